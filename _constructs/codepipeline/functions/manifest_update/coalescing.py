@@ -0,0 +1,52 @@
+"""短時間に連続したbuildのtag updateをまとめる
+
+jobは(repository, branch, manifest)毎のitemに自身のtagを最新として登録し、coalesce windowの間待機する
+(continuation tokenで再invokeされる)。window経過後、自身のtagが最新のままのtargetのみを更新する。
+CodePipelineはcontinuationを新しいjob idのjobとして実行するため、登録したjob idはstateに保持して比較する。
+後続のjobに上書きされたtargetは後続のjobが更新するため、全targetが上書きされたjobは更新せずに成功とする。
+"""
+import time
+from store import StateStore
+
+PHASE_COALESCE = 'coalesce'
+KEY_PREFIX = 'coalesce'
+ITEM_TTL_SECONDS = 7 * 24 * 3600
+
+
+def coalesce_key(repository: str, branch: str, manifest: str) -> str:
+    return f'{KEY_PREFIX}#{repository}#{branch}#{manifest}'
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def register(store: StateStore, repository: str, conf: dict, job_id: str, window_ms: int) -> dict:
+    """全targetにjobのtagを最新として登録し、window経過まで待機するstateを返す"""
+    requested_at = now_ms()
+    for target in conf['targets']:
+        for manifest in target['manifests']:
+            # requested_atがより新しいjobが登録済みの場合は上書きしない(そのtargetはsupersededとなる)
+            store.put_if_newer(coalesce_key(repository, target['branch'], manifest), {
+                'tag': conf['container_image_tag'],
+                'job_id': job_id,
+                'requested_at': requested_at,
+                'expires_at': requested_at // 1000 + ITEM_TTL_SECONDS,
+            }, order_key='requested_at')
+    return {'phase': PHASE_COALESCE, 'not_before': requested_at + window_ms, 'job_id': job_id}
+
+
+def is_waiting(state: dict) -> bool:
+    return now_ms() < state['not_before']
+
+
+def owned_targets(store: StateStore, repository: str, conf: dict, job_id: str) -> list:
+    """自身のtagが最新のままのtarget(branch x manifest)を返す。job_idはregister()したjobのid"""
+    targets = []
+    for target in conf['targets']:
+        manifests = [manifest for manifest in target['manifests']
+                     if (store.get(coalesce_key(repository, target['branch'], manifest)) or {}).get('job_id')
+                     == job_id]
+        if manifests:
+            targets.append({'branch': target['branch'], 'manifests': manifests})
+    return targets
@@ -1,173 +1,1010 @@
-import shutil
+import os
+import time
 import json
-import yaml
-import boto3
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 from aws_lambda_powertools import Logger
-from dulwich import porcelain
+from dulwich.client import get_transport_and_path, HTTPUnauthorized
+from dulwich.objects import Blob, Commit, Tree
+from dulwich.object_store import tree_lookup_path
+from dulwich.errors import NotGitRepository
+from dulwich.repo import Repo
+from repository_cache import RepositoryCache
+from github_api import GithubApi, GithubApiError
+from image_updater import ImageIndex, ImageReference, update_images
+from memory_repo import MemoryLimitExceeded, bounded_memory_repo
+from telemetry import metrics, tracer, measure_phase, add_bytes, add_count, add_dimensions, in_current_trace
+from telemetry import collect_metrics, emit_repository_metrics
+from store import StateStore
+import coalescing
+import idempotency
+import ledger
+import promotion
 
 logger = Logger()
-code_pipeline_client = boto3.client('codepipeline')
-secrets_manager_client = boto3.client('secretsmanager')
+
+# boto3(import含む)とclientは初回利用時に作成する(cold startのinit phaseで作成しない)
+# dulwich.porcelainはfull clone modeでのみimportする
+_clients = {}
+
+# Secrets Managerから取得したGitHub tokenのcache (secret_id -> (token, 有効期限))
+SECRET_TTL_SECONDS = int(os.environ.get('SECRET_TTL_SECONDS', '300'))
+_secret_cache = {}
+
+# Warm containerで再利用するCD Repositoryのcache
+REPO_CACHE_DIR = os.environ.get('REPO_CACHE_DIR', '/tmp/repo-cache')
+REPO_CACHE_MAX_BYTES = int(os.environ.get('REPO_CACHE_MAX_MB', '256')) * 1024 * 1024  # entry毎の上限
+# cache全体の上限(/tmpのdefaultは512MB)。超えた場合は最後に使用した時刻が古いentryから削除する
+REPO_CACHE_TOTAL_MAX_BYTES = int(os.environ.get('REPO_CACHE_TOTAL_MAX_MB', '384')) * 1024 * 1024
+
+# 同じbranchへの同時pushでrejectされた場合、fetchしてtagを再適用しretryする
+PUSH_MAX_ATTEMPTS = int(os.environ.get('PUSH_MAX_ATTEMPTS', '4'))
+PUSH_BACKOFF_SECONDS = float(os.environ.get('PUSH_BACKOFF_SECONDS', '0.5'))  # 1回目のretryの最大待ち時間
+PUSH_BACKOFF_MAX_SECONDS = 5.0
+
+# Lambdaの残り時間がこれ未満となった場合、次のphaseはcontinuation tokenで別のinvocationとして実行する
+CONTINUATION_REMAINING_MS = int(os.environ.get('CONTINUATION_REMAINING_MS', '30000'))
+CONTINUATION_TOKEN_MAX_LENGTH = 2048  # CodePipelineのcontinuationTokenの上限
+
+# 複数のCD Repositoryを更新する場合に並列に処理するrepository数
+FANOUT_MAX_WORKERS = int(os.environ.get('FANOUT_MAX_WORKERS', '4'))
+
+# tag updateの状態(coalesce等)を保持するDynamoDB table
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME')
+
+
+CLONE_MODE_FULL = 'full'
+CLONE_MODE_SPARSE = 'sparse'  # shallow(depth=1) + single-branch + target manifestのみcheckout
+CLONE_MODE_MEMORY = 'memory'  # shallow(depth=1) + single-branch をmemory上のobject storeにfetchする(/tmpを使用しない)
+
+# memory modeでfetchするobjectの上限。超えた場合はsparse(disk)にfallbackする
+MEMORY_REPO_MAX_BYTES = int(os.environ.get('MEMORY_REPO_MAX_MB', '32')) * 1024 * 1024
+
+EDIT_MODE_SURGICAL = 'surgical'  # image scalarの範囲のみ書き換え、それ以外はbyte単位で維持する
+EDIT_MODE_ROUNDTRIP = 'roundtrip'  # yaml load -> dump (comment, formatは失われる)
+
+BACKEND_GIT = 'git'  # clone -> add -> commit -> push
+BACKEND_API = 'api'  # GitHub Git Data API (cloneしない)
+
+PHASE_FETCH = 'fetch'  # clone/fetch
+PHASE_EDIT = 'edit'  # manifestのimage tag更新とcommit作成
+PHASE_PUSH = 'push'
+PHASE_DONE = 'done'
+
+
+class GitPushError(Exception):
+    """remoteのbranchがclone/fetch後に更新されていた等で、pushがrejectされた"""
+    pass
+
+
+class ResumeError(Exception):
+    """continuation tokenのcommitがlocal repositoryにない"""
+    pass
+
+
+class FanOutError(Exception):
+    """複数のCD Repositoryの更新で、一部のrepositoryが失敗した"""
+    def __init__(self, repositories: list):
+        super().__init__(f'failed repositories: {repositories}')
+        self.repositories = repositories
 
 
 class Git:
     def __init__(self,
                  cd_repository: str,
-                 branch: str,
+                 targets: list,  # [{'branch': 'dev', 'manifests': ['deployment.yaml']}, ...]
                  local_repo_path: str,  # 'current path' + '/tmp/repo'
-                 target_manifest: str,  # 'deployment.yaml'
-                 github_personal_access_token: str):
+                 github_personal_access_token: str,
+                 clone_mode: str = CLONE_MODE_FULL):
 
         self._cd_repository = cd_repository
-        self._target_manifest = target_manifest
-        self._branch = branch
+        self._targets = targets
+        self._branches = [target['branch'] for target in targets]
         self._local_repo_path = local_repo_path
         self._github_personal_access_token = github_personal_access_token
+        self._clone_mode = clone_mode
         self._local_repo = None
+        self._heads = {}  # branch -> fetchしたcommit id
+        self._staged = {}  # branch -> {manifest: 更新後のcontent}
+        self._blobs = {}  # branch -> {manifest: add()したblob id}
+        self._commits = {}  # branch -> commit()したcommit id
+        # metrics用: clone/fetchで増えた.git/objectsのsize, pushしたcommitのobject size(zlib圧縮後)
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self._unpushed_bytes = 0
         self.author = 'aws-codepipeline-lambda <lambda@example.com>'
         self.username = 'not relevant'
 
     def clone(self):
         logger.info('GitHub CD Repository clone(): '
                     f'source={self._cd_repository}'
-                    f'branch={self._branch}'
-                    f'target={self._local_repo_path}')
+                    f'branches={self._branches}'
+                    f'target={self._local_repo_path}'
+                    f'mode={self._clone_mode}')
+        if self._clone_mode == CLONE_MODE_MEMORY:
+            self._memory_clone()
+            return
+        if self._clone_mode == CLONE_MODE_SPARSE:
+            self._sparse_clone()
+        else:
+            self._full_clone()
+        self.bytes_received += self._objects_size()
+
+    def _full_clone(self):
+        from dulwich import porcelain
         self._local_repo = porcelain.clone(
             source=self._cd_repository,
-            branch=self._branch.encode('utf-8'),  # e.g. dev, stg, prd
+            branch=self._branches[0].encode('utf-8'),  # e.g. dev, stg, prd
             password=self._github_personal_access_token,
             username=self.username,
             target=self._local_repo_path,
             checkout=True
         )
+        # 全branchをfetch済みのため、対象branchのlocal refをremote refに合わせる
+        for branch in self._branches:
+            remote_ref = b'refs/remotes/origin/' + branch.encode('utf-8')
+            if remote_ref not in self._local_repo.refs:
+                raise ValueError(f'branch not found: {branch}')
+            self._heads[branch] = self._local_repo.refs[remote_ref]
+            self._local_repo.refs[self._branch_ref(branch)] = self._heads[branch]
+
+    def _sparse_clone(self):
+        # 対象branchのみをdepth=1でfetchし、target manifestだけをworking treeに書き出す。
+        # 他のserviceのmanifestや過去のhistoryはfetchしない。
+        os.makedirs(self._local_repo_path, exist_ok=True)
+        self._local_repo = Repo.init(self._local_repo_path)
+        self._fetch_branches(depth=1)
+        self._local_repo.refs.set_symbolic_ref(b'HEAD', self._branch_ref(self._branches[0]))
+        self._checkout_manifests()
+
+    def _memory_clone(self):
+        # working treeを作らず、manifestの編集からcommit, pushまでmemory上のobjectのみで行う
+        self._local_repo = bounded_memory_repo(MEMORY_REPO_MAX_BYTES)
+        self._fetch_branches(depth=1)
+        self.bytes_received += self._objects_size()
+
+    @property
+    def in_memory(self) -> bool:
+        return self._clone_mode == CLONE_MODE_MEMORY
+
+    def use_disk(self):
+        """memory modeで上限を超えた場合に、sparse(disk)に切り替える"""
+        logger.info(f'memory repository exceeds {MEMORY_REPO_MAX_BYTES} bytes, fallback to sparse clone')
+        self._clone_mode = CLONE_MODE_SPARSE
+        self._local_repo = None
+        self._heads, self._staged, self._blobs, self._commits = {}, {}, {}, {}
+
+    def fetch(self):
+        """cache済みのlocal repositoryにincremental fetchし、remote headにhard resetする"""
+        logger.info('GitHub CD Repository fetch(): '
+                    f'source={self._cd_repository}'
+                    f'branches={self._branches}'
+                    f'target={self._local_repo_path}'
+                    f'mode={self._clone_mode}')
+        if self._clone_mode == CLONE_MODE_MEMORY:
+            objects_size = self._objects_size()
+            self._fetch_branches(depth=1)
+            self.bytes_received += self._objects_size() - objects_size
+            return
+
+        self._local_repo = Repo(self._local_repo_path)
+        objects_size = self._objects_size()
+        if self._clone_mode == CLONE_MODE_SPARSE:
+            self._fetch_branches(depth=1)
+            self._checkout_manifests()
+        else:
+            from dulwich import porcelain
+            self._fetch_branches()
+            for branch, head in self._heads.items():
+                self._local_repo.refs[b'refs/remotes/origin/' + branch.encode('utf-8')] = head
+            porcelain.reset(self._local_repo, 'hard', b'HEAD')
+        self.bytes_received += self._objects_size() - objects_size
+
+    def _objects_size(self) -> int:
+        if self._clone_mode == CLONE_MODE_MEMORY:
+            return self._local_repo.object_store.size  # 非圧縮のsize
+        return RepositoryCache.size_of(os.path.join(self._local_repo_path, '.git', 'objects'))
+
+    @staticmethod
+    def _branch_ref(branch: str) -> bytes:
+        return b'refs/heads/' + branch.encode('utf-8')
+
+    def _fetch_branches(self, depth: int = None):
+        # 対象branchのみ1回のfetchで取得し、local branchをremote headに合わせる
+        branch_refs = [self._branch_ref(branch) for branch in self._branches]
+        client, path = get_transport_and_path(
+            self._cd_repository,
+            username=self.username,
+            password=self._github_personal_access_token)
+
+        def determine_wants(refs, depth=None):
+            missing = [ref for ref in branch_refs if ref not in refs]
+            if missing:
+                raise ValueError(f'branch not found: {missing}')
+            # 前回pushしたcommit等、local repositoryにあるheadはfetchしない(全てある場合はpackを受信しない)。
+            # depthを指定したfetchはhaveがあってもhead commitのtree全体を再送するため
+            return list({refs[ref] for ref in branch_refs if refs[ref] not in self._local_repo.object_store})
+
+        result = client.fetch(path, self._local_repo, determine_wants=determine_wants, depth=depth)
+        for branch, branch_ref in zip(self._branches, branch_refs):
+            self._heads[branch] = result.refs[branch_ref]
+            self._local_repo.refs[branch_ref] = self._heads[branch]
+
+    def _checkout_manifests(self):
+        # HEAD(先頭のbranch)のtarget manifestのみworking treeに書き出す
+        target = self._targets[0]
+        for manifest in target['manifests']:
+            manifest_path = os.path.join(self._local_repo_path, manifest)
+            os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+            with open(manifest_path, 'wb') as f:
+                f.write(self._read_blob(target['branch'], manifest))
+
+    def _head_blob_id(self, branch: str, manifest: str) -> bytes:
+        _, blob_id = tree_lookup_path(
+            self._local_repo.__getitem__,
+            self._local_repo[self._heads[branch]].tree,
+            manifest.encode('utf-8'))
+        return blob_id
+
+    def manifest_blob_id(self, branch: str, manifest: str) -> str:
+        return self._head_blob_id(branch, manifest).decode('ascii')
+
+    def _read_blob(self, branch: str, manifest: str) -> bytes:
+        return self._local_repo[self._head_blob_id(branch, manifest)].data
+
+    def read_manifest(self, branch: str, manifest: str) -> str:
+        staged = self._staged.get(branch, {})
+        if manifest in staged:
+            return staged[manifest].decode('utf-8')
+        return self._read_blob(branch, manifest).decode('utf-8')
+
+    def write_manifest(self, branch: str, manifest: str, content: str):
+        # branch headのblobと同じhashであれば変更なしとしてstageしない
+        data = content.encode('utf-8')
+        staged = self._staged.setdefault(branch, {})
+        if Blob.from_string(data).id == self._head_blob_id(branch, manifest):
+            staged.pop(manifest, None)
+            logger.info(f'git write_manifest(): unchanged, branch={branch}, manifest={manifest}')
+            return
+        staged[manifest] = data
+
+    def has_changes(self) -> bool:
+        return any(self._staged.values())
 
     def add(self):
+        # working treeではなくobject storeにblobを直接追加する
+        paths = {branch: list(staged) for branch, staged in self._staged.items()}
         logger.info(
             f'git add(): repo={self._local_repo}, '
-            f'paths={self._local_repo_path + self._target_manifest}')
-        porcelain.add(
-            repo=self._local_repo,
-            paths=self._local_repo_path + self._target_manifest
-        )
+            f'paths={paths}')
+        self._unpushed_bytes = -self._objects_size()
+        for branch, staged in self._staged.items():
+            for manifest, content in staged.items():
+                blob = Blob.from_string(content)
+                self._local_repo.object_store.add_object(blob)
+                self._blobs.setdefault(branch, {})[manifest] = blob.id
 
     def commit(self):
+        # branch毎に1つのcommitを作成する
         logger.info(
-            f'git commit(): repo={self._local_repo}')
-        porcelain.commit(
-            repo=self._local_repo,
-            message='Update Image Tag',
-            author=self.author
-        )
+            f'git commit(): repo={self._local_repo}, branches={list(self._blobs)}')
+        object_store = self._local_repo.object_store
+        for branch, blobs in self._blobs.items():
+            tree_id = self._local_repo[self._heads[branch]].tree
+            for manifest, blob_id in blobs.items():
+                tree_id = replace_tree_entry(
+                    object_store,
+                    tree_id=tree_id,
+                    path=manifest.encode('utf-8'),
+                    blob_id=blob_id)
+
+            commit = Commit()
+            commit.tree = tree_id
+            commit.parents = [self._heads[branch]]
+            commit.author = commit.committer = self.author.encode('utf-8')
+            commit.author_time = commit.commit_time = int(time.time())
+            commit.author_timezone = commit.commit_timezone = 0
+            commit.encoding = b'UTF-8'
+            commit.message = b'Update Image Tag'
+            object_store.add_object(commit)
+
+            self._local_repo.refs[self._branch_ref(branch)] = commit.id
+            self._commits[branch] = commit.id
+        self._unpushed_bytes += self._objects_size()
 
     def push(self):
+        # commitした全branchのrefを1回のpushで更新する
         logger.info(
             f'git push():'
             f'repo={self._local_repo}'
             f'remote_location={self._cd_repository}'
-            f'refspecs={self._branch}')
+            f'refspecs={list(self._commits)}')
 
-        porcelain.push(
-            repo=self._local_repo,
-            remote_location=self._cd_repository,
-            refspecs=self._branch.encode('utf-8'),
-            password=self._github_personal_access_token,
-            username=self.username
-        )
+        new_refs = {self._branch_ref(branch): commit_id for branch, commit_id in self._commits.items()}
+        client, path = get_transport_and_path(
+            self._cd_repository,
+            username=self.username,
+            password=self._github_personal_access_token)
+
+        def update_refs(refs):
+            # clone/fetch後に他のinvocationがpushしていた場合は上書きせずrejectとする
+            moved = [branch for branch in self._commits
+                     if refs.get(self._branch_ref(branch)) != self._heads[branch]]
+            if moved:
+                raise GitPushError(f'push rejected: remote branch updated {moved}')
+            refs = dict(refs)
+            refs.update(new_refs)
+            return refs
+
+        result = client.send_pack(path, update_refs, self._local_repo.generate_pack_data)
+        errors = {ref: status for ref, status in (result.ref_status or {}).items() if status is not None}
+        if errors:
+            raise GitPushError(f'push rejected: {errors}')
+        self._heads.update(self._commits)
+        self.bytes_sent += self._unpushed_bytes
+
+    def checkpoint(self) -> dict:
+        # continuation tokenに保存する、push前のheadと作成したcommit
+        return {'heads': {branch: self._heads[branch].decode('ascii') for branch in self._commits},
+                'commits': {branch: commit_id.decode('ascii') for branch, commit_id in self._commits.items()}}
+
+    def resume(self, heads: dict, commits: dict):
+        """checkpoint()の状態をcacheしたlocal repositoryから復元する"""
+        if self._clone_mode == CLONE_MODE_MEMORY:
+            raise ResumeError('memory repository is not kept across invocations')
+        try:
+            self._local_repo = Repo(self._local_repo_path)
+            for branch, commit_id in commits.items():
+                if self._local_repo[commit_id.encode('ascii')].parents != [heads[branch].encode('ascii')]:
+                    raise ResumeError(f'unexpected parent: branch={branch}, commit={commit_id}')
+        except (NotGitRepository, KeyError) as e:
+            raise ResumeError(f'commit not found in {self._local_repo_path}: {e}')
+        self._heads = {branch: head.encode('ascii') for branch, head in heads.items()}
+        self._commits = {branch: commit_id.encode('ascii') for branch, commit_id in commits.items()}
+
+    def refresh(self):
+        """stageした変更を破棄し、remoteの最新headをfetchし直す"""
+        self._staged, self._blobs, self._commits = {}, {}, {}
+        self.fetch()
+
+
+def replace_tree_entry(object_store, tree_id: bytes, path: bytes, blob_id: bytes) -> bytes:
+    """tree_idのpathをblob_idに差し替えたTreeを作成し、そのidを返す。
+    サブディレクトリのTreeも再帰的に作り直す。"""
+    tree = object_store[tree_id]
+    name, _, rest = path.partition(b'/')
+    mode, entry_id = tree[name]
+    if rest:
+        entry_id = replace_tree_entry(object_store, entry_id, rest, blob_id)
+    else:
+        entry_id = blob_id
+
+    new_tree = Tree()
+    for item in tree.items():
+        new_tree.add(item.path, item.mode, item.sha)
+    new_tree.add(name, mode, entry_id)
+    object_store.add_object(new_tree)
+    return new_tree.id
 
 
 class ManifestUpdated:
-    def __init__(self, target_manifest, container_image_tag):
+    def __init__(self, target_manifest, container_image_tag, container_image_name=None,
+                 edit_mode=EDIT_MODE_SURGICAL):
         self.target_manifest = target_manifest
         self.container_image_tag = container_image_tag
+        self.container_image_name = container_image_name  # ECR Repository名 e.g. flask
+        self.edit_mode = edit_mode
 
     def update_image_tag(self):
         logger.info('ManifestUpdated update_image_tag()')
         # read manifest
-        with open(self.target_manifest, 'r', encoding='utf-8') as f:
+        with open(self.target_manifest, 'r', encoding='utf-8', newline='') as f:
             logger.info('ManifestUpdated open(r)')
-            manifest = yaml.safe_load(f)
-            replaced_manifest = self.replace_image_tag(  # update manifest
-                manifest,
-                container_image_tag=self.container_image_tag)
+            content = f.read()
 
         # write manifest
-        with open(self.target_manifest, 'w', encoding='utf-8') as f:
+        with open(self.target_manifest, 'w', encoding='utf-8', newline='') as f:
             logger.info('ManifestUpdated open(w)')
-            yaml.dump(
-                data=replaced_manifest,
-                stream=f,
-                sort_keys=False)  # Keyの順番を維持するためにsort_key=Falseを指定
+            f.write(self.update_image_tag_content(content))
 
-    @staticmethod
-    def replace_image_tag(manifest, container_image_tag: str):
-        logger.info('ManifestUpdated replace_image_tag()')
+    def update_image_tag_content(self, content: str) -> str:
+        # manifestの文字列を受け取り、image tagを更新した文字列を返す
+        # multi-document, initContainers, CronJob, kustomization.yamlのimages:に対応
+        index = ImageIndex(content, filename=self.target_manifest)
+        logger.info(f'ManifestUpdated update_image_tag_content(): '
+                    f'documents={index.documents}, images={len(index.containers)}, mode={self.edit_mode}')
+        new_tags = self.new_tags(index)
+        self.image_changes = index.image_changes(new_tags)  # change record用
+        return update_images(content, new_tags, filename=self.target_manifest, index=index,
+                             preserve_format=(self.edit_mode == EDIT_MODE_SURGICAL))
+
+    def new_tags(self, index: ImageIndex) -> dict:
+        if self.container_image_name:
+            return {self.container_image_name: self.container_image_tag}
+        # image名が指定されていない場合はECRのimageを全て更新する
+        references = [ImageReference(location.image) for location in index.containers]
+        return {reference.name: self.container_image_tag
+                for reference in references if '.dkr.ecr.' in reference.registry}
+
+
+def prepare_repository(git: Git, cache: RepositoryCache, local_repo_path: str, branches: list):
+    # cacheが利用できればincremental fetch、できなければfresh clone
+    if cache.is_usable(local_repo_path, branches):
+        try:
+            with measure_phase('Fetch'):
+                git.fetch()
+            return
+        except Exception as e:
+            logger.info(f'fetch failed, fallback to clone: {e}')
+
+    cache.invalidate(local_repo_path)
+    os.makedirs(cache.cache_dir, exist_ok=True)
+    with measure_phase('Clone'):
+        git.clone()
+
+
+def get_client(service_name: str):
+    if service_name not in _clients:
+        import boto3
+        _clients[service_name] = boto3.client(service_name)
+    return _clients[service_name]
+
+
+def get_code_pipeline_client():
+    return get_client('codepipeline')
 
-        image = manifest['spec']['template']['spec']['containers'][0]['image']
-        _list = image.rsplit(':')
-        _list[1] = container_image_tag  # Update Tag
-        image_value = ':'.join(_list)
-        # update manifest
-        manifest['spec']['template']['spec']['containers'][0]['image'] = image_value
 
-        return manifest
+def get_secrets_manager_client():
+    return get_client('secretsmanager')
 
-def get_secret(secret_id: str) -> str:
-    response = secrets_manager_client.get_secret_value(SecretId=secret_id)
+
+def get_state_store() -> Optional[StateStore]:
+    # tableが指定されていない場合はcoalesce, change recordを使用しない
+    if STATE_TABLE_NAME is None:
+        return None
+    if 'state_store' not in _clients:
+        _clients['state_store'] = StateStore(STATE_TABLE_NAME)
+    return _clients['state_store']
+
+
+def get_secret(secret_id: str, force_refresh: bool = False) -> str:
+    # TTL内はcacheを返す。tokenのrotation後に認証エラーとなった場合はforce_refreshで再取得する
+    cached = _secret_cache.get(secret_id)
+    if cached is not None and not force_refresh and time.monotonic() < cached[1]:
+        return cached[0]
+
+    logger.info(f'get_secret(): secret_id={secret_id}, force_refresh={force_refresh}')
+    response = get_secrets_manager_client().get_secret_value(SecretId=secret_id)
+    _secret_cache[secret_id] = (response['SecretString'], time.monotonic() + SECRET_TTL_SECONDS)
     return response['SecretString']
 
+
+def repository_name(url: str) -> str:
+    # https://github.com/rafty/handson-flask_cd.git -> handson-flask_cd
+    name = url.rstrip('/').rsplit('/', 1)[-1]
+    return name[:-len('.git')] if name.endswith('.git') else name
+
+
+def is_authentication_error(e: Exception) -> bool:
+    if isinstance(e, HTTPUnauthorized):
+        return True
+    return isinstance(e, GithubApiError) and e.status == 401
+
+
 def extruct_user_parameters(event: dict) -> dict:
     logger.info(f'extruct_user_parameters() - event: {event}')
     job_data = event['CodePipeline.job']['data']
     user_parameters = json.loads(job_data['actionConfiguration']['configuration']['UserParameters'])
     conf = {
         'github_cd_repository': user_parameters['github_cd_repository'],
-        'github_cd_manifest': user_parameters['github_cd_manifest'],  # deployment.yaml
         'github_token_name': user_parameters['github_token_name'],
-        'github_branch': user_parameters['github_branch'],  # dev, stg, prd
-        'container_image_tag': user_parameters['container_image_tag']['value']  # from Build Stage
+        'targets': extruct_targets(user_parameters),
+        # github_repositoriesを指定した場合は複数のCD Repositoryを並列に更新する
+        'repositories': extruct_repositories(user_parameters),
+        'container_image_tag': user_parameters['container_image_tag']['value'],  # from Build Stage
+        'container_image_name': user_parameters.get('container_image_name', {}).get('value'),  # flask
+        'github_clone_mode': user_parameters.get('github_clone_mode', CLONE_MODE_FULL),  # full, sparse
+        'github_backend': user_parameters.get('github_backend', BACKEND_GIT),  # git, api
+        'github_api_url': user_parameters.get('github_api_url', 'https://api.github.com'),
+        'manifest_edit_mode': user_parameters.get('manifest_edit_mode', EDIT_MODE_SURGICAL),
+        # 0より大きい場合、window内に続いたbuildのtag updateをまとめて最新のtagのみ更新する
+        'coalesce_window_seconds': int(user_parameters.get('coalesce_window_seconds', 0)),
     }
     return conf
 
 
+def extruct_repositories(user_parameters: dict) -> list:
+    # github_repositories: [{'github_cd_repository': url, 'github_targets': [...]}, ...]
+    # github_branch, github_cd_manifest等を省略した場合はtop levelの値を使用する
+    if 'github_repositories' not in user_parameters:
+        return []
+    return [{
+        'github_cd_repository': repository['github_cd_repository'],
+        'targets': extruct_targets(dict(
+            {key: value for key, value in user_parameters.items() if key != 'github_targets'}, **repository)),
+    } for repository in user_parameters['github_repositories']]
+
+
+def extruct_targets(user_parameters: dict) -> list:
+    # github_targets: [{'branch': 'dev', 'manifests': ['deployment.yaml', ...]}, ...]
+    # 未指定の場合はgithub_branch, github_cd_manifestの1 targetとする
+    if 'github_targets' not in user_parameters:
+        return [{
+            'branch': user_parameters['github_branch'],  # dev, stg, prd
+            'manifests': [user_parameters['github_cd_manifest']],  # deployment.yaml
+        }]
+
+    targets = {}  # 同じbranchが複数回指定された場合はmanifestをまとめる
+    for target in user_parameters['github_targets']:
+        manifests = targets.setdefault(target['branch'], [])
+        manifests.extend(m for m in target['manifests'] if m not in manifests)
+    return [{'branch': branch, 'manifests': manifests} for branch, manifests in targets.items()]
+
+
+def update_manifests(conf: dict, github_personal_access_token: str, state: dict = None, context=None) -> dict:
+    """全target(branch x manifest)のimage tagを更新してpushする。
+
+    fetch -> edit -> push のphase毎に、Lambdaの残り時間がCONTINUATION_REMAINING_MS未満であれば
+    次のphaseのstateを返して中断する(continuation tokenとしてCodePipelineに渡す)。
+    完了した場合は {'phase': 'done', 'updated': bool, 'commits': {branch: pushしたcommit}} を返す。
+    """
+    state = dict(state or {'phase': PHASE_FETCH, 'attempt': 1})
+    lambda_local_path = None
+    git = None
+    try:
+        if conf['github_backend'] == BACKEND_API:
+            git = GithubApi(
+                cd_repository=conf['github_cd_repository'],
+                targets=conf['targets'],
+                github_personal_access_token=github_personal_access_token,
+                api_url=conf['github_api_url']
+            )
+
+            def prepare():
+                with measure_phase('Clone', backend=BACKEND_API):
+                    git.clone()
+        else:
+            branches = [target['branch'] for target in conf['targets']]
+            cache = RepositoryCache(cache_dir=REPO_CACHE_DIR, max_bytes=REPO_CACHE_MAX_BYTES,
+                                    total_max_bytes=REPO_CACHE_TOTAL_MAX_BYTES)
+            # memory modeの場合、上限を超えてfallbackした際にsparseのcacheを使用する
+            clone_mode = conf['github_clone_mode']
+            lambda_local_path = cache.path_for(  # lambda local path
+                conf['github_cd_repository'], branches,
+                CLONE_MODE_SPARSE if clone_mode == CLONE_MODE_MEMORY else clone_mode)
+            # fan-outの他のthreadのevict()で削除されないよう、このinvocationの間は使用中とする
+            cache.acquire(lambda_local_path)
+
+            git = Git(
+                cd_repository=conf['github_cd_repository'],
+                targets=conf['targets'],
+                local_repo_path=lambda_local_path,
+                github_personal_access_token=github_personal_access_token,
+                clone_mode=conf['github_clone_mode']
+            )
+
+            def prepare():
+                if git.in_memory:
+                    try:
+                        with measure_phase('Clone'):
+                            git.clone()
+                        return
+                    except MemoryLimitExceeded as e:
+                        logger.info(e)
+                        git.use_disk()
+                prepare_repository(git, cache, lambda_local_path, branches)
+
+        prepared = False  # このinvocationでclone/fetch済みか
+        while state['phase'] != PHASE_DONE:
+            logger.info(f'update_manifests(): phase={state["phase"]}, attempt={state["attempt"]}')
+            if state['phase'] == PHASE_FETCH:
+                prepare()
+                prepared = True
+                state = {'phase': PHASE_EDIT, 'attempt': state['attempt']}
+
+            elif state['phase'] == PHASE_EDIT:
+                # 前回のinvocationでfetchした場合も、最新のheadに対してeditする(cacheがあればfetchのみ)
+                if not prepared:
+                    prepare()
+                    prepared = True
+                changes = []
+                if not apply_and_commit(conf, git, changes):
+                    state = {'phase': PHASE_DONE, 'updated': False}
+                    continue
+                state = dict(git.checkpoint(), phase=PHASE_PUSH, attempt=state['attempt'], changes=changes)
+
+            elif state['phase'] == PHASE_PUSH:
+                if not prepared:
+                    try:
+                        git.resume(state['heads'], state['commits'])
+                    except ResumeError as e:
+                        # 別のcontainerで実行された等でcommitが残っていない場合はeditからやり直す
+                        logger.info(f'resume failed, re-apply from edit phase: {e}')
+                        state = {'phase': PHASE_EDIT, 'attempt': state['attempt']}
+                        continue
+                try:
+                    with measure_phase('Push', attempt=state['attempt']):
+                        git.push()  # 全branchを1回でpush
+                    # pushしたblobのみ他のinvocationで再利用されるよう、push後にchange recordを保存する
+                    save_change_records(state.get('changes', []))
+                    state = {'phase': PHASE_DONE, 'updated': True, 'commits': git.checkpoint()['commits']}
+                except (GitPushError, GithubApiError) as e:
+                    attempt = state['attempt']
+                    if (isinstance(e, GithubApiError) and e.status != 422) or attempt >= PUSH_MAX_ATTEMPTS:
+                        raise
+                    # full jitter: 同時に失敗したinvocationが同じtimingでretryしないようにする
+                    delay = random.uniform(0, min(PUSH_BACKOFF_MAX_SECONDS, PUSH_BACKOFF_SECONDS * 2 ** (attempt - 1)))
+                    logger.info(f'push rejected, retry after {delay:.2f}s (attempt {attempt}): {e}')
+                    time.sleep(delay)
+                    git.refresh()  # 最新のheadの上にtagを再適用する
+                    prepared = True
+                    state = {'phase': PHASE_EDIT, 'attempt': attempt + 1}
+
+            if state['phase'] != PHASE_DONE and should_continue_later(state, context):
+                break
+        # "/tmp/repo-cache/"は次回のinvocationで再利用するため削除しない
+        if lambda_local_path is not None and not git.in_memory:
+            cache.record(lambda_local_path, git.bytes_received + git.bytes_sent)
+        return state
+
+    except Exception:
+        # local repositoryの状態が不明なためcacheを破棄する
+        if lambda_local_path is not None:
+            RepositoryCache.invalidate(lambda_local_path)
+        raise
+
+    finally:
+        if lambda_local_path is not None:
+            RepositoryCache.release(lambda_local_path)
+        if git is not None:
+            add_bytes('BytesReceived', git.bytes_received)
+            add_bytes('BytesSent', git.bytes_sent)
+
+
+def apply_and_commit(conf: dict, git, changes: list) -> bool:
+    # 1回のclone/fetchで全target(branch x manifest)を更新する
+    # changesにはpush後に保存するchange record [change key, change]を追加する
+    store = get_state_store()
+    with measure_phase('ManifestEdit', edit_mode=conf['manifest_edit_mode']):
+        for target in conf['targets']:
+            for target_manifest in target['manifests']:
+                change_key = promotion.change_key(conf['github_cd_repository'], target_manifest,
+                                                  conf['container_image_name'], conf['container_image_tag'],
+                                                  conf['manifest_edit_mode'])
+                if store is not None and apply_change_record(store, change_key, git, target['branch'],
+                                                             target_manifest):
+                    continue
+
+                manifest = ManifestUpdated(
+                    target_manifest=target_manifest,
+                    container_image_tag=conf['container_image_tag'],
+                    container_image_name=conf['container_image_name'],
+                    edit_mode=conf['manifest_edit_mode']
+                )
+                content = git.read_manifest(target['branch'], target_manifest)
+                add_bytes('ManifestSize', len(content.encode('utf-8')))
+                updated_content = manifest.update_image_tag_content(content)
+                git.write_manifest(target['branch'], target_manifest, updated_content)
+                if store is not None and updated_content != content:
+                    changes.append([change_key, promotion.new_change(content, updated_content,
+                                                                     manifest.image_changes)])
+
+    if not git.has_changes():
+        # retryや同じtagの再promotionでmanifestが変わらない場合、空のcommitをpushしない
+        logger.info('Skip commit and push: manifest blob is identical to branch head.')
+        return False
+
+    with measure_phase('Commit'):
+        git.add()
+        git.commit()  # branch毎に1 commit
+    return True
+
+
+def should_continue_later(state: dict, context) -> bool:
+    # 残り時間が少ない場合は次のphaseをcontinuation tokenで再開する
+    if context is None or len(json.dumps(state)) > CONTINUATION_TOKEN_MAX_LENGTH:
+        return False
+    return context.get_remaining_time_in_millis() < CONTINUATION_REMAINING_MS
+
+
+def apply_change_record(store: StateStore, change_key: str, git, branch: str, manifest: str) -> bool:
+    # 別のinvocation(dev stage等)が同じmanifestに同じtagを適用済みであれば、parse/editせずに結果を使用する
+    try:
+        change = promotion.find_change(store, change_key, git.manifest_blob_id(branch, manifest))
+    except Exception as e:
+        logger.info(f'change record lookup failed, edit manifest: {e}')
+        return False
+    if change is None:
+        return False
+
+    if isinstance(git, GithubApi):
+        git.write_manifest_blob(branch, manifest, change['new_blob'])
+    else:
+        content = promotion.reapply(git.read_manifest(branch, manifest), change)
+        if content is None:
+            logger.info(f'change record does not match, edit manifest: branch={branch}, manifest={manifest}')
+            return False
+        git.write_manifest(branch, manifest, content)
+    logger.info(f'apply change record: branch={branch}, manifest={manifest}, images={change["images"]}')
+    add_count('ChangeRecordApplied')
+    return True
+
+
+def save_change_records(changes: list):
+    store = get_state_store()
+    if store is None:
+        return
+    for change_key, change in changes:
+        try:
+            promotion.record_change(store, change_key, change)
+        except Exception as e:
+            # change recordはpromotionの高速化のみに使用するため、保存できなくても更新は続ける
+            logger.info(f'change record save failed: {e}')
+
+
+def pending_targets(store: StateStore, job_id: str, conf: dict) -> list:
+    records = idempotency.completed(store, job_id, conf['github_cd_repository'], conf['targets'])
+    for branch, record in records.items():
+        logger.info(f'job already completed: branch={branch}, commit={record["commit"]}')
+    if records:
+        add_count('DuplicateJob')
+    return [target for target in conf['targets'] if target['branch'] not in records]
+
+
+def run_update(conf: dict, state: Optional[dict], context) -> dict:
+    try:
+        return update_manifests(conf, get_secret_measured(conf['github_token_name']), state, context)
+    except Exception as e:
+        if not is_authentication_error(e):
+            raise
+        # cacheしたtokenがrotationで無効になった場合、再取得して1回だけretryする
+        logger.info(f'authentication failed, refresh secret: {e}')
+        return update_manifests(conf, get_secret_measured(conf['github_token_name'], force_refresh=True),
+                                state, context)
+
+
+def update_repository(conf: dict, job_id: str) -> dict:
+    """fan-outする1 repositoryの更新。continuation tokenは使用せず、このinvocationで完了させる"""
+    result = {'repository': conf['github_cd_repository']}
+    try:
+        store = get_state_store()
+        if store is not None:
+            conf['targets'] = pending_targets(store, job_id, conf)
+            if not conf['targets']:
+                return dict(result, status='duplicate')
+        state = run_update(conf, None, None)
+        if store is not None:
+            record_deployments(store, conf, state.get('commits', {}))
+            idempotency.record_completion(store, job_id, conf['github_cd_repository'], conf['targets'],
+                                          state.get('commits', {}))
+        return dict(result, status='updated' if state['updated'] else 'unchanged', commits=state.get('commits', {}))
+    except Exception as e:
+        logger.exception(f'update failed: repository={conf["github_cd_repository"]}')
+        return dict(result, status='failed', error=str(e))
+
+
+def update_repositories(conf: dict, job_id: str) -> list:
+    """conf['repositories']をFANOUT_MAX_WORKERSのthread poolで並列に更新する。
+    失敗したrepositoryがある場合は、全repositoryの完了後にFanOutErrorとする。"""
+    repositories = conf['repositories']
+    # secret, state storeはthread間で共有するため、thread pool開始前に取得する
+    get_secret_measured(conf['github_token_name'])
+    get_state_store()
+
+    def update(repository: dict) -> tuple:
+        # workerのmetricは共有のMetricsに追加せず、repository毎に呼び出し元threadで出力する
+        with collect_metrics() as measurements:
+            return update_repository(dict(conf, **repository), job_id), measurements
+
+    with measure_phase('FanOut', repositories=len(repositories)):
+        with ThreadPoolExecutor(max_workers=min(FANOUT_MAX_WORKERS, len(repositories))) as executor:
+            updates = list(executor.map(in_current_trace(update), repositories))
+
+    results = []
+    for repository, (result, measurements) in zip(repositories, updates):
+        logger.info(f'repository result: {result}')
+        emit_repository_metrics(repository_name(repository['github_cd_repository']),
+                                [target['branch'] for target in repository['targets']], measurements)
+        results.append(result)
+    failed = [result['repository'] for result in results if result['status'] == 'failed']
+    add_count('RepositoryFailed', len(failed))
+    if failed:
+        raise FanOutError(failed)
+    return results
+
+
+def record_deployments(store: StateStore, conf: dict, commits: dict, rolled_back_from: dict = None):
+    # pushしたbranchのmanifest毎に、deployしたtagとcommitをledgerに追加する
+    for target in conf['targets']:
+        if target['branch'] not in commits:
+            continue
+        for manifest in target['manifests']:
+            key = ledger.ledger_key(conf['github_cd_repository'], target['branch'], manifest)
+            try:
+                ledger.record_deployment(store, key, conf['container_image_tag'], commits[target['branch']],
+                                         image_name=conf['container_image_name'],
+                                         rolled_back_from=(rolled_back_from or {}).get(key))
+            except Exception as e:
+                # ledgerはrollback先の決定にのみ使用するため、更新できなくてもjobは成功とする
+                logger.info(f'ledger update failed: {e}')
+
+
+def get_secret_measured(secret_id: str, force_refresh: bool = False) -> str:
+    with measure_phase('SecretFetch', force_refresh=force_refresh):
+        return get_secret(secret_id, force_refresh=force_refresh)
+
+
+def coalesce(conf: dict, job_id: str, state: dict) -> dict:
+    """coalesce windowの間はcoalesce phaseのstateを返して待機する。job_idは最初のjobのid。
+    window経過後は自身のtagが最新のままのtargetのみをstate['targets']として更新を開始する。"""
+    store = get_state_store()
+    repository = conf['github_cd_repository']
+    if state is None:
+        state = coalescing.register(store, repository, conf, job_id, conf['coalesce_window_seconds'] * 1000)
+    if coalescing.is_waiting(state):
+        add_count('CoalesceWait')
+        return state
+
+    # continuationのjob idではなく、register()したjob idと比較する
+    targets = coalescing.owned_targets(store, repository, conf, state['job_id'])
+    if not targets:
+        add_count('Superseded')
+        return {'phase': PHASE_DONE, 'updated': False, 'superseded': True}
+    return {'phase': PHASE_FETCH, 'attempt': 1, 'targets': targets}
+
+
+@metrics.log_metrics
+@tracer.capture_lambda_handler
 def lambda_handler(event, context):
     logger.info(f'event: {event}')
+    job_id = event['CodePipeline.job']['id']
     try:
         conf = extruct_user_parameters(event=event)
-        lambda_local_path = '/tmp/repo/'  # lambda local path
-
-        git = Git(
-            cd_repository=conf['github_cd_repository'],
-            branch=conf['github_branch'],
-            local_repo_path=lambda_local_path,
-            target_manifest=conf['github_cd_manifest'],
-            github_personal_access_token=get_secret(conf['github_token_name'])
-        )
+        if conf['repositories']:
+            # 複数のCD Repositoryを並列に更新し、1つのjob resultとする
+            update_repositories(conf, job_id)
+            logger.info('Success: Updating image tag of manifests in all repositories.')
+            get_code_pipeline_client().put_job_success_result(jobId=job_id)
+            return
 
-        git.clone()
+        add_dimensions(repository=repository_name(conf['github_cd_repository']),
+                       branches=[target['branch'] for target in conf['targets']])
+        continuation_token = event['CodePipeline.job']['data'].get('continuationToken')
+        state = json.loads(continuation_token) if continuation_token else None
+        # continuationは新しいjob idのjobとして実行されるため、最初のjobのidをstateで引き継ぐ
+        origin_job_id = state.get('job_id', job_id) if state is not None else job_id
+        store = get_state_store()
+        if store is not None:
+            # 再配信/retryされたjobは、完了済みのbranchを更新しない
+            conf['targets'] = pending_targets(store, origin_job_id, conf)
+            if not conf['targets']:
+                logger.info('Success: Duplicate job, already completed.')
+                get_code_pipeline_client().put_job_success_result(jobId=job_id)
+                return
+        job_targets = conf['targets']
 
-        manifest = ManifestUpdated(
-            target_manifest=lambda_local_path + conf['github_cd_manifest'],
-            container_image_tag=conf['container_image_tag']
-        )
-        manifest.update_image_tag()
+        if (conf['coalesce_window_seconds'] > 0 and store is not None
+                and (state is None or state['phase'] == coalescing.PHASE_COALESCE)):
+            state = coalesce(conf, origin_job_id, state)
+        if state is not None and 'targets' in state:
+            conf['targets'] = state['targets']  # coalesceで絞り込んだtarget
 
-        git.add()
-        git.commit()
-        git.push()
+        if state is None or state['phase'] not in (coalescing.PHASE_COALESCE, PHASE_DONE):
+            state = run_update(conf, state, context)
+            if state['phase'] != PHASE_DONE and conf['coalesce_window_seconds'] > 0:
+                state['targets'] = conf['targets']
 
-        # Complete notification to AWS CodePipeline Stage
-        logger.info('Success: Updating image tag of manifest.')
-        code_pipeline_client.put_job_success_result(jobId=event['CodePipeline.job']['id'])
+        if state['phase'] != PHASE_DONE:
+            # CodePipelineがcontinuation tokenを付けて新しいjob idで再度invokeする
+            logger.info(f'Continue: next phase={state["phase"]}')
+            state['job_id'] = origin_job_id
+            get_code_pipeline_client().put_job_success_result(jobId=job_id, continuationToken=json.dumps(state))
+            return
 
-        # Cleanup lambda "/tmp/repo/"
-        shutil.rmtree(lambda_local_path)
+        if store is not None:
+            record_deployments(store, conf, state.get('commits', {}))
+            # supersededのtargetもこのjobとしては完了とする
+            idempotency.record_completion(store, origin_job_id, conf['github_cd_repository'], job_targets,
+                                          state.get('commits', {}))
+
+        # Complete notification to AWS CodePipeline Stage
+        if state.get('superseded'):
+            logger.info('Success: Superseded by a newer build.')
+        else:
+            logger.info('Success: Updating image tag of manifest.' if state['updated'] else 'Success: No change.')
+        get_code_pipeline_client().put_job_success_result(jobId=job_id)
 
     except Exception as e:
         logger.info(e)
+        message = 'Error: GitHub Push Failed.'
+        if isinstance(e, FanOutError):
+            message += f' ({", ".join(map(repository_name, e.repositories))})'
         # Failure notification to AWS CodePipeline Stage
-        code_pipeline_client.put_job_failure_result(jobId=event['CodePipeline.job']['id'],
-                                                    failureDetails={
-                                                        'type': 'JobFailed',
-                                                        'message': 'Error: GitHub Push Failed.'
-                                                    })
+        get_code_pipeline_client().put_job_failure_result(jobId=job_id,
+                                                          failureDetails={
+                                                              'type': 'JobFailed',
+                                                              'message': message
+                                                          })
     return
+
+
+def extruct_rollback_parameters(event: dict) -> dict:
+    # CodePipelineを経由せずに直接invokeする: {'github_cd_repository': ..., 'github_branch': 'prd', ...}
+    logger.info(f'extruct_rollback_parameters() - event: {event}')
+    return {
+        'github_cd_repository': event['github_cd_repository'],
+        'github_token_name': event['github_token_name'],
+        'targets': extruct_targets(event),
+        'container_image_tag': event.get('rollback_tag'),  # 省略時はledgerの直前のknown-good tag
+        'container_image_name': event.get('container_image_name'),  # 省略時はledgerの直近のdeployのimage
+        'github_clone_mode': event.get('github_clone_mode', CLONE_MODE_SPARSE),
+        'github_backend': event.get('github_backend', BACKEND_GIT),
+        'github_api_url': event.get('github_api_url', 'https://api.github.com'),
+        'manifest_edit_mode': event.get('manifest_edit_mode', EDIT_MODE_SURGICAL),
+    }
+
+
+def resolve_rollback_tag(store: Optional[StateStore], conf: dict) -> tuple:
+    """rollback先のtagと、ledger key毎のrollback元のtagを返す"""
+    if store is None:
+        if conf['container_image_tag'] is None:
+            raise ValueError('rollback_tag is required without deployment ledger (STATE_TABLE_NAME)')
+        return conf['container_image_tag'], {}
+
+    ledgers = {}
+    for target in conf['targets']:
+        for manifest in target['manifests']:
+            key = ledger.ledger_key(conf['github_cd_repository'], target['branch'], manifest)
+            ledgers[key] = ledger.get_ledger(store, key)
+
+    image_name = conf['container_image_name']
+    if image_name is None:
+        # image名を省略した場合は、pipelineが直近にdeployしたimageをrollbackする
+        images = {ledger.current_image(deployments) for deployments in ledgers.values()} - {None}
+        if len(images) > 1:
+            raise ValueError(f'container_image_name is required for multiple images: {sorted(images)}')
+        image_name = conf['container_image_name'] = images.pop() if images else None
+
+    tag = conf['container_image_tag']
+    if tag is None:
+        # 全target(branch x manifest)で同じtagにrollbackする
+        candidates = {ledger.previous_good_tag(deployments, image_name) for deployments in ledgers.values()}
+        if len(candidates) != 1 or None in candidates:
+            raise ValueError(f'no common known-good tag to roll back to: {sorted(map(str, candidates))}')
+        tag = candidates.pop()
+    rolled_back_from = {key: ledger.current_tag(deployments, image_name) for key, deployments in ledgers.items()
+                        if ledger.current_tag(deployments, image_name) not in (None, tag)}
+    return tag, rolled_back_from
+
+
+@metrics.log_metrics
+@tracer.capture_lambda_handler
+def rollback_handler(event, context):
+    """直前のknown-good tag(またはrollback_tag)をbuildせずに1 commitで再適用する
+
+    aws lambda invoke --function-name GithubManifestRollback \\
+        --payload '{"github_cd_repository": "...", "github_token_name": "...", "github_branch": "prd",
+                    "github_cd_manifest": "deployment.yaml"}' out.json
+    """
+    conf = extruct_rollback_parameters(event)
+    add_dimensions(repository=repository_name(conf['github_cd_repository']),
+                   branches=[target['branch'] for target in conf['targets']])
+    store = get_state_store()
+    with measure_phase('ResolveRollback'):
+        conf['container_image_tag'], rolled_back_from = resolve_rollback_tag(store, conf)
+    logger.info(f'rollback: tag={conf["container_image_tag"]}, from={rolled_back_from}')
+
+    # 1 invocationで完了させる(continuation tokenを使用しない)
+    state = run_update(conf, None, None)
+    if store is not None:
+        # manifestが既にrollback先のtagの場合(commitなし)も、rollback元のtagをledgerに記録する
+        commits = {target['branch']: state.get('commits', {}).get(target['branch']) for target in conf['targets']}
+        record_deployments(store, conf, commits, rolled_back_from=rolled_back_from)
+    add_count('Rollback')
+    return {
+        'tag': conf['container_image_tag'],
+        'updated': state['updated'],
+        'commits': state.get('commits', {}),
+        'rolled_back_from': sorted(set(rolled_back_from.values())),
+    }
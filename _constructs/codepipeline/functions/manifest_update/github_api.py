@@ -0,0 +1,197 @@
+import json
+import base64
+import hashlib
+import urllib.error
+import urllib.parse
+import urllib.request
+from aws_lambda_powertools import Logger
+
+logger = Logger(child=True)
+
+
+class GithubApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f'GitHub API Error: status={status}, message={message}')
+        self.status = status
+
+
+class GithubApi:
+    """GitHub Git Data APIでmanifestを更新するbackend
+
+    clone/add/commit/pushの代わりに、
+      ref取得 -> tree/blob取得 -> blob作成 -> tree作成 -> commit作成 -> ref更新(fast-forward)
+    をREST APIで行う。working treeを作らないため/tmpを使用しない。
+    https://docs.github.com/en/rest/git"""
+
+    def __init__(self,
+                 cd_repository: str,
+                 targets: list,  # [{'branch': 'dev', 'manifests': ['deployment.yaml']}, ...]
+                 github_personal_access_token: str,
+                 api_url: str = 'https://api.github.com'):
+
+        self._cd_repository = cd_repository
+        self._targets = targets
+        self._github_personal_access_token = github_personal_access_token
+        self._api_url = api_url.rstrip('/')
+        self._owner, self._repository = self.owner_and_repository(cd_repository)
+
+        self._heads = {}  # branch -> commit sha
+        self._base_trees = {}  # branch -> headのtree sha
+        self._manifests = {}  # (branch, manifest) -> (blob sha, content)。contentはread_manifestで取得する
+        self._remote_blobs = set()  # GitHub上に存在するblob sha (uploadを省略する)
+        self._staged = {}  # branch -> {manifest: 更新後のcontent}
+        self._blobs = {}  # branch -> {manifest: blob sha}
+        self._commits = {}  # branch -> commit sha
+        # metrics用: API requestとresponseのbody size
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.author = {'name': 'aws-codepipeline-lambda', 'email': 'lambda@example.com'}
+
+    @staticmethod
+    def owner_and_repository(cd_repository: str) -> tuple:
+        # 'https://github.com/rafty/handson-flask_cd.git' -> ('rafty', 'handson-flask_cd')
+        path = urllib.parse.urlparse(cd_repository).path.strip('/')
+        if path.endswith('.git'):
+            path = path[:-len('.git')]
+        owner, repository = path.split('/')[-2:]
+        return owner, repository
+
+    def clone(self):
+        # cloneの代わりにbranch headとtarget manifestのblobのみ取得する
+        for target in self._targets:
+            branch = target['branch']
+            logger.info('GitHub Data API clone(): '
+                        f'repository={self._owner}/{self._repository}'
+                        f'branch={branch}'
+                        f'manifests={target["manifests"]}')
+            ref = self._request('GET', f'git/ref/heads/{branch}')
+            self._heads[branch] = ref['object']['sha']
+            commit = self._request('GET', f'git/commits/{self._heads[branch]}')
+            self._base_trees[branch] = commit['tree']['sha']
+
+            for manifest in target['manifests']:
+                tree_sha = self._base_trees[branch]
+                *directories, filename = manifest.split('/')
+                for name in directories:
+                    tree_sha = self._tree_entry(tree_sha, name)['sha']
+                blob_sha = self._tree_entry(tree_sha, filename)['sha']
+                self._manifests[(branch, manifest)] = (blob_sha, None)
+                self._remote_blobs.add(blob_sha)
+
+    def manifest_blob_id(self, branch: str, manifest: str) -> str:
+        return self._manifests[(branch, manifest)][0]
+
+    def read_manifest(self, branch: str, manifest: str) -> str:
+        staged = self._staged.get(branch, {})
+        if manifest in staged:
+            return staged[manifest].decode('utf-8')
+        blob_sha, content = self._manifests[(branch, manifest)]
+        if content is None:
+            # change recordを適用する場合はblobを取得しないため、readした時点で取得する
+            blob = self._request('GET', f'git/blobs/{blob_sha}')
+            content = base64.b64decode(blob['content'])
+            self._manifests[(branch, manifest)] = (blob_sha, content)
+        return content.decode('utf-8')
+
+    def write_manifest_blob(self, branch: str, manifest: str, blob_sha: str):
+        """GitHub上に存在するblob(別のbranchにpush済み等)をcontentを取得せずにstageする"""
+        self._staged.get(branch, {}).pop(manifest, None)
+        self._blobs.setdefault(branch, {})[manifest] = blob_sha
+
+    def write_manifest(self, branch: str, manifest: str, content: str):
+        # branch headのblobと同じhashであれば変更なしとしてstageしない
+        data = content.encode('utf-8')
+        staged = self._staged.setdefault(branch, {})
+        if self.blob_sha(data) == self._manifests[(branch, manifest)][0]:
+            staged.pop(manifest, None)
+            logger.info(f'GitHub Data API write_manifest(): unchanged, branch={branch}, manifest={manifest}')
+            return
+        staged[manifest] = data
+
+    def has_changes(self) -> bool:
+        return any(self._staged.values()) or any(self._blobs.values())
+
+    @staticmethod
+    def blob_sha(data: bytes) -> str:
+        # git hash-object
+        return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+    def add(self):
+        for branch, staged in self._staged.items():
+            for manifest, content in staged.items():
+                blob_sha = self.blob_sha(content)
+                if blob_sha in self._remote_blobs:
+                    logger.info(f'GitHub Data API add(): reuse blob, branch={branch}, manifest={manifest}')
+                else:
+                    logger.info(f'GitHub Data API add(): branch={branch}, manifest={manifest}')
+                    blob_sha = self._request('POST', 'git/blobs', {
+                        'content': base64.b64encode(content).decode('ascii'),
+                        'encoding': 'base64'})['sha']
+                    self._remote_blobs.add(blob_sha)
+                self._blobs.setdefault(branch, {})[manifest] = blob_sha
+
+    def commit(self):
+        # branch毎に1つのtreeとcommitを作成する
+        for branch, blobs in self._blobs.items():
+            logger.info(f'GitHub Data API commit(): branch={branch}, parent={self._heads[branch]}')
+            tree = self._request('POST', 'git/trees', {
+                'base_tree': self._base_trees[branch],
+                'tree': [{'path': manifest, 'mode': '100644', 'type': 'blob', 'sha': blob_sha}
+                         for manifest, blob_sha in blobs.items()]})
+            commit = self._request('POST', 'git/commits', {
+                'message': 'Update Image Tag',
+                'tree': tree['sha'],
+                'parents': [self._heads[branch]],
+                'author': self.author})
+            self._commits[branch] = commit['sha']
+
+    def push(self):
+        # force=Falseのためfast-forwardできない場合は422となる
+        # Git Data APIは複数refの一括更新がないため、branch毎にrefを更新する
+        for branch, commit_sha in self._commits.items():
+            logger.info(f'GitHub Data API push(): branch={branch}, sha={commit_sha}')
+            self._request('PATCH', f'git/refs/heads/{branch}', {'sha': commit_sha, 'force': False})
+            self._heads[branch] = commit_sha
+
+    def checkpoint(self) -> dict:
+        # continuation tokenに保存する、push前のheadと作成したcommit (commitはGitHub上に保存済み)
+        return {'heads': {branch: self._heads[branch] for branch in self._commits},
+                'commits': dict(self._commits)}
+
+    def resume(self, heads: dict, commits: dict):
+        self._heads = dict(heads)
+        self._commits = dict(commits)
+
+    def refresh(self):
+        """stageした変更を破棄し、remoteの最新headとmanifestを取得し直す"""
+        self._staged, self._blobs, self._commits = {}, {}, {}
+        self.clone()
+
+    def _tree_entry(self, tree_sha: str, name: str) -> dict:
+        tree = self._request('GET', f'git/trees/{tree_sha}')
+        for entry in tree['tree']:
+            if entry['path'] == name:
+                return entry
+        raise GithubApiError(404, f'{name} not found in tree {tree_sha}')
+
+    def _request(self, method: str, path: str, body: dict = None) -> dict:
+        url = f'{self._api_url}/repos/{self._owner}/{self._repository}/{path}'
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        self.bytes_sent += len(data or b'')
+        request = urllib.request.Request(
+            url,
+            method=method,
+            data=data,
+            headers={
+                'Accept': 'application/vnd.github+json',
+                'Authorization': f'token {self._github_personal_access_token}',
+                'Content-Type': 'application/json',
+                'User-Agent': 'aws-codepipeline-lambda',
+            })
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                content = response.read()
+                self.bytes_received += len(content)
+                return json.loads(content.decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            raise GithubApiError(e.code, e.read().decode('utf-8', errors='replace')) from e
@@ -0,0 +1,35 @@
+"""CodePipeline job id, repository, branch毎にtag updateの完了を記録し、再配信されたjobを重複して実行しない
+
+branch毎にpushしたcommit(変更がない場合はNone)を保存する。
+continuationは新しいjob idで実行されるため、keyには最初のjobのidを使用する。
+一部のbranchのみ完了している場合は、残りのbranchのみ更新する。
+"""
+import time
+from store import StateStore
+
+KEY_PREFIX = 'job'
+ITEM_TTL_SECONDS = 7 * 24 * 3600
+
+
+def job_key(job_id: str, repository: str, branch: str) -> str:
+    return f'{KEY_PREFIX}#{job_id}#{repository}#{branch}'
+
+
+def completed(store: StateStore, job_id: str, repository: str, targets: list) -> dict:
+    """完了済みのbranchの {branch: record} を返す"""
+    records = {}
+    for target in targets:
+        record = store.get(job_key(job_id, repository, target['branch']))
+        if record is not None:
+            records[target['branch']] = record
+    return records
+
+
+def record_completion(store: StateStore, job_id: str, repository: str, targets: list, commits: dict):
+    # commits: {branch: commit sha} (pushしたbranchのみ)
+    for target in targets:
+        store.put(job_key(job_id, repository, target['branch']), {
+            'commit': commits.get(target['branch']),
+            'manifests': target['manifests'],
+            'expires_at': int(time.time()) + ITEM_TTL_SECONDS,
+        })
@@ -0,0 +1,251 @@
+import json
+import collections
+import yaml
+
+# PyYAMLはinvoke毎にmanifestの解析で使用するため、init phaseでimportする
+# libyamlが利用可能な場合はC実装を使用する
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+Dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+CONTAINER_KEYS = ('containers', 'initContainers', 'ephemeralContainers')
+KUSTOMIZATION_FILES = ('kustomization.yaml', 'kustomization.yml', 'Kustomization')
+
+# document: multi-document manifest内の位置(0始まり), path: document内のkeyのtuple
+# span: manifest文字列内のscalarの位置 (start, end, style)
+ImageLocation = collections.namedtuple('ImageLocation', ['document', 'path', 'image', 'span'])
+# span=Noneの場合はinsert_atの位置にkeyごと追加する(kustomizationのnewTagがない場合)
+ImageUpdate = collections.namedtuple('ImageUpdate', ['document', 'path', 'value', 'span', 'insert_at'])
+
+
+class ImageReference:
+    """container image referenceを registry / repository / tag / digest に分解する
+
+    'registry:5000/team/flask:v1' のようにregistryにportがある場合も
+    tagは最後のpath要素の':'以降として扱う。"""
+
+    def __init__(self, image: str):
+        name, _, self.digest = image.partition('@')
+        head, slash, last = name.rpartition('/')
+        last, colon, self.tag = last.partition(':')
+        name = head + slash + last
+        first, _, rest = name.partition('/')
+        if rest and ('.' in first or ':' in first or first == 'localhost'):
+            self.registry, self.repository = first, rest
+        else:
+            self.registry, self.repository = '', name
+
+    @property
+    def name(self) -> str:
+        return f'{self.registry}/{self.repository}' if self.registry else self.repository
+
+    def matches(self, repository: str) -> bool:
+        # repository名('flask')またはregistry付きの名前で一致を判定する
+        return repository in (self.repository, self.name)
+
+    def with_tag(self, tag: str) -> str:
+        # tagを変更するとdigestと一致しなくなるため、digestは外す
+        return f'{self.name}:{tag}'
+
+
+class ImageIndex:
+    """manifest内のimageの位置を1回のevent streamの走査で索引化する
+
+    - Pod/Deployment/StatefulSet/DaemonSet/Job/CronJob(jobTemplate)の
+      containers, initContainers, ephemeralContainersのimage
+    - kustomization.yamlのimages:
+    複数imageを更新する場合も、manifestの走査はindex作成時の1回のみ。"""
+
+    def __init__(self, content: str, filename: str = ''):
+        self.containers = []  # [ImageLocation]
+        self.kustomize_images = []  # [(document, index, {'name': (value, span), 'newTag': (value, span), ...})]
+        self.documents = 0
+        self._build(content, filename.rsplit('/', 1)[-1] in KUSTOMIZATION_FILES)
+
+    def _build(self, content: str, is_kustomization_file: bool):
+        document = -1
+        kinds = {}
+        kustomize_entries = {}
+        for event, path, value in walk_scalars(content):
+            if isinstance(event, yaml.DocumentStartEvent):
+                document += 1
+                continue
+            if path == ('kind',):
+                kinds[document] = value
+            elif is_container_image(path):
+                self.containers.append(ImageLocation(document, path, value, scalar_span(event)))
+            elif len(path) == 3 and path[0] == 'images' and isinstance(path[1], int):
+                kustomize_entries.setdefault((document, path[1]), {})[path[2]] = (value, scalar_span(event))
+        self.documents = document + 1
+
+        for (document, index), entry in sorted(kustomize_entries.items()):
+            if is_kustomization_file or kinds.get(document) == 'Kustomization':
+                self.kustomize_images.append((document, index, entry))
+
+    def updates_for(self, new_tags: dict) -> list:
+        """{repository: tag}から、変更が必要なImageUpdateの一覧を返す"""
+        updates = []
+        for location in self.containers:
+            reference = ImageReference(location.image)
+            for repository, tag in new_tags.items():
+                if reference.matches(repository):
+                    updates.append(ImageUpdate(
+                        location.document, location.path, reference.with_tag(tag), location.span, None))
+                    break
+
+        for document, index, entry in self.kustomize_images:
+            names = [ImageReference(entry[key][0]) for key in ('name', 'newName') if key in entry]
+            for repository, tag in new_tags.items():
+                if any(name.matches(repository) for name in names):
+                    path = ('images', index, 'newTag')
+                    if 'newTag' in entry:
+                        updates.append(ImageUpdate(document, path, tag, entry['newTag'][1], None))
+                    else:
+                        last_end = max(span[1] for _, span in entry.values())
+                        updates.append(ImageUpdate(document, path, tag, None, last_end))
+                    break
+        return updates
+
+    def image_changes(self, new_tags: dict) -> list:
+        """container imageの [(変更前のimage, 変更後のimage)] を返す(変更がないimageは含まない)"""
+        changes = []
+        for location in self.containers:
+            reference = ImageReference(location.image)
+            for repository, tag in new_tags.items():
+                if reference.matches(repository):
+                    if reference.with_tag(tag) != location.image:
+                        changes.append((location.image, reference.with_tag(tag)))
+                    break
+        return changes
+
+
+def scalar_span(event) -> tuple:
+    return event.start_mark.index, event.end_mark.index, event.style or None
+
+
+def is_container_image(path: tuple) -> bool:
+    # (..., 'containers', 0, 'image')
+    return (len(path) >= 3 and path[-1] == 'image'
+            and isinstance(path[-2], int) and path[-3] in CONTAINER_KEYS)
+
+
+def walk_scalars(content: str):
+    """yaml event streamを走査し、(event, path, value)をyieldする
+
+    DocumentStartEventはpath=()でyieldする。scalarはmappingのvalue, sequenceの要素のみ。
+    nodeのtreeを作らないため、大きなmanifestでもmemoryを消費しない。"""
+    stack = []  # [[path, is_mapping, current_key, next_index, expecting_key]]
+    for event in yaml.parse(content, Loader=Loader):
+        if isinstance(event, yaml.DocumentStartEvent):
+            yield event, (), None
+            continue
+        if isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            stack.pop()
+            continue
+        if not isinstance(event, (yaml.ScalarEvent, yaml.MappingStartEvent,
+                                  yaml.SequenceStartEvent, yaml.AliasEvent)):
+            continue
+
+        if stack and stack[-1][1] and stack[-1][4]:
+            # mapping key (complex keyの場合はkey=Noneとし、中身は索引化しない)
+            stack[-1][2] = event.value if isinstance(event, yaml.ScalarEvent) else None
+            stack[-1][4] = False
+            if isinstance(event, yaml.MappingStartEvent):
+                stack.append([(None,), True, None, 0, True])
+            elif isinstance(event, yaml.SequenceStartEvent):
+                stack.append([(None,), False, None, 0, False])
+            continue
+
+        if stack:
+            frame = stack[-1]
+            if frame[1]:
+                path = frame[0] + (frame[2],)
+                frame[4] = True
+            else:
+                path = frame[0] + (frame[3],)
+                frame[3] += 1
+        else:
+            path = ()
+
+        if isinstance(event, yaml.MappingStartEvent):
+            stack.append([path, True, None, 0, True])
+        elif isinstance(event, yaml.SequenceStartEvent):
+            stack.append([path, False, None, 0, False])
+        elif isinstance(event, yaml.ScalarEvent):
+            yield event, path, event.value
+
+
+def update_images(content: str,
+                  new_tags: dict,
+                  filename: str = '',
+                  index: ImageIndex = None,
+                  preserve_format: bool = True) -> str:
+    """manifest(multi-document可)の該当imageのtagのみを更新する
+
+    preserve_format=Trueの場合、image scalarの範囲のみを書き換え、
+    それ以外(comment, indent, keyの順番, quote)は元のまま残す。
+    書き換えられない形式(block scalar, flow styleへのkey追加)の場合はload/dumpする。"""
+    index = index or ImageIndex(content, filename)
+    updates = index.updates_for(new_tags)
+    if not updates:
+        return content
+
+    if preserve_format:
+        edited = edit_in_place(content, updates)
+        if edited is not None:
+            return edited
+
+    documents = list(yaml.load_all(content, Loader=Loader))
+    for update in updates:
+        node = documents[update.document]
+        for key in update.path[:-1]:
+            node = node[key]
+        node[update.path[-1]] = update.value
+    return yaml.dump_all(documents, Dumper=Dumper, sort_keys=False)  # Keyの順番を維持する
+
+
+def edit_in_place(content: str, updates: list):
+    """updatesのscalarの範囲のみを置換した文字列を返す。置換できない場合はNone"""
+    edits = []  # (start, end, text)
+    for update in updates:
+        if update.span is not None:
+            start, end, style = update.span
+            text = format_scalar(update.value, style)
+            if text is None:
+                return None
+            edits.append((start, end, text))
+            continue
+
+        # kustomizationのimages:にnewTagを追加する。entryの最終行の次の行に同じindentで追加
+        line_start = content.rfind('\n', 0, update.insert_at) + 1
+        line_end = content.find('\n', update.insert_at)
+        line_end = len(content) if line_end < 0 else line_end
+        line = content[line_start:update.insert_at]
+        if '{' in line or '[' in line:
+            return None  # flow style
+        key_column = len(line) - len(line.lstrip(' -'))
+        edits.append((line_end, line_end,
+                      '\n' + ' ' * key_column + f'{update.path[-1]}: {format_scalar(update.value, None)}'))
+
+    # 変更箇所以外はそのままcopyする(大きなmanifestで文字列の再作成を繰り返さない)
+    pieces = []
+    position = 0
+    for start, end, text in sorted(edits):
+        pieces.append(content[position:start])
+        pieces.append(text)
+        position = end
+    pieces.append(content[position:])
+    return ''.join(pieces)
+
+
+def format_scalar(value: str, style):
+    if style == '"':
+        return json.dumps(value)
+    if style == "'":
+        return "'" + value.replace("'", "''") + "'"
+    if style is None:
+        # plainでstring以外(数値等)と解釈される場合はquoteする
+        plain_safe = value and value.strip() == value and not value.startswith(('#', '&', '*', '!', '{', '[', '"', "'"))
+        if plain_safe and ': ' not in value and ' #' not in value and yaml.safe_load(value) == value:
+            return value
+        return json.dumps(value)
+    return None  # block scalar ('|', '>')
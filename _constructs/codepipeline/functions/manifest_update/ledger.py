@@ -0,0 +1,71 @@
+"""branch毎のdeployment ledger (deployしたtag, commit, 時刻) とrollback先tagの決定
+
+(repository, branch, manifest)毎に1 itemとし、直近MAX_ENTRIES件のdeployを保持する。
+entryにはdeployしたimage名を保存し、image名を指定した場合はそのimageのentryのみを対象とする。
+rollbackした場合、rollback元のtagはbad_tagsに追加し、以降のrollback先としない。
+"""
+import time
+from typing import Optional
+from store import StateStore
+
+KEY_PREFIX = 'ledger'
+MAX_ENTRIES = 20
+PUT_MAX_ATTEMPTS = 3  # 同時に更新された場合(versionの競合)のretry回数
+
+
+class LedgerError(Exception):
+    pass
+
+
+def ledger_key(repository: str, branch: str, manifest: str) -> str:
+    return f'{KEY_PREFIX}#{repository}#{branch}#{manifest}'
+
+
+def get_ledger(store: StateStore, key: str) -> dict:
+    return store.get(key) or {'entries': [], 'bad_tags': [], 'version': 0}
+
+
+def record_deployment(store: StateStore, key: str, tag: str, commit: Optional[str], image_name: str = None,
+                      rolled_back_from: str = None):
+    # read-modify-writeのため、versionが変わっていない場合のみputする(optimistic lock)
+    for _ in range(PUT_MAX_ATTEMPTS):
+        ledger = get_ledger(store, key)
+        entry = {'tag': tag, 'commit': commit, 'deployed_at': int(time.time() * 1000)}
+        if image_name is not None:
+            entry['image'] = image_name
+        if rolled_back_from is not None:
+            entry['rolled_back_from'] = rolled_back_from
+        bad_tags = [t for t in ledger['bad_tags'] if t != tag]
+        if rolled_back_from is not None and rolled_back_from not in bad_tags:
+            bad_tags.append(rolled_back_from)
+        if store.put_if_newer(key, {
+            'entries': (ledger['entries'] + [entry])[-MAX_ENTRIES:],
+            'bad_tags': bad_tags[-MAX_ENTRIES:],
+            'version': ledger['version'] + 1,
+        }, order_key='version'):
+            return
+    raise LedgerError(f'ledger update conflicted {PUT_MAX_ATTEMPTS} times: {key}')
+
+
+def entries_for(ledger: dict, image_name: Optional[str]) -> list:
+    if image_name is None:
+        return ledger['entries']
+    return [entry for entry in ledger['entries'] if entry.get('image') == image_name]
+
+
+def current_image(ledger: dict) -> Optional[str]:
+    return ledger['entries'][-1].get('image') if ledger['entries'] else None
+
+
+def current_tag(ledger: dict, image_name: Optional[str] = None) -> Optional[str]:
+    entries = entries_for(ledger, image_name)
+    return entries[-1]['tag'] if entries else None
+
+
+def previous_good_tag(ledger: dict, image_name: Optional[str] = None) -> Optional[str]:
+    """現在のtag以前にdeployした、rollback元となっていない直近のtag"""
+    current = current_tag(ledger, image_name)
+    for entry in reversed(entries_for(ledger, image_name)):
+        if entry['tag'] != current and entry['tag'] not in ledger['bad_tags']:
+            return entry['tag']
+    return None
@@ -0,0 +1,47 @@
+from dulwich import object_store
+from dulwich.object_store import MemoryObjectStore
+from dulwich.repo import MemoryRepo
+
+
+class MemoryLimitExceeded(Exception):
+    pass
+
+
+class BoundedMemoryObjectStore(MemoryObjectStore):
+    """object sizeの合計がmax_bytesを超えた場合にMemoryLimitExceededとするMemoryObjectStore
+
+    fetch中に受信したpackのsize(圧縮後)と、展開して追加したobjectのsize(非圧縮)の両方を確認する。
+    packのsizeで確認することで、大きなrepositoryの場合は受信が終わる前に中断できる。
+    MemoryObjectStore.add_pack()はPACK_SPOOL_FILE_MAX_SIZE(16MB)を超えたpackを一時fileに書き出すため、
+    packのsizeはmax_bytesとPACK_SPOOL_FILE_MAX_SIZEの小さい方までとする(/tmpを使用しない)。"""
+
+    def __init__(self, max_bytes: int):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.size = 0
+
+    def add_pack(self):
+        f, commit, abort = super().add_pack()
+        write = f.write
+        max_pack_bytes = min(self.max_bytes, object_store.PACK_SPOOL_FILE_MAX_SIZE)
+
+        def bounded_write(data):
+            if f.tell() + len(data) > max_pack_bytes:
+                raise MemoryLimitExceeded(f'incoming pack exceeds {max_pack_bytes} bytes')
+            return write(data)
+
+        f.write = bounded_write
+        return f, commit, abort
+
+    def add_object(self, obj):
+        super().add_object(obj)
+        self.size += len(obj.as_raw_string())
+        if self.size > self.max_bytes:
+            raise MemoryLimitExceeded(f'object store exceeds {self.max_bytes} bytes')
+
+
+def bounded_memory_repo(max_bytes: int) -> MemoryRepo:
+    """working tree, /tmpを使用しないrepository"""
+    repo = MemoryRepo()
+    repo.object_store = BoundedMemoryObjectStore(max_bytes)
+    return repo
@@ -0,0 +1,51 @@
+"""dev stageで計算したmanifestの変更をprd stage(promotion)で再利用する
+
+manifest毎に 変更前/変更後のblob hash, image をchange recordとして、pushが成功した後に保存する(contentは保存しない)。
+同じtagを適用する別のinvocationでは、branch headのmanifestが変更前のblobと同じであれば
+parse/editせずに変更を適用する。
+  - GitHub API backend: devでpush済みの変更後のblobをそのまま使用する(blobの取得とuploadを省略する)
+  - git backend: imageの文字列を置換し、変更後のblob hashと一致した場合のみ使用する
+"""
+import time
+from typing import Optional
+from github_api import GithubApi
+from store import StateStore
+
+KEY_PREFIX = 'change'
+# manual approvalの期限(7日)まで保持する
+ITEM_TTL_SECONDS = 8 * 24 * 3600
+
+
+def change_key(repository: str, manifest: str, image_name: Optional[str], image_tag: str, edit_mode: str) -> str:
+    return f'{KEY_PREFIX}#{repository}#{manifest}#{image_name or "*"}#{image_tag}#{edit_mode}'
+
+
+def new_change(content: str, updated_content: str, images: list) -> dict:
+    # itemのsizeはmanifestのsizeによらない
+    return {
+        'old_blob': GithubApi.blob_sha(content.encode('utf-8')),
+        'new_blob': GithubApi.blob_sha(updated_content.encode('utf-8')),
+        'images': [list(change) for change in images],  # [[変更前のimage, 変更後のimage], ...]
+    }
+
+
+def record_change(store: StateStore, key: str, change: dict):
+    """pushが成功した後に保存する(GitHub API backendは変更後のblobがGitHub上に存在する前提で使用する)"""
+    store.put(key, dict(change, expires_at=int(time.time()) + ITEM_TTL_SECONDS))
+
+
+def find_change(store: StateStore, key: str, blob_id: str) -> Optional[dict]:
+    """変更前のblobがblob_idと同じchange recordを返す"""
+    change = store.get(key)
+    if change is None or change['old_blob'] != blob_id:
+        return None
+    return change
+
+
+def reapply(content: str, change: dict) -> Optional[str]:
+    """変更前のcontentのimageを置換し、変更後のblobと一致した場合のみ返す(一致しない場合None)"""
+    for old_image, new_image in change['images']:
+        content = content.replace(old_image, new_image)
+    if GithubApi.blob_sha(content.encode('utf-8')) != change['new_blob']:
+        return None
+    return content
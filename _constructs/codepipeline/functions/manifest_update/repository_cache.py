@@ -0,0 +1,135 @@
+import os
+import shutil
+import hashlib
+import threading
+import collections
+from aws_lambda_powertools import Logger
+from dulwich.repo import Repo
+
+logger = Logger(child=True)
+
+# fan-outのworker threadが使用中のentry (path -> 使用中のthread数)。evict()は使用中のentryを削除しない
+_lock = threading.Lock()
+_in_use = collections.Counter()
+
+
+class RepositoryCache:
+    """Warm containerで再利用するCD Repositoryのlocal cache
+
+    Lambdaの/tmpはcontainerが再利用される間は保持されるため、
+    cloneしたRepositoryを残しておき、次回はincremental fetchのみ行う。
+    cacheのkeyはrepository URL, branch(複数の場合はその組), clone modeとする。
+    entryのsizeは書き込み時に'<entry>.size'に保存し、cache_dir全体がtotal_max_bytesを超えた場合は
+    最後に使用した(sizeを保存した)時刻が古いentryから削除する。
+    Lambdaのcontainerは同時に1 invocationのみ実行するため、このprocessで使用中でないentryは
+    以前のinvocationが残したものとして削除できる。"""
+
+    SIZE_SUFFIX = '.size'
+
+    def __init__(self, cache_dir: str, max_bytes: int, total_max_bytes: int = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total_max_bytes = total_max_bytes if total_max_bytes is not None else max_bytes
+
+    def path_for(self, cd_repository: str, branches: list, clone_mode: str) -> str:
+        key_source = '\0'.join([cd_repository, ','.join(sorted(branches)), clone_mode])
+        key = hashlib.sha256(key_source.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, key) + '/'  # Git.local_repo_pathは末尾'/'
+
+    def is_usable(self, local_repo_path: str, branches: list) -> bool:
+        # cacheが存在し、破損しておらず、size上限以内であればfetchで再利用する
+        if not os.path.isdir(os.path.join(local_repo_path, '.git')):
+            return False
+        size = self.stored_size(local_repo_path)
+        if size is None or size > self.max_bytes:
+            logger.info(f'RepositoryCache over size limit: path={local_repo_path}, size={size}')
+            return False
+        try:
+            repo = Repo(local_repo_path)
+            for branch in branches:
+                repo[repo.refs[b'refs/heads/' + branch.encode('utf-8')]]  # branch headのcommitが読めること
+        except Exception as e:
+            logger.info(f'RepositoryCache corrupted: path={local_repo_path}, error={e}')
+            return False
+        return True
+
+    def record(self, local_repo_path: str, added_bytes: int):
+        """entryのsizeを更新し(最終使用時刻となる)、cache_dir全体の上限を超えた分を古いentryから削除する
+
+        sizeが未保存(cloneした直後)の場合のみentryを走査する。以降はclone/fetch, commitで増えたbyte数を加算する。"""
+        size = self.stored_size(local_repo_path)
+        size = self.size_of(local_repo_path) if size is None else size + added_bytes
+        with open(self._size_path(local_repo_path), 'w') as f:
+            f.write(str(size))
+        self.evict(keep=local_repo_path)
+
+    def evict(self, keep: str = None):
+        with _lock:
+            entries = []  # (最終使用時刻, path, size)
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if not os.path.isdir(path):
+                    continue
+                size = self.stored_size(path)
+                if size is None:
+                    # clone中(他のthread)のentryは削除しない。使用中でなければ以前のinvocationが中断したentry
+                    if path not in _in_use:
+                        self.invalidate(path)
+                    continue
+                entries.append((os.path.getmtime(self._size_path(path)), path, size))
+
+            total = sum(size for _, _, size in entries)
+            keep = keep.rstrip('/') if keep is not None else None
+            for _, path, size in sorted(entries):
+                if total <= self.total_max_bytes:
+                    break
+                if path == keep or path in _in_use:
+                    continue
+                logger.info(f'RepositoryCache evict(): path={path}, size={size}, total={total}')
+                self.invalidate(path)
+                total -= size
+
+    @staticmethod
+    def acquire(local_repo_path: str):
+        """entryを使用中とする。release()するまでevict()の対象としない"""
+        with _lock:
+            _in_use[local_repo_path.rstrip('/')] += 1
+
+    @staticmethod
+    def release(local_repo_path: str):
+        with _lock:
+            path = local_repo_path.rstrip('/')
+            _in_use[path] -= 1
+            if _in_use[path] <= 0:
+                del _in_use[path]
+
+    @classmethod
+    def stored_size(cls, local_repo_path: str):
+        try:
+            with open(cls._size_path(local_repo_path)) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def _size_path(cls, local_repo_path: str) -> str:
+        return local_repo_path.rstrip('/') + cls.SIZE_SUFFIX
+
+    @classmethod
+    def invalidate(cls, local_repo_path: str):
+        if os.path.exists(local_repo_path):
+            logger.info(f'RepositoryCache invalidate(): path={local_repo_path}')
+            shutil.rmtree(local_repo_path, ignore_errors=True)
+        if os.path.exists(cls._size_path(local_repo_path)):
+            os.remove(cls._size_path(local_repo_path))
+
+    @staticmethod
+    def size_of(path: str) -> int:
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
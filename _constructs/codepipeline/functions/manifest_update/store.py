@@ -0,0 +1,57 @@
+import threading
+from decimal import Decimal
+from typing import Optional
+
+
+class StateStore:
+    """tag updateの状態を保持するDynamoDB table (partition key: pk)
+
+    pkは機能毎のprefixで分ける (例: 'coalesce#<repository>#<branch>#<manifest>')。
+    expires_at(epoch秒)を指定したitemはDynamoDBのTTLで削除される。
+    boto3(import含む)とtableは初回利用時に作成する。
+    boto3のresourceはthread safeではないため、fan-outのthread毎に作成する。
+    """
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+        self._local = threading.local()
+
+    @property
+    def table(self):
+        if getattr(self._local, 'table', None) is None:
+            import boto3
+            self._local.table = boto3.session.Session().resource('dynamodb').Table(self.table_name)
+        return self._local.table
+
+    def get(self, pk: str) -> Optional[dict]:
+        item = self.table.get_item(Key={'pk': pk}, ConsistentRead=True).get('Item')
+        return _to_python(item) if item else None
+
+    def put(self, pk: str, item: dict):
+        self.table.put_item(Item=dict(item, pk=pk))
+
+    def put_if_newer(self, pk: str, item: dict, order_key: str) -> bool:
+        """itemがない、またはitem[order_key]が既存のitemより大きい場合のみputする"""
+        from botocore.exceptions import ClientError
+        try:
+            self.table.put_item(
+                Item=dict(item, pk=pk),
+                ConditionExpression='attribute_not_exists(pk) OR #order < :order',
+                ExpressionAttributeNames={'#order': order_key},
+                ExpressionAttributeValues={':order': item[order_key]})
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+
+def _to_python(value):
+    # boto3 resourceは数値をDecimalで返す(list, mapの中も含む)
+    if isinstance(value, Decimal):
+        return int(value) if value % 1 == 0 else float(value)
+    if isinstance(value, dict):
+        return {key: _to_python(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_to_python(item) for item in value]
+    return value
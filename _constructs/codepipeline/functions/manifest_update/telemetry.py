@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import contextlib
+import threading
+from aws_lambda_powertools import Metrics, Tracer
+from aws_lambda_powertools.metrics import MetricUnit
+
+
+def metrics_namespace() -> str:
+    return os.environ.get('POWERTOOLS_METRICS_NAMESPACE', 'GitOpsPipeline')
+
+
+# serviceはPOWERTOOLS_SERVICE_NAME、namespaceはPOWERTOOLS_METRICS_NAMESPACEで指定する
+# metricsはCloudWatch EMFとしてlogに出力される
+# Tracer()はaws_xray_sdk.coreのimport(botocoreのclient作成を含む)とpatchを行うため、
+# 初回invokeではなくinit phaseで作成する
+metrics = Metrics(namespace=metrics_namespace())
+tracer = Tracer()
+# fan-outのworker threadで記録したmetric (collect_metrics)
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def measure_phase(phase: str, **metadata):
+    """phaseの処理時間を '<phase>Time' metric(ms)とX-Ray subsegment '## <phase>' として記録する"""
+    with tracer.provider.in_subsegment(f'## {phase}') as subsegment:
+        for key, value in metadata.items():
+            subsegment.put_metadata(key, value)
+        start = time.perf_counter()
+        try:
+            yield subsegment
+        finally:
+            add_metric(f'{phase}Time', MetricUnit.Milliseconds, (time.perf_counter() - start) * 1000)
+
+
+def in_current_trace(function):
+    """thread poolで実行するfunctionに、呼び出し元threadのX-Ray trace entityを引き継ぐ"""
+    entity = tracer.provider.get_trace_entity()
+
+    def wrapper(*args, **kwargs):
+        tracer.provider.set_trace_entity(entity)
+        return function(*args, **kwargs)
+    return wrapper
+
+
+def add_metric(name: str, unit: MetricUnit, value: float):
+    collected = getattr(_local, 'collected', None)
+    if collected is not None:
+        collected.append((name, unit, value))
+    else:
+        metrics.add_metric(name=name, unit=unit, value=value)
+
+
+def add_bytes(name: str, value: int):
+    add_metric(name, MetricUnit.Bytes, value)
+
+
+def add_count(name: str, value: int = 1):
+    add_metric(name, MetricUnit.Count, value)
+
+
+@contextlib.contextmanager
+def collect_metrics():
+    """このthreadで記録したmetricを共有のMetricsに追加せず、(name, unit, value)のlistに集める
+
+    fan-outのworker threadは共有のMetricsのdimensionを使用できないため、
+    集めたmetricは呼び出し元threadでemit_repository_metricsにより出力する。
+    """
+    _local.collected = collected = []
+    try:
+        yield collected
+    finally:
+        _local.collected = None
+
+
+def emit_repository_metrics(repository: str, branches: list, measurements: list):
+    """1 repositoryのmetricを、そのrepository, branchをdimensionとするEMFとして出力する"""
+    # Powertools v1のMetricsはinstance間でmetric, dimensionを共有するため、
+    # instance毎にmetric, dimensionを持つMetricManagerを使用する
+    from aws_lambda_powertools.metrics.base import MetricManager
+    metrics = MetricManager(namespace=metrics_namespace())
+    metrics.add_dimension(name='repository', value=repository)
+    metrics.add_dimension(name='branch', value=','.join(branches))
+    for name, unit, value in measurements:
+        metrics.add_metric(name=name, unit=unit, value=value)
+    if metrics.metric_set:
+        print(json.dumps(metrics.serialize_metric_set(), separators=(',', ':')))
+
+
+def add_dimensions(repository: str, branches: list):
+    # 1 repositoryのbatch更新の場合、branchは','で連結した値とする
+    metrics.add_dimension(name='repository', value=repository)
+    metrics.add_dimension(name='branch', value=','.join(branches))
+    tracer.put_annotation(key='repository', value=repository)
+    tracer.put_annotation(key='branch', value=','.join(branches))
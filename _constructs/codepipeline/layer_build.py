@@ -0,0 +1,185 @@
+import os
+import re
+import sys
+import shutil
+import hashlib
+import sysconfig
+import tempfile
+import warnings
+import subprocess
+from typing import Optional
+
+# Lambda runtimeでimportしないfile/directory (layerのsizeと展開時間を削減する)
+TRIM_DIRECTORIES = ('tests', 'test', '__pycache__')
+TRIM_SUFFIXES = ('.pyi', '.pyx', '.pxd', '.c', '.h')
+# manifest_update functionが使用しないpackage (python/からの相対path)
+UNUSED_PACKAGES = ('bin', 'dulwich/contrib', 'dulwich/cloud', 'dulwich/aiohttp', '_yaml')
+
+# build keyはrequirements fileの内容から作成するため、versionを固定していないpackageは更新されても再buildされない
+PINNED_REQUIREMENT = re.compile(r'^[A-Za-z0-9._-]+(\[[A-Za-z0-9._,-]+\])?==[^=*]+$')
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+# build処理(install, trim, compile)を変更した場合に更新し、既存のbuild結果を使用しないようにする
+BUILD_VERSION = '1'
+HASH_FILE = '.layer-hash'  # output dirに保存するbuild keyのhash (CDKのasset hashとしても使用する)
+
+
+def install_requirements(requirements_file: str, python_dir: str):
+    # Note: Pip will create the output dir if it does not exist
+    # --no-compile: pipが作成するtimestamp付きの.pycとRECORDのhashをassetに含めない(compile_layerで作成する)
+    subprocess.check_call(
+        f'pip install --no-compile -r {requirements_file} -t {python_dir}'.split()
+    )
+
+
+def layer_hash(requirements_file: str, runtime_version: str) -> str:
+    """requirements, build処理, pipを実行するpythonのversionとplatformから作成するbuild key
+
+    全てのpackageが==でversionを固定している必要がある(固定していない場合はValueError)。
+    """
+    digest = hashlib.sha256()
+    with open(requirements_file, 'rb') as f:
+        content = f.read()
+    unpinned = [line for line in (line.split('#', 1)[0].strip() for line in content.decode('utf-8').splitlines())
+                if line and not PINNED_REQUIREMENT.match(line)]
+    if unpinned:
+        raise ValueError(f'{requirements_file}: version is not pinned: {", ".join(unpinned)}')
+    digest.update(content)
+    for value in (BUILD_VERSION, runtime_version, '%d.%d' % sys.version_info[:2], sysconfig.get_platform(),
+                  repr(TRIM_DIRECTORIES), repr(TRIM_SUFFIXES), repr(UNUSED_PACKAGES)):
+        digest.update(b'\0' + value.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def read_layer_hash(output_dir: str) -> Optional[str]:
+    try:
+        with open(os.path.join(output_dir, HASH_FILE)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def build_layer(requirements_file: str, output_dir: str, runtime_version: str = '3.8') -> dict:
+    """output_dir/pythonにlayerを作成する。build keyが前回と同じ場合はinstallせずに再利用する。
+
+    別のdirectoryでinstall, trim, compileしてからoutput_dirと入れ替えるため、
+    途中で失敗した場合も前回のoutput_dirは壊れない。
+    """
+    key = layer_hash(requirements_file, runtime_version)
+    if read_layer_hash(output_dir) == key:
+        return {'hash': key, 'rebuilt': False, 'removed': 0}
+
+    output_dir = output_dir.rstrip('/')
+    build_dir = tempfile.mkdtemp(prefix='.layer-build-', dir=os.path.dirname(os.path.abspath(output_dir)))
+    previous_dir = None
+    try:
+        python_dir = os.path.join(build_dir, 'python')
+        install_requirements(requirements_file, python_dir)
+        # test等を削除し、runtimeと同じpythonでbytecodeを作成する
+        removed = trim_layer(python_dir)
+        compile_layer(python_dir, runtime_version=runtime_version)
+        with open(os.path.join(build_dir, HASH_FILE), 'w') as f:
+            f.write(key + '\n')
+        os.chmod(build_dir, 0o755)  # mkdtempは0700で作成する
+
+        if os.path.exists(output_dir):
+            previous_dir = f'{build_dir}.previous'
+            os.rename(output_dir, previous_dir)
+        os.rename(build_dir, output_dir)
+    except BaseException:
+        _remove(build_dir)
+        if previous_dir is not None and not os.path.exists(output_dir):
+            os.rename(previous_dir, output_dir)
+        raise
+    if previous_dir is not None:
+        _remove(previous_dir)
+    return {'hash': key, 'rebuilt': True, 'removed': removed}
+
+
+def trim_layer(python_dir: str) -> int:
+    """test, 型情報, C source, 未使用packageを削除し、削除したbyte数を返す"""
+    removed = 0
+    for package in UNUSED_PACKAGES:
+        removed += _remove(os.path.join(python_dir, package))
+
+    for root, dirs, files in os.walk(python_dir):
+        for name in [d for d in dirs if d in TRIM_DIRECTORIES]:
+            removed += _remove(os.path.join(root, name))
+            dirs.remove(name)
+        for name in files:
+            if name.endswith(TRIM_SUFFIXES):
+                removed += _remove(os.path.join(root, name))
+    return removed
+
+
+def compile_layer(python_dir: str, runtime_version: str = '3.8') -> bool:
+    """Lambda runtimeと同じversionのpythonでbytecodeを作成する。
+
+    /optはread onlyのため、layerに.pycがないとcold start毎にcompileされる。
+    zip展開でmtimeが変わっても有効となるようunchecked-hashで作成する。
+    同じversionのpythonがない場合は作成しない(versionが異なる.pycは使用されない)。
+    """
+    python = shutil.which(f'python{runtime_version}')
+    if python is None and '%d.%d' % sys.version_info[:2] == runtime_version:
+        python = sys.executable
+    if python is None:
+        warnings.warn(f'layer_build: python{runtime_version} not found, skip precompile')
+        return False
+
+    subprocess.check_call([python, '-m', 'compileall', '-q', '-j', '0',
+                           '--invalidation-mode', 'unchecked-hash', python_dir])
+    return True
+
+
+def profile_imports(module: str, paths: list) -> list:
+    """python -X importtimeでmoduleをimportし、[(name, depth, self_us, cumulative_us)]を返す"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(paths + [env.get('PYTHONPATH', '')])
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'import {module} failed: {result.stderr.strip().splitlines()[-1:]}')
+
+    entries = []
+    for line in result.stderr.splitlines():
+        matched = IMPORT_TIME_LINE.match(line)
+        if matched:
+            self_us, cumulative_us, indent, name = matched.groups()
+            entries.append((name, len(indent) // 2, int(self_us), int(cumulative_us)))
+    return entries
+
+
+def format_import_profile(module: str, entries: list, budget_ms: int, top: int = 20) -> str:
+    """moduleのimport時間を直接importしたmodule毎と、self time上位のmodule毎に出力する"""
+    # importtimeは子moduleを親より先に出力するため、直前のtop level moduleの後からがmoduleのimport
+    end = max(i for i, (name, depth, _, _) in enumerate(entries) if name == module and depth == 0)
+    start = max([i + 1 for i, entry in enumerate(entries[:end]) if entry[1] == 0] + [0])
+    entries = entries[start:end + 1]
+
+    lines = [f'import profile: {module}',
+             f'total: {entries[-1][3] / 1000:.1f} ms (budget: {budget_ms} ms)',
+             '',
+             'direct imports (cumulative ms):']
+    direct = [(name, cumulative) for name, depth, _, cumulative in entries if depth == 1]
+    for name, cumulative in sorted(direct, key=lambda entry: -entry[1]):
+        lines.append(f'  {cumulative / 1000:8.1f}  {name}')
+
+    lines += ['', f'top {top} modules (self ms):']
+    for name, _, self_us, _ in sorted(entries, key=lambda entry: -entry[2])[:top]:
+        lines.append(f'  {self_us / 1000:8.1f}  {name}')
+    return '\n'.join(lines) + '\n'
+
+
+def _remove(path: str) -> int:
+    if os.path.isdir(path) and not os.path.islink(path):
+        size = sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, files in os.walk(path) for name in files)
+        shutil.rmtree(path)
+        return size
+    if os.path.exists(path):
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    return 0
@@ -22,24 +22,46 @@ class TagUpdateAction(Construct):
 
         self.function = function
         self.container_image_tag = container_info.get('container_image_tag')  # from Build Stage
+        self.container_image_name = container_info.get('container_image_name')  # from Build Stage
         self.github_cd_repository = cd_manifest_info.get('github_cd_repository')
         self.github_cd_branch = cd_manifest_info.get('github_cd_branch')
         self.github_cd_manifest = cd_manifest_info.get('github_cd_manifest')
         self.github_token_name = cd_manifest_info.get('github_token_name')
+        self.github_clone_mode = cd_manifest_info.get('github_clone_mode', 'full')  # full, sparse
+        self.github_backend = cd_manifest_info.get('github_backend', 'git')  # git, api
+        # 複数branch/manifestを1回で更新する場合に指定する
+        # [{'branch': 'dev', 'manifests': ['deployment.yaml', ...]}, ...]
+        self.github_cd_targets = cd_manifest_info.get('github_cd_targets')
+        # 複数のCD Repositoryを並列に更新する場合に指定する(branch, manifestを省略した場合は上記の値)
+        # [{'github_cd_repository': url, 'github_targets': [...]}, ...]
+        self.github_cd_repositories = cd_manifest_info.get('github_cd_repositories')
+        # 0より大きい場合、window内に続いたbuildのtag updateをまとめて最新のtagのみ更新する
+        self.coalesce_window_seconds = cd_manifest_info.get('coalesce_window_seconds', 0)
 
     def create(self):
         # ----------------------------------------------------------
         # Stage - Manifest Tag Update (GitHub)
         # ----------------------------------------------------------
+        user_parameters = {
+            'github_cd_repository': self.github_cd_repository,
+            'github_cd_manifest': self.github_cd_manifest,
+            'github_branch': self.github_cd_branch,
+            'github_token_name': self.github_token_name,
+            'github_clone_mode': self.github_clone_mode,
+            'github_backend': self.github_backend,
+            'container_image_tag': self.container_image_tag,  # from Build Stage
+            'container_image_name': self.container_image_name,  # from Build Stage
+        }
+        if self.github_cd_targets:
+            user_parameters['github_targets'] = self.github_cd_targets
+        if self.github_cd_repositories:
+            user_parameters['github_repositories'] = self.github_cd_repositories
+        if self.coalesce_window_seconds:
+            user_parameters['coalesce_window_seconds'] = self.coalesce_window_seconds
+
         lambda_invoke_action = aws_codepipeline_actions.LambdaInvokeAction(
             action_name='github-manifest-tag-update',
-            user_parameters={
-                'github_cd_repository': self.github_cd_repository,
-                'github_cd_manifest': self.github_cd_manifest,
-                'github_branch': self.github_cd_branch,
-                'github_token_name': self.github_token_name,
-                'container_image_tag': self.container_image_tag,  # from Build Stage
-            },
+            user_parameters=user_parameters,
             lambda_=self.function,
         )
         return lambda_invoke_action
@@ -1,9 +1,15 @@
 import os
-import subprocess
 import aws_cdk
 from constructs import Construct
 from aws_cdk import aws_lambda
 from aws_cdk import aws_iam
+from aws_cdk import aws_dynamodb
+from _constructs.codepipeline import layer_build
+
+FUNCTION_NAME = 'GithubManifestTagUpdate'
+ROLLBACK_FUNCTION_NAME = 'GithubManifestRollback'
+FUNCTION_DIR = './_constructs/codepipeline/functions/manifest_update'
+LAYER_OUTPUT_DIR = 'layer_pip/'
 
 
 class TagUpdateFunction(Construct):
@@ -29,6 +35,7 @@ class TagUpdateFunction(Construct):
 
     def create_lambda_function(self):
         lambda_role = self.create_lambda_role()
+        state_table = self.create_state_table()
         git_layer = self.create_lambda_layer()
         powertools_layer = aws_lambda.LayerVersion.from_layer_version_arn(
             self,
@@ -37,25 +44,88 @@ class TagUpdateFunction(Construct):
                                'layer:AWSLambdaPowertoolsPython:19')
         )
 
-        function = aws_lambda.Function(
-            self,
-            'LambdaInvokeFunction',
-            function_name='GithubManifestTagUpdate',
-            handler='function.lambda_handler',
+        function_props = dict(
             runtime=aws_lambda.Runtime.PYTHON_3_8,
-            code=aws_lambda.Code.from_asset('./_constructs/codepipeline/functions/manifest_update'),
+            code=aws_lambda.Code.from_asset(FUNCTION_DIR),
             role=lambda_role,
             layers=[powertools_layer, git_layer],
             environment={
                 'POWERTOOLS_SERVICE_NAME': 'GitOpsPipelineAction',  # for Powertools
                 'LOG_LEVEL': 'INFO',  # for Powertools
+                'POWERTOOLS_METRICS_NAMESPACE': 'GitOpsPipeline',  # for Powertools Metrics (EMF)
+                'REPO_CACHE_DIR': '/tmp/repo-cache',  # warm containerで再利用するCD Repository
+                'REPO_CACHE_MAX_MB': '256',  # 超過した場合はfresh cloneする
+                'REPO_CACHE_TOTAL_MAX_MB': '384',  # cache全体の上限。超過した場合は古いentryから削除する
+                'MEMORY_REPO_MAX_MB': '32',  # memory modeの上限。超過した場合はsparse(disk)でcloneする
+                'SECRET_TTL_SECONDS': '300',  # GitHub tokenをwarm containerでcacheする期間
+                'PUSH_MAX_ATTEMPTS': '4',  # 同時実行でpushがrejectされた場合のretry回数(初回含む)
+                'CONTINUATION_REMAINING_MS': '30000',  # 残り時間が少ない場合は次のphaseを再invokeで実行する
+                'FANOUT_MAX_WORKERS': '4',  # 複数のCD Repositoryを更新する場合の並列数
+                'STATE_TABLE_NAME': state_table.table_name,  # coalesce等の状態
             },
             memory_size=128,
             timeout=aws_cdk.Duration.seconds(60),
+            tracing=aws_lambda.Tracing.ACTIVE,  # Powertools Tracer (xray:PutTraceSegmentsはCDKが付与する)
             # dead_letter_queue_enabled=True
         )
+        function = aws_lambda.Function(
+            self,
+            'LambdaInvokeFunction',
+            function_name=FUNCTION_NAME,
+            handler='function.lambda_handler',
+            **function_props
+        )
+        state_table.grant_read_write_data(lambda_role)
+
+        # deployment ledgerの直前のknown-good tagを再適用する(CodePipelineを経由せずに直接invokeする)
+        self.rollback_function = aws_lambda.Function(
+            self,
+            'RollbackFunction',
+            function_name=ROLLBACK_FUNCTION_NAME,
+            handler='function.rollback_handler',
+            **function_props
+        )
+        # import profileはsubprocessでfunctionをimportするため、指定した場合のみ作成する
+        #   cdk synth -c import_profile=true
+        if str(self.node.try_get_context('import_profile')).lower() == 'true':
+            self.create_import_profile()
         return function
 
+    def create_state_table(self) -> aws_dynamodb.Table:
+        # tag updateの状態を保持する。itemはexpires_atで自動削除する
+        return aws_dynamodb.Table(
+            self,
+            'StateTable',
+            partition_key=aws_dynamodb.Attribute(name='pk', type=aws_dynamodb.AttributeType.STRING),
+            billing_mode=aws_dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute='expires_at',
+            removal_policy=aws_cdk.RemovalPolicy.DESTROY,
+        )
+
+    def create_import_profile(self):
+        # synth時にfunctionのimport時間(cold startのinit phase)をmodule毎に出力し、
+        # budgetを超えた場合はwarningとする
+        budget_ms = self.config['tag_update_import_budget_ms']
+        try:
+            entries = layer_build.profile_imports(
+                'function', [FUNCTION_DIR, os.path.join(LAYER_OUTPUT_DIR, 'python')])
+        except RuntimeError as e:
+            aws_cdk.Annotations.of(self).add_warning(f'import profile failed: {e}')
+            return
+
+        report = layer_build.format_import_profile('function', entries, budget_ms)
+        outdir = aws_cdk.Stage.of(self).outdir
+        os.makedirs(outdir, exist_ok=True)
+        with open(os.path.join(outdir, f'import-profile-{FUNCTION_NAME}.txt'), 'w') as f:
+            f.write(report)
+
+        total_ms = entries[-1][3] / 1000
+        message = f'{FUNCTION_NAME} import time: {total_ms:.1f} ms (budget: {budget_ms} ms)'
+        if total_ms > budget_ms:
+            aws_cdk.Annotations.of(self).add_warning(message)
+        else:
+            aws_cdk.Annotations.of(self).add_info(message)
+
     def create_lambda_role(self):
         lambda_role = aws_iam.Role(
             self,
@@ -81,18 +151,25 @@ class TagUpdateFunction(Construct):
 
     def create_lambda_layer(self) -> aws_lambda.LayerVersion:
         requirements_file = './_constructs/codepipeline/layers/git_command/requirements.txt'
-        output_dir = "layer_pip/"
 
-        # Install requirements for layer in the output_dir
+        # requirements, pythonのversion/platformが前回のbuildと同じ場合はlayer_pip/を再利用する
         if not os.environ.get("SKIP_PIP"):
-            # Note: Pip will create the output dir if it does not exist
-            subprocess.check_call(
-                f"pip install -r {requirements_file} -t {output_dir}/python".split()
-            )
+            result = layer_build.build_layer(requirements_file, LAYER_OUTPUT_DIR, runtime_version='3.8')
+            if result['rebuilt']:
+                aws_cdk.Annotations.of(self).add_info(
+                    f'GitCommand layer rebuilt: trimmed {result["removed"] // 1024} KiB')
+            else:
+                aws_cdk.Annotations.of(self).add_info('GitCommand layer reused: requirements unchanged')
+
+        # build keyをasset hashとし、layerが変わっていない場合はuploadしない
+        layer_hash = layer_build.read_layer_hash(LAYER_OUTPUT_DIR)
+        asset_options = {}
+        if layer_hash is not None:
+            asset_options = {'asset_hash_type': aws_cdk.AssetHashType.CUSTOM, 'asset_hash': layer_hash}
         layer = aws_lambda.LayerVersion(
             self,
             id='GitCommand',
             layer_version_name='GitCommand',
-            code=aws_lambda.Code.from_asset(output_dir)
+            code=aws_lambda.Code.from_asset(LAYER_OUTPUT_DIR, **asset_options)
         )
         return layer
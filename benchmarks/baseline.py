@@ -0,0 +1,72 @@
+"""benchmark共通: baseline.jsonの更新/比較(--update-baseline, --check)とdirectory size
+
+各benchmarkはscenario名をkeyとする結果のdictを作成し、
+CHECKED_METRICSを指定してcheck_or_updateを呼び出す。
+CHECKED_METRICSは (key, 許容する悪化率のargument名, 許容する絶対値のargument名) のlist。
+"""
+import json
+import os
+import sys
+
+
+def directory_size(path: str, suffix: str = '') -> int:
+    """path以下のfile(suffixで終わるもののみ)の合計byte数"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name.endswith(suffix):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def add_arguments(parser, baseline_path: str, slack_ms: float, size_metrics: str):
+    parser.add_argument('--baseline', default=baseline_path)
+    parser.add_argument('--check', action='store_true', help='baselineより悪化した場合exit 1')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='時間の許容する悪化率')
+    parser.add_argument('--slack-ms', type=float, default=slack_ms, help='時間の許容する悪化(ms)')
+    parser.add_argument('--size-tolerance', type=float, default=0.2, help=f'{size_metrics}の許容する悪化率')
+
+
+def find_regressions(results: dict, baseline: dict, tolerances: dict, checked_metrics: list) -> list:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key, tolerance_name, slack_name in checked_metrics:
+            limit = baseline[name][key] * (1 + tolerances[tolerance_name]) + tolerances.get(slack_name, 0)
+            if result[key] > limit:
+                regressions.append(f'{name}: {key} {result[key]} > {limit:.1f} (baseline {baseline[name][key]})')
+    return regressions
+
+
+def update_baseline(path: str, results: dict):
+    # 実行しなかったscenarioのbaselineは残す
+    baseline = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            baseline = json.load(f)
+    baseline.update(results)
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+    print(f'baseline updated: {path}')
+
+
+def check_or_update(args, results: dict, checked_metrics: list):
+    """add_argumentsで追加したargumentに従いbaselineを更新/比較する。悪化した場合exit 1"""
+    if args.update_baseline:
+        update_baseline(args.baseline, results)
+
+    if args.check:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(
+            results, baseline,
+            {'tolerance': args.tolerance, 'slack_ms': args.slack_ms, 'size_tolerance': args.size_tolerance},
+            checked_metrics)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print('no regression against baseline')
@@ -0,0 +1,89 @@
+"""manifest_update Lambdaが使用するAWS serviceのlocal stand-in
+
+function.get_code_pipeline_client / get_secrets_manager_client / get_state_storeを差し替えて使用する。
+"""
+import json
+
+
+class StubCodePipeline:
+    """put_job_success_result / put_job_failure_resultの呼び出しを記録する"""
+
+    def __init__(self):
+        self.results = []
+
+    def put_job_success_result(self, **kwargs):
+        self.results.append(('success', kwargs))
+
+    def put_job_failure_result(self, **kwargs):
+        self.results.append(('failure', kwargs))
+
+
+class StubSecretsManager:
+    """get_secret_valueで指定したtokenを順に返す(最後のtokenは返し続ける)"""
+
+    def __init__(self, *tokens):
+        self.tokens = list(tokens)
+        self.calls = 0
+
+    def get_secret_value(self, SecretId):
+        self.calls += 1
+        token = self.tokens.pop(0) if len(self.tokens) > 1 else self.tokens[0]
+        return {'SecretString': token}
+
+
+class MemoryStateStore:
+    """StateStore(DynamoDB table)と同じconditionでputするdict"""
+
+    def __init__(self):
+        self.items = {}
+
+    def get(self, pk):
+        item = self.items.get(pk)
+        return dict(item) if item else None
+
+    def put(self, pk, item):
+        self.items[pk] = dict(item, pk=pk)
+
+    def put_if_newer(self, pk, item, order_key):
+        current = self.items.get(pk)
+        if current is not None and not current[order_key] < item[order_key]:
+            return False
+        self.items[pk] = dict(item, pk=pk)
+        return True
+
+
+class StubContext:
+    """Lambda contextのうちget_remaining_time_in_millisのみ提供する"""
+
+    def __init__(self, remaining_ms: int = 60000):
+        self.remaining_ms = remaining_ms
+        self.function_name = 'GithubManifestTagUpdate'
+
+    def get_remaining_time_in_millis(self) -> int:
+        return self.remaining_ms
+
+
+def install(function, codepipeline: StubCodePipeline, secrets_manager: StubSecretsManager,
+            state_store: MemoryStateStore = None):
+    """function moduleのAWS clientをstand-inに差し替え、secretのcacheを破棄する"""
+    function.get_code_pipeline_client = lambda: codepipeline
+    function.get_secrets_manager_client = lambda: secrets_manager
+    state_store = state_store or MemoryStateStore()
+    function.get_state_store = lambda: state_store
+    function._secret_cache.clear()
+
+
+def codepipeline_event(url: str, branch: str, tag: str, job_id: str = 'job-1', continuation_token: str = None,
+                       **user_parameters) -> dict:
+    """CodePipelineのLambda invoke actionが渡すCodePipeline.job event"""
+    user_parameters = dict({
+        'github_cd_repository': url,
+        'github_cd_manifest': 'deployment.yaml',
+        'github_branch': branch,
+        'github_token_name': 'GithubPersonalAccessToken',
+        'container_image_tag': {'value': tag},
+    }, **user_parameters)
+    data = {'actionConfiguration': {'configuration': {'UserParameters': json.dumps(user_parameters)}}}
+    if continuation_token is not None:
+        data['continuationToken'] = continuation_token
+    return {'CodePipeline.job': {'id': job_id, 'data': data}}
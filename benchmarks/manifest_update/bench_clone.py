@@ -0,0 +1,89 @@
+"""Git.clone() benchmark: full clone vs sparse(shallow/single-branch) clone vs memory clone
+
+深いhistoryを持つlocal bare repositoryをSmart HTTPで公開し、
+clone_mode毎に別processでcloneを実行してclone時間とpeak RSSを計測する。
+
+    python -m benchmarks.manifest_update.bench_clone --history 2000 --services 50
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.baseline import directory_size
+from benchmarks.manifest_update.fixtures import build_cd_repository
+from benchmarks.manifest_update.fixtures import import_function
+from benchmarks.manifest_update.fixtures import GitHttpServer
+
+
+def worker(url: str, clone_mode: str, branch: str, manifest: str) -> dict:
+    function = import_function()
+    with tempfile.TemporaryDirectory() as work_dir:
+        local_repo_path = work_dir + '/repo/'
+        git = function.Git(
+            cd_repository=url,
+            targets=[{'branch': branch, 'manifests': [manifest]}],
+            local_repo_path=local_repo_path,
+            github_personal_access_token='not-used',
+            clone_mode=clone_mode)
+        start = time.perf_counter()
+        git.clone()
+        elapsed = time.perf_counter() - start
+        disk_usage = directory_size(local_repo_path)
+
+    return {
+        'clone_mode': clone_mode,
+        'seconds': round(elapsed, 3),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'disk_mb': round(disk_usage / 1024 / 1024, 2),
+    }
+
+
+def run_worker(url: str, clone_mode: str, branch: str, manifest: str) -> dict:
+    env = dict(os.environ, AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION', 'ap-northeast-1'))
+    output = subprocess.check_output(
+        [sys.executable, '-m', 'benchmarks.manifest_update.bench_clone',
+         '--worker', url, '--clone-mode', clone_mode, '--branch', branch, '--manifest', manifest],
+        env=env, stderr=subprocess.DEVNULL)
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--history', type=int, default=1000, help='commit数')
+    parser.add_argument('--services', type=int, default=50, help='CD Repository内のservice数')
+    parser.add_argument('--branch', default='dev')
+    parser.add_argument('--manifest', default='deployment.yaml')
+    parser.add_argument('--clone-mode', default=None, help='指定したclone modeのみ実行する')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--worker', metavar='URL', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(worker(args.worker, args.clone_mode, args.branch, args.manifest)))
+        return
+
+    clone_modes = [args.clone_mode] if args.clone_mode else ['full', 'sparse', 'memory']
+    with tempfile.TemporaryDirectory() as work_dir:
+        remote_path = os.path.join(work_dir, 'remote.git')
+        print(f'building remote: history={args.history} services={args.services}')
+        build_cd_repository(remote_path, services=args.services, history=args.history,
+                            manifest=args.manifest)
+        print(f'remote size: {directory_size(remote_path) / 1024 / 1024:.2f} MB')
+
+        with GitHttpServer(remote_path) as server:
+            print(f'{"mode":<8}{"seconds(min)":>14}{"seconds(max)":>14}{"peak_rss_mb":>13}{"disk_mb":>10}')
+            for clone_mode in clone_modes:
+                results = [run_worker(server.url, clone_mode, args.branch, args.manifest)
+                           for _ in range(args.repeat)]
+                seconds = [r['seconds'] for r in results]
+                print(f'{clone_mode:<8}{min(seconds):>14.3f}{max(seconds):>14.3f}'
+                      f'{max(r["peak_rss_mb"] for r in results):>13.1f}'
+                      f'{results[0]["disk_mb"]:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""lambda_handler benchmark: scenario毎のlatency(p50/p95/p99), peak RSS, /tmp使用量
+
+scenario毎にCD Repository(bare)を生成してlocalのSmart HTTP server(またはGitHub API stand-in)で公開し、
+CodePipeline/Secrets Managerをstand-inに差し替えた別processでlambda_handlerを繰り返しinvokeする。
+1回目はcacheがないためclone(cold)、2回目以降はcacheへのfetch(warm)となる。
+coldは1回のみのため個別に比較し、p50/p95/p99はwarmのinvocationのみで計算する。
+
+    python -m benchmarks.manifest_update.bench_handler
+    python -m benchmarks.manifest_update.bench_handler --scenario small --scenario api --invocations 10
+    python -m benchmarks.manifest_update.bench_handler --check            # baselineより悪化した場合exit 1 (CI用)
+    python -m benchmarks.manifest_update.bench_handler --update-baseline  # baseline.jsonを更新する
+"""
+import argparse
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks import baseline
+from benchmarks.baseline import directory_size
+from benchmarks.manifest_update import aws_stubs
+from benchmarks.manifest_update.fixtures import build_cd_repository
+from benchmarks.manifest_update.fixtures import import_function
+from benchmarks.manifest_update.fixtures import GitHttpServer
+from benchmarks.manifest_update.github_api_server import GithubApiServer
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+API_REPOSITORY = 'https://github.com/rafty/handson-flask_cd.git'
+
+SCENARIOS = {
+    'small': {'services': 10, 'history': 100, 'backend': 'git', 'clone_mode': 'sparse'},
+    'large-sparse': {'services': 100, 'history': 2000, 'backend': 'git', 'clone_mode': 'sparse'},
+    'large-memory': {'services': 100, 'history': 2000, 'backend': 'git', 'clone_mode': 'memory'},
+    'large-full': {'services': 100, 'history': 2000, 'backend': 'git', 'clone_mode': 'full'},
+    # dev, prdの2 branch x 2 manifestを1回のinvocationで更新する
+    'batch': {'services': 30, 'history': 500, 'backend': 'git', 'clone_mode': 'sparse', 'targets': [
+        {'branch': 'dev', 'manifests': ['deployment.yaml', 'services/service-000/deployment.yaml']},
+        {'branch': 'prd', 'manifests': ['deployment.yaml', 'services/service-000/deployment.yaml']}]},
+    'api': {'services': 30, 'history': 500, 'backend': 'api', 'clone_mode': 'sparse'},
+}
+
+# baselineと比較するmetric: (key, 許容する悪化率のargument名, 許容する絶対値のargument名)
+# 数十msのlatencyは実行環境のnoiseが大きいため、悪化率に加えて絶対値の余裕を持たせる
+CHECKED_METRICS = [('cold_ms', 'tolerance', 'slack_ms'), ('p50_ms', 'tolerance', 'slack_ms'),
+                   ('p95_ms', 'tolerance', 'slack_ms'), ('p99_ms', 'tolerance', 'slack_ms'),
+                   ('peak_rss_mb', 'size_tolerance', None), ('tmp_mb', 'size_tolerance', None)]
+
+
+def percentile(values: list, p: float) -> float:
+    # nearest-rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def worker(scenario: dict, url: str, api_url: str, invocations: int) -> dict:
+    function = import_function()
+    codepipeline = aws_stubs.StubCodePipeline()
+    aws_stubs.install(function, codepipeline, aws_stubs.StubSecretsManager('token'))
+
+    user_parameters = {'github_backend': scenario['backend'], 'github_clone_mode': scenario['clone_mode']}
+    if 'targets' in scenario:
+        user_parameters['github_targets'] = scenario['targets']
+    if scenario['backend'] == 'api':
+        url, user_parameters['github_api_url'] = API_REPOSITORY, api_url
+
+    latencies, tmp_usage = [], 0
+    with tempfile.TemporaryDirectory() as work_dir:
+        function.REPO_CACHE_DIR = os.path.join(work_dir, 'repo-cache')
+        for i in range(invocations):
+            event = aws_stubs.codepipeline_event(url, 'dev', f'bench-{os.getpid()}-{i}', job_id=f'job-{i}',
+                                                 **user_parameters)
+            start = time.perf_counter()
+            function.lambda_handler(event, aws_stubs.StubContext())
+            latencies.append((time.perf_counter() - start) * 1000)
+            result, kwargs = codepipeline.results[-1]
+            if result != 'success' or 'continuationToken' in kwargs:
+                raise RuntimeError(f'invocation {i} did not complete: {result} {kwargs}')
+            tmp_usage = max(tmp_usage, directory_size(work_dir))
+
+    # p99がcoldの1回となって比較がnoisyにならないよう、percentileはwarmのみで計算する
+    cold, warm = latencies[0], latencies[1:]
+    return {
+        'invocations': invocations,
+        'cold_ms': round(cold, 1),
+        'p50_ms': round(percentile(warm, 50), 1),
+        'p95_ms': round(percentile(warm, 95), 1),
+        'p99_ms': round(percentile(warm, 99), 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'tmp_mb': round(tmp_usage / 1024 / 1024, 2),
+    }
+
+
+def run_scenario(name: str, invocations: int) -> dict:
+    scenario = SCENARIOS[name]
+    with tempfile.TemporaryDirectory() as work_dir:
+        remote_path = os.path.join(work_dir, 'remote.git')
+        build_cd_repository(remote_path, services=scenario['services'], history=scenario['history'])
+        with GitHttpServer(remote_path) as server, GithubApiServer(remote_path, token='token') as api:
+            env = dict(os.environ, AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION', 'ap-northeast-1'))
+            output = subprocess.check_output(
+                [sys.executable, '-m', 'benchmarks.manifest_update.bench_handler',
+                 '--worker', json.dumps(scenario), '--url', server.url, '--api-url', api.url,
+                 '--invocations', str(invocations)],
+                env=env, stderr=subprocess.DEVNULL)
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='実行するscenario(複数指定可)。省略時は全scenario')
+    parser.add_argument('--invocations', type=int, default=50, help='scenario毎のinvoke回数(cold 1回 + warm)')
+    baseline.add_arguments(parser, BASELINE_PATH, slack_ms=50, size_metrics='peak RSS, /tmp使用量')
+    parser.add_argument('--worker', metavar='SCENARIO', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--api-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.invocations < 2:
+        parser.error('--invocations must be at least 2 (cold + warm)')
+
+    if args.worker:
+        print(json.dumps(worker(json.loads(args.worker), args.url, args.api_url, args.invocations)))
+        return
+
+    results = {}
+    print(f'{"scenario":<14}{"cold_ms":>10}{"p50_ms":>10}{"p95_ms":>10}{"p99_ms":>10}'
+          f'{"peak_rss_mb":>13}{"tmp_mb":>9}')
+    for name in args.scenario or list(SCENARIOS):
+        result = results[name] = run_scenario(name, args.invocations)
+        print(f'{name:<14}{result["cold_ms"]:>10.1f}{result["p50_ms"]:>10.1f}{result["p95_ms"]:>10.1f}'
+              f'{result["p99_ms"]:>10.1f}{result["peak_rss_mb"]:>13.1f}{result["tmp_mb"]:>9.2f}')
+
+    baseline.check_or_update(args, results, CHECKED_METRICS)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""manifest編集のbenchmark: load/dump round trip vs surgical(in-place) edit
+
+複数MBのmulti-document manifestを生成し、mode毎に実行時間とpeak memory(tracemalloc)を計測する。
+    original : yaml.safe_load_all -> yaml.dump_all (変更前のManifestUpdatedと同じpure python実装)
+    roundtrip: ImageIndex + load/dump (EDIT_MODE_ROUNDTRIP)
+    surgical : ImageIndex + image scalarの範囲のみ置換 (EDIT_MODE_SURGICAL)
+
+    python -m benchmarks.manifest_update.bench_manifest_edit --documents 2000
+"""
+import argparse
+import time
+import tracemalloc
+import yaml
+from benchmarks.manifest_update.fixtures import add_function_path
+from benchmarks.manifest_update.fixtures import deployment_manifest
+from benchmarks.manifest_update.fixtures import ECR_IMAGE
+
+add_function_path()
+import image_updater  # noqa: E402
+
+
+def original(content: str, tag: str) -> str:
+    documents = list(yaml.safe_load_all(content))
+    for document in documents:
+        image = document['spec']['template']['spec']['containers'][0]['image']
+        document['spec']['template']['spec']['containers'][0]['image'] = image.rsplit(':', 1)[0] + ':' + tag
+    return yaml.dump_all(documents, sort_keys=False)
+
+
+def roundtrip(content: str, tag: str) -> str:
+    return image_updater.update_images(content, {'flask': tag}, preserve_format=False)
+
+
+def surgical(content: str, tag: str) -> str:
+    return image_updater.update_images(content, {'flask': tag}, preserve_format=True)
+
+
+MODES = {'original': original, 'roundtrip': roundtrip, 'surgical': surgical}
+
+
+def build_manifest(documents: int) -> str:
+    # 各documentに'# service'のcommentを入れ、round tripで失われることを確認できるようにする
+    return '---\n'.join(
+        f'# service-{i}\n' + deployment_manifest('flask', 'old', env_count=40).decode('utf-8')
+        for i in range(documents))
+
+
+def measure(mode: str, content: str, repeat: int) -> dict:
+    edit = MODES[mode]
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = edit(content, 'new')
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    edit(content, 'new')
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    changed_lines = sum(1 for a, b in zip(content.splitlines(), result.splitlines()) if a != b)
+    return {
+        'mode': mode,
+        'seconds': min(seconds),
+        'peak_mb': peak / 1024 / 1024,
+        'changed_lines': changed_lines + abs(len(content.splitlines()) - len(result.splitlines())),
+        'images_updated': result.count(f'{ECR_IMAGE}:new'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, default=2000, help='manifest内のdocument数')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--modes', default=','.join(MODES))
+    args = parser.parse_args()
+
+    content = build_manifest(args.documents)
+    print(f'manifest: documents={args.documents} size={len(content.encode("utf-8")) / 1024 / 1024:.2f} MB '
+          f'libyaml={hasattr(yaml, "CSafeLoader")}')
+    print(f'{"mode":<10}{"seconds":>10}{"peak_mb":>10}{"changed_lines":>15}{"images":>8}')
+    for mode in args.modes.split(','):
+        r = measure(mode, content, args.repeat)
+        print(f'{r["mode"]:<10}{r["seconds"]:>10.3f}{r["peak_mb"]:>10.1f}{r["changed_lines"]:>15}{r["images_updated"]:>8}')
+
+
+if __name__ == '__main__':
+    main()
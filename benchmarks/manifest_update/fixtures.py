@@ -0,0 +1,173 @@
+"""manifest_update Lambda benchmark用のfixture
+ - 深いhistoryを持つCD Repository(bare)の生成
+ - dulwichのSmart HTTP serverによるlocal git remote
+"""
+import os
+import sys
+import threading
+from dulwich.objects import Blob, Commit, Tree
+from dulwich.repo import Repo
+from dulwich.server import DictBackend
+from dulwich.web import make_wsgi_chain, make_server, WSGIRequestHandlerLogger, WSGIServerLogger
+
+FUNCTION_DIR = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', '..',
+    '_constructs', 'codepipeline', 'functions', 'manifest_update'))
+
+ECR_IMAGE = '338456725408.dkr.ecr.ap-northeast-1.amazonaws.com/flask'
+
+DEPLOYMENT_TEMPLATE = """apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: {name}
+  namespace: {name}
+spec:
+  replicas: 1
+  template:
+    metadata:
+      labels:
+        app: {name}
+    spec:
+      serviceAccountName: {name}
+      containers:
+      - name: {name}
+        image: {image}:{tag}
+        imagePullPolicy: Always
+        ports:
+        - containerPort: 5000
+{padding}  selector:
+    matchLabels:
+      app: {name}
+"""
+
+
+def add_function_path():
+    """Lambda asset directoryをsys.pathに追加する(Lambdaではhandlerのdirectoryがsys.pathにある)"""
+    if FUNCTION_DIR not in sys.path:
+        sys.path.insert(0, FUNCTION_DIR)
+
+
+def import_function():
+    """function moduleをimportする"""
+    add_function_path()
+    import function
+    return function
+
+
+def deployment_manifest(name: str, tag: str, env_count: int = 20) -> bytes:
+    padding = '        env:\n' + ''.join(
+        f'        - name: ENV_{i}\n          value: value-{name}-{i}\n' for i in range(env_count))
+    return DEPLOYMENT_TEMPLATE.format(
+        name=name, image=ECR_IMAGE, tag=tag, padding=padding).encode('utf-8')
+
+
+def _tree(object_store, entries: dict) -> bytes:
+    # entries: {b'name': blob_id or {nested entries}}
+    tree = Tree()
+    for name, value in entries.items():
+        if isinstance(value, dict):
+            tree.add(name, 0o040000, _tree(object_store, value))
+        else:
+            tree.add(name, 0o100644, value)
+    object_store.add_object(tree)
+    return tree.id
+
+
+def build_cd_repository(path: str,
+                        branches=('dev', 'prd'),
+                        services: int = 30,
+                        history: int = 500,
+                        manifest: str = 'deployment.yaml') -> Repo:
+    """history数のcommitを持つbare repositoryを作成する。
+    commit毎にいずれかのserviceのmanifestのtagを更新する。"""
+    repo = Repo.init_bare(path, mkdir=True)
+    object_store = repo.object_store
+
+    def add_blob(data: bytes) -> bytes:
+        blob = Blob.from_string(data)
+        object_store.add_object(blob)
+        return blob.id
+
+    service_blobs = {
+        f'service-{i:03d}'.encode(): add_blob(deployment_manifest(f'service-{i:03d}', 'initial'))
+        for i in range(services)}
+    root_blob = add_blob(deployment_manifest('flask', 'initial'))
+
+    parent = None
+    for n in range(history):
+        name = f'service-{n % services:03d}'
+        service_blobs[name.encode()] = add_blob(deployment_manifest(name, f'build-{n:06d}'))
+        tree_id = _tree(object_store, {
+            manifest.encode(): root_blob,
+            b'services': {k: {b'deployment.yaml': v} for k, v in service_blobs.items()},
+        })
+        commit = Commit()
+        commit.tree = tree_id
+        commit.parents = [parent] if parent else []
+        commit.author = commit.committer = b'benchmark <benchmark@example.com>'
+        commit.author_time = commit.commit_time = 1655000000 + n
+        commit.author_timezone = commit.commit_timezone = 0
+        commit.message = f'Update {name}'.encode()
+        object_store.add_object(commit)
+        parent = commit.id
+
+    for branch in branches:
+        repo.refs[b'refs/heads/' + branch.encode()] = parent
+    repo.refs.set_symbolic_ref(b'HEAD', b'refs/heads/' + branches[0].encode())
+    return repo
+
+
+class GitHttpServer:
+    """bare repositoryをSmart HTTPで公開するlocal server(with文で使用)
+
+    dulwichはpush毎にpackを追加し、objectの検索は全packを確認してからloose objectを読むため、
+    pushを繰り返すとfetchが遅くなる(GitHubはrepositoryをmaintenanceするため遅くならない)。
+    build_cd_repositoryはloose objectのみで作成するため、pushされたpackはloose objectに展開する。
+    """
+
+    def __init__(self, repo_path: str, host: str = '127.0.0.1'):
+        self.repo_path = repo_path
+        self.host = host
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self._server.server_port}/'
+
+    def __enter__(self):
+        repo = Repo(self.repo_path)
+        wsgi_app = make_wsgi_chain(DictBackend({b'/': repo}))
+
+        def app(environ, start_response):
+            response = list(wsgi_app(environ, start_response))
+            if environ['PATH_INFO'].endswith('/git-receive-pack'):
+                _unpack_objects(repo)
+            return response
+
+        self._server = make_server(
+            self.host, 0, app,
+            handler_class=_QuietRequestHandler,
+            server_class=WSGIServerLogger)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _unpack_objects(repo: Repo):
+    object_store = repo.object_store
+    for pack in object_store.packs:
+        for obj in pack.iterobjects():
+            object_store.add_object(obj)
+    object_store.close()
+    for name in os.listdir(object_store.pack_dir):
+        os.remove(os.path.join(object_store.pack_dir, name))
+
+
+class _QuietRequestHandler(WSGIRequestHandlerLogger):
+    def log_message(self, format, *args):
+        pass
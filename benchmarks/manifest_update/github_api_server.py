@@ -0,0 +1,196 @@
+"""GitHub Git Data APIのlocal stand-in server
+
+GithubApi backendをofflineでtest/benchmarkするため、
+bare repository(dulwich)を背後に持つ最小限のREST APIを提供する。
+    GET   /repos/{owner}/{repo}/git/ref/heads/{branch}
+    GET   /repos/{owner}/{repo}/git/commits/{sha}
+    GET   /repos/{owner}/{repo}/git/trees/{sha}
+    GET   /repos/{owner}/{repo}/git/blobs/{sha}
+    POST  /repos/{owner}/{repo}/git/blobs
+    POST  /repos/{owner}/{repo}/git/trees
+    POST  /repos/{owner}/{repo}/git/commits
+    PATCH /repos/{owner}/{repo}/git/refs/heads/{branch}
+"""
+import base64
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dulwich.objects import Blob, Commit, Tree
+from dulwich.repo import Repo
+
+ROUTE = re.compile(r'^/repos/[^/]+/[^/]+/git/(?P<kind>ref|refs|commits|trees|blobs)(?:/(?P<rest>.+))?$')
+
+
+class GithubApiServer:
+    """with文で使用する。requestsに受け付けたrequestの(method, path)を記録する。"""
+
+    def __init__(self, repo_path: str, token: str = 'token', host: str = '127.0.0.1'):
+        self.repo = Repo(repo_path)
+        self.token = token
+        self.host = host
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self._server.server_port}'
+
+    def __enter__(self):
+        stand_in = self
+
+        class Handler(_GithubApiHandler):
+            server_state = stand_in
+
+        self._server = ThreadingHTTPServer((self.host, 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+        self.repo.close()
+
+    # ---------------- Git Data API ----------------
+    def get_ref(self, branch: str):
+        ref = b'refs/heads/' + branch.encode('utf-8')
+        if ref not in self.repo.refs:
+            return 404, {'message': 'Not Found'}
+        return 200, {'ref': ref.decode(), 'object': {'type': 'commit', 'sha': self.repo.refs[ref].decode()}}
+
+    def get_commit(self, sha: str):
+        commit = self.repo[sha.encode()]
+        return 200, {'sha': sha, 'tree': {'sha': commit.tree.decode()},
+                     'parents': [{'sha': p.decode()} for p in commit.parents],
+                     'message': commit.message.decode('utf-8')}
+
+    def get_tree(self, sha: str):
+        tree = self.repo[sha.encode()]
+        return 200, {'sha': sha, 'tree': [
+            {'path': item.path.decode('utf-8'), 'mode': f'{item.mode:06o}',
+             'type': 'tree' if item.mode == 0o040000 else 'blob', 'sha': item.sha.decode()}
+            for item in tree.items()]}
+
+    def get_blob(self, sha: str):
+        blob = self.repo[sha.encode()]
+        return 200, {'sha': sha, 'size': len(blob.data), 'encoding': 'base64',
+                     'content': base64.b64encode(blob.data).decode('ascii')}
+
+    def create_blob(self, body: dict):
+        if body.get('encoding') == 'base64':
+            data = base64.b64decode(body['content'])
+        else:
+            data = body['content'].encode('utf-8')
+        blob = Blob.from_string(data)
+        self.repo.object_store.add_object(blob)
+        return 201, {'sha': blob.id.decode()}
+
+    def create_tree(self, body: dict):
+        # GitHubは存在しないblobを含むtreeを422とする
+        missing = [entry['sha'] for entry in body['tree'] if entry['sha'].encode() not in self.repo.object_store]
+        if missing:
+            return 422, {'message': f'tree.sha {missing[0]} is not a valid blob'}
+        tree_id = body['base_tree'].encode()
+        for entry in body['tree']:
+            tree_id = self._replace(tree_id, entry['path'].encode('utf-8'),
+                                    int(entry['mode'], 8), entry['sha'].encode())
+        return 201, {'sha': tree_id.decode()}
+
+    def create_commit(self, body: dict):
+        commit = Commit()
+        commit.tree = body['tree'].encode()
+        commit.parents = [p.encode() for p in body['parents']]
+        author = body.get('author', {'name': 'stand-in', 'email': 'stand-in@example.com'})
+        commit.author = commit.committer = f'{author["name"]} <{author["email"]}>'.encode('utf-8')
+        commit.author_time = commit.commit_time = 0
+        commit.author_timezone = commit.commit_timezone = 0
+        commit.message = body['message'].encode('utf-8')
+        self.repo.object_store.add_object(commit)
+        return 201, {'sha': commit.id.decode()}
+
+    def update_ref(self, branch: str, body: dict):
+        ref = b'refs/heads/' + branch.encode('utf-8')
+        new = body['sha'].encode()
+        with self._lock:
+            old = self.repo.refs[ref]
+            ancestors = (entry.commit.id for entry in self.repo.get_walker(include=[new]))
+            if not body.get('force') and old not in ancestors:
+                return 422, {'message': 'Update is not a fast forward'}
+            self.repo.refs[ref] = new
+        return 200, {'ref': ref.decode(), 'object': {'type': 'commit', 'sha': body['sha']}}
+
+    def _replace(self, tree_id: bytes, path: bytes, mode: int, sha: bytes) -> bytes:
+        new_tree = Tree()
+        if tree_id:
+            for item in self.repo[tree_id].items():
+                new_tree.add(item.path, item.mode, item.sha)
+        name, _, rest = path.partition(b'/')
+        if rest:
+            sub_tree = new_tree[name][1] if name in new_tree else None
+            new_tree.add(name, 0o040000, self._replace(sub_tree, rest, mode, sha))
+        else:
+            new_tree.add(name, mode, sha)
+        self.repo.object_store.add_object(new_tree)
+        return new_tree.id
+
+
+class _GithubApiHandler(BaseHTTPRequestHandler):
+    server_state: GithubApiServer = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+    def _dispatch(self, method: str):
+        state = self.server_state
+        with state._lock:
+            state.requests.append((method, self.path))
+        if self.headers.get('Authorization') != f'token {state.token}':
+            return self._reply(401, {'message': 'Bad credentials'})
+
+        match = ROUTE.match(self.path.split('?')[0])
+        if not match:
+            return self._reply(404, {'message': 'Not Found'})
+        kind, rest = match.group('kind'), match.group('rest')
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        try:
+            if method == 'GET' and kind == 'ref' and rest.startswith('heads/'):
+                status, payload = state.get_ref(rest[len('heads/'):])
+            elif method == 'GET' and kind == 'commits':
+                status, payload = state.get_commit(rest)
+            elif method == 'GET' and kind == 'trees':
+                status, payload = state.get_tree(rest)
+            elif method == 'GET' and kind == 'blobs':
+                status, payload = state.get_blob(rest)
+            elif method == 'POST' and kind == 'blobs' and rest is None:
+                status, payload = state.create_blob(body)
+            elif method == 'POST' and kind == 'trees' and rest is None:
+                status, payload = state.create_tree(body)
+            elif method == 'POST' and kind == 'commits' and rest is None:
+                status, payload = state.create_commit(body)
+            elif method == 'PATCH' and kind == 'refs' and rest.startswith('heads/'):
+                status, payload = state.update_ref(rest[len('heads/'):], body)
+            else:
+                status, payload = 404, {'message': 'Not Found'}
+        except KeyError:
+            status, payload = 404, {'message': 'Not Found'}
+        self._reply(status, payload)
+
+    def _reply(self, status: int, payload: dict):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
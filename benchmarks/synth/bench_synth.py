@@ -0,0 +1,141 @@
+"""CDK synth benchmark: stack毎のsynth時間, peak memory, template size, resource数
+
+scenario毎に別processで1つのstackのみを作成してsynthする(AWS, Dockerへのアクセスなし)。
+SKIP_PIP=1でlayerはbuildせず、HostedZone.from_lookupとArgoCdのSecrets Managerはfixtureで差し替える。
+peak memoryはpython processとjsii(node) processの合計。
+--jobsでscenarioを並列に実行する(並列数が多いとCPUを取り合い、時間は悪化する)。
+
+    python -m benchmarks.synth.bench_synth
+    python -m benchmarks.synth.bench_synth --scenario eks-minimal --scenario eks-all-addons --jobs 2
+    python -m benchmarks.synth.bench_synth --check            # baselineより悪化した場合exit 1 (CI用)
+    python -m benchmarks.synth.bench_synth --update-baseline  # baseline.jsonを更新する
+"""
+import argparse
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks import baseline
+from benchmarks.baseline import directory_size
+from benchmarks.synth import fixtures
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# baselineと比較するmetric: (key, 許容する悪化率のargument名, 許容する絶対値のargument名)
+CHECKED_METRICS = [('construct_ms', 'tolerance', 'slack_ms'), ('synth_ms', 'tolerance', 'slack_ms'),
+                   ('total_ms', 'tolerance', 'slack_ms'), ('peak_rss_mb', 'size_tolerance', None),
+                   ('template_kb', 'size_tolerance', None), ('resources', 'size_tolerance', None)]
+
+
+def child_peak_rss_kb() -> int:
+    # jsii(node)のprocessはpythonの子process。終了前のためRUSAGE_CHILDRENでは取得できない
+    total = 0
+    for children in glob.glob(f'/proc/{os.getpid()}/task/*/children'):
+        with open(children) as f:
+            pids = f.read().split()
+        for pid in pids:
+            try:
+                with open(f'/proc/{pid}/status') as f:
+                    for line in f:
+                        if line.startswith('VmHWM:'):
+                            total += int(line.split()[1])
+            except OSError:
+                pass
+    return total
+
+
+def count_templates(out_dir: str) -> tuple:
+    # nested stack(EKSのkubectl provider等)のtemplateを含める
+    resources = 0
+    for path in glob.glob(os.path.join(out_dir, '*.template.json')):
+        with open(path) as f:
+            resources += len(json.load(f).get('Resources', {}))
+    return directory_size(out_dir, suffix='.template.json'), resources
+
+
+def worker(name: str) -> dict:
+    start = time.perf_counter()
+    import aws_cdk
+    from configration import apex_domain
+    # stack, constructのmoduleのimportを含む
+    spec = fixtures.scenario_spec(name)
+    fixtures.install_stubs()
+    imported = time.perf_counter()
+
+    out_dir = os.path.join(os.getcwd(), 'cdk.out')
+    app = aws_cdk.App(outdir=out_dir, context=fixtures.synth_context(apex_domain))
+    spec.stack_class(app, spec.name, env=aws_cdk.Environment(account=fixtures.ACCOUNT, region=fixtures.REGION),
+                     **spec.kwargs)
+    constructed = time.perf_counter()
+    app.synth()
+    synthesized = time.perf_counter()
+
+    template_bytes, resources = count_templates(out_dir)
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + child_peak_rss_kb()
+    return {
+        'import_ms': round((imported - start) * 1000, 1),
+        'construct_ms': round((constructed - imported) * 1000, 1),
+        'synth_ms': round((synthesized - constructed) * 1000, 1),
+        'total_ms': round((synthesized - start) * 1000, 1),
+        'peak_rss_mb': round(peak_rss_kb / 1024, 1),
+        'template_kb': round(template_bytes / 1024, 1),
+        'resources': resources,
+    }
+
+
+def run_scenario(name: str, repeat: int) -> dict:
+    """repeat回実行し、時間は最小値、peak memoryは最大値を返す"""
+    runs = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as work_dir:
+            fixtures.prepare_work_dir(work_dir)
+            env = dict(os.environ, SKIP_PIP='1', JSII_SILENCE_WARNING_DEPRECATED_NODE_VERSION='1',
+                       PYTHONPATH=os.pathsep.join(filter(None, [fixtures.REPOSITORY_ROOT,
+                                                                os.environ.get('PYTHONPATH')])))
+            process = subprocess.run([sys.executable, '-m', 'benchmarks.synth.bench_synth', '--worker', name],
+                                     cwd=work_dir, env=env, capture_output=True)
+            if process.returncode != 0:
+                raise RuntimeError(f'{name} synth failed:\n{process.stderr.decode("utf-8")[-2000:]}')
+            runs.append(json.loads(process.stdout.decode('utf-8').splitlines()[-1]))
+
+    result = {key: min(run[key] for run in runs) for key in ['import_ms', 'construct_ms', 'synth_ms', 'total_ms']}
+    result.update(peak_rss_mb=max(run['peak_rss_mb'] for run in runs),
+                  template_kb=runs[-1]['template_kb'], resources=runs[-1]['resources'])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=sorted(fixtures.SCENARIO_KINDS),
+                        help='実行するscenario(複数指定可)。省略時は全scenario')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='並列に実行するscenario数')
+    parser.add_argument('--repeat', type=int, default=1, help='scenario毎の実行回数(時間は最小値)')
+    baseline.add_arguments(parser, BASELINE_PATH, slack_ms=500, size_metrics='peak memory, template size, resource数')
+    parser.add_argument('--worker', metavar='SCENARIO', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(worker(args.worker)))
+        return
+
+    names = args.scenario or list(fixtures.SCENARIO_KINDS)
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        results = dict(zip(names, executor.map(lambda name: run_scenario(name, args.repeat), names)))
+
+    print(f'{"scenario":<16}{"import_ms":>11}{"construct_ms":>14}{"synth_ms":>10}{"total_ms":>10}'
+          f'{"peak_rss_mb":>13}{"template_kb":>13}{"resources":>11}')
+    for name, result in results.items():
+        print(f'{name:<16}{result["import_ms"]:>11.1f}{result["construct_ms"]:>14.1f}{result["synth_ms"]:>10.1f}'
+              f'{result["total_ms"]:>10.1f}{result["peak_rss_mb"]:>13.1f}{result["template_kb"]:>13.1f}'
+              f'{result["resources"]:>11}')
+
+    baseline.check_or_update(args, results, CHECKED_METRICS)
+
+
+if __name__ == '__main__':
+    main()
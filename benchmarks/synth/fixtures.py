@@ -0,0 +1,76 @@
+"""synth benchmark用のfixture: scenario毎のstack, offlineでsynthするためのcontextとstand-in
+
+stackの引数はstacks.stack_graph.plan_stacksでconfigrationから作成する(app.pyと同じ)。
+AWSへのアクセスが必要な箇所は以下で差し替える。
+  - HostedZone.from_lookup: cdk.context.jsonと同じ形式のcontextを事前に設定する
+  - ArgoCdのadmin password: Secrets Manager(boto3)から取得してbcrypt hashするため、固定のhashを返す
+    (hashはsaltにより毎回異なり、templateの内容が実行毎に変わるため)
+"""
+import copy
+import os
+
+ACCOUNT = '123456789012'
+REGION = 'ap-northeast-1'
+# 'bench-password'のbcrypt hash
+ARGOCD_ADMIN_PASSWORD_HASH = '$2b$04$Uj0jcSG5uhOmYinW2ofztehag/z6ximfub6WugJQ0MwNK4ABsYtX.'
+HOSTED_ZONE_ID = 'Z0000000000BENCH'
+ADDON_FLAGS = ['addon_cwmetrics_enable', 'addon_cwlogs_enable', 'addon_awslbclt_enable',
+               'addon_extdns_enable', 'addon_argocd_enable']
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# scenario名: StackSpecのkind (eks-minimalは全addonを無効にしたcluster)
+SCENARIO_KINDS = {
+    'vpc': 'vpc',
+    'stateful': 'stateful',
+    'eks-minimal': 'cluster',
+    'eks-all-addons': 'cluster',
+    'flask-app': 'app',
+    'codepipeline': 'pipeline',
+}
+
+
+def dev_specs() -> dict:
+    """devのcluster-1のStackSpecを {kind: StackSpec} で返す"""
+    # aws_cdkのimport時間をworkerで計測するため、stackのmoduleはここでimportする
+    from stacks.stack_graph import plan_stacks
+    from configration import codepipeline_stack_configuration
+    from configration import dev_env_configuration
+    specs = plan_stacks(codepipeline_stack_configuration, [{'config': dev_env_configuration, 'clusters': [1]}])
+    return {spec.kind: spec for spec in specs}
+
+
+def without_addons(spec):
+    kwargs = copy.deepcopy(spec.kwargs)
+    for flag in ADDON_FLAGS:
+        kwargs['cluster_config'][flag] = False
+    return spec._replace(kwargs=kwargs)
+
+
+def scenario_spec(name: str):
+    specs = dev_specs()
+    if name == 'eks-minimal':
+        return without_addons(specs['cluster'])
+    return specs[SCENARIO_KINDS[name]]
+
+
+def synth_context(apex_domain: str) -> dict:
+    return {
+        # Docker bundlingを行わない
+        'aws:cdk:bundling-stacks': [],
+        f'hosted-zone:account={ACCOUNT}:domainName={apex_domain}:region={REGION}': {
+            'Id': f'/hostedzone/{HOSTED_ZONE_ID}', 'Name': f'{apex_domain}.'},
+    }
+
+
+def install_stubs():
+    from _constructs.eks.eks_addon_argocd import ArgoCd
+    ArgoCd.get_argocd_admin_password = lambda self: ARGOCD_ADMIN_PASSWORD_HASH
+
+
+def prepare_work_dir(work_dir: str):
+    """stackはrepositoryのrootからの相対pathでassetを参照するため、work_dirにlinkを作成する
+
+    layer_pip/はSKIP_PIPでbuildしないため空のdirectoryとする(repositoryのlayer_pip/は使用しない)。
+    """
+    os.symlink(os.path.join(REPOSITORY_ROOT, '_constructs'), os.path.join(work_dir, '_constructs'))
+    os.makedirs(os.path.join(work_dir, 'layer_pip', 'python'))
@@ -12,8 +12,10 @@ dev_env_configuration = {
         'flask-stateful': {},       # AppのStateful AWS Resource
         'cluster-1': {},            # BlueGreen switching用EKS Cluster
         'cluster-2': {},            # BlueGreen switching用EKS Cluster
+        ...                         # 'cluster-N': N個のclusterを1つのALBの後ろで稼働できる
         'flask-1': {},              # BlueGreen switching用App
         'flask-2': {},              # BlueGreen switching用App
+        ...                         # 'flask-N': 'cluster-N'毎に必要
 }
 
 # --- stg environment---
@@ -22,8 +24,10 @@ stg_env_configuration = {
         'flask-stateful': {},       # AppのStateful AWS Resource
         'cluster-1': {},            # BlueGreen switching用EKS Cluster
         'cluster-2': {},            # BlueGreen switching用EKS Cluster
+        ...                         # 'cluster-N': N個のclusterを1つのALBの後ろで稼働できる
         'flask-1': {},              # BlueGreen switching用App
         'flask-2': {},              # BlueGreen switching用App
+        ...                         # 'flask-N': 'cluster-N'毎に必要
 }
 
 # --- prd environment---
@@ -32,8 +36,10 @@ prd_env_configuration = {
         'flask-stateful': {},       # AppのStateful AWS Resource
         'cluster-1': {},            # BlueGreen switching用EKS Cluster
         'cluster-2': {},            # BlueGreen switching用EKS Cluster
+        ...                         # 'cluster-N': N個のclusterを1つのALBの後ろで稼働できる
         'flask-1': {},              # BlueGreen switching用App
         'flask-2': {},              # BlueGreen switching用App
+        ...                         # 'flask-N': 'cluster-N'毎に必要
 }
 
 """
@@ -55,6 +61,15 @@ codepipeline_stack_configuration = {
     'github_owner': github_owner,
     'github_cd_repository': cd_repository,
     'github_cd_target_manifest': 'deployment.yaml',
+    # full: 全history clone, sparse: depth=1で対象branch/manifestのみ, memory: sparseと同じ対象をmemory上にfetch(/tmp不使用)
+    'github_cd_clone_mode': 'sparse',
+    'github_cd_backend': 'git',  # git: clone/commit/push, api: GitHub Git Data API(cloneしない)
+    # 0より大きい場合、window(秒)内に続いたbuildのtag updateをまとめ、(repository, branch, manifest)毎に最新のtagのみcommitする
+    'github_cd_coalesce_window_seconds': 0,
+    # manifest_update functionのimport時間(cold start)のbudget。cdk synth -c import_profile=true で確認する
+    # Tracer(aws_xray_sdk.core, botocore), PyYAMLはinit phaseでimportするため含める。
+    # 実測(median): 全体581ms, うちaws_xray_sdk.core 383ms, yaml 20ms (実行環境のnoiseに約20%の余裕を持たせる)
+    'tag_update_import_budget_ms': 700,
     'ecr_repository_name': 'flask'
 }
 
@@ -65,10 +80,10 @@ dev_env_configuration = {
         'cidr': '10.11.0.0/16',
         'azs': 3,    # aws_ec2.Vpc.from_vpc_attributesを使用する際、３つのAZがあることを前提とする
         'nat_gateways': 1,
-        'cluster_name_list': ['dev-1', 'dev-2']  # SubnetにEKS用Tag付加
     },
     'cluster-1': {
         'name': 'dev-1',
+        'weight': 100,  # ALBのtrafficの割合(%)。環境の全clusterの合計を100とする (Blue)
         'version': '1.21',
         'instance_type': 't3.large',
         'addon_cwmetrics_enable': True,
@@ -83,6 +98,7 @@ dev_env_configuration = {
     },
     'cluster-2': {
         'name': 'dev-2',
+        'weight': 0,  # ALBのtrafficの割合(%)。環境の全clusterの合計を100とする (Green)
         'version': '1.22',
         'instance_type': 't3.large',
         'addon_cwmetrics_enable': True,
@@ -102,7 +118,6 @@ dev_env_configuration = {
         'wildcard_cert_arn': wildcard_cert_arn,
         'apex_domain': apex_domain,
         'sub_domain': f'flask-dev.{apex_domain}',
-        'cluster_list': ['dev-1', 'dev-2']
     },
     'flask-1': {
         'env': 'dev',
@@ -133,10 +148,10 @@ prd_env_configuration = {
         'cidr': '10.12.0.0/16',
         'azs': 3,  # aws_ec2.Vpc.from_vpc_attributesを使用する際、３つのAZがあることを前提とする
         'nat_gateways': 1,
-        'cluster_name_list': ['prd-1', 'prd-2']  # SubnetにEKS用Tag付加
     },
     'cluster-1': {
         'name': 'prd-1',
+        'weight': 100,  # ALBのtrafficの割合(%)。環境の全clusterの合計を100とする (Blue)
         'version': '1.21',
         'instance_type': 't3.large',
         'addon_cwmetrics_enable': True,
@@ -151,6 +166,7 @@ prd_env_configuration = {
     },
     'cluster-2': {
         'name': 'prd-2',
+        'weight': 0,  # ALBのtrafficの割合(%)。環境の全clusterの合計を100とする (Green)
         'version': '1.22',
         'instance_type': 't3.large',
         'addon_cwmetrics_enable': True,
@@ -170,7 +186,6 @@ prd_env_configuration = {
         'wildcard_cert_arn': wildcard_cert_arn,
         'apex_domain': apex_domain,
         'sub_domain': f'flask-prd.{apex_domain}',
-        'cluster_list': ['prd-1', 'prd-2']  # BlueGreen Switching用にprd-2がなくても作成する。
     },
     'flask-1': {
         'env': 'prd',
@@ -193,3 +208,11 @@ prd_env_configuration = {
         'repo_branch': 'prd',
     },
 }
+
+# app.pyで作成する環境とcluster (clusters: 環境のconfigurationの'cluster-N', 'flask-N'のN)
+# 環境間、cluster間には依存関係を設定しないため並列にdeployできる
+# subnetのtag, ALBのtarget groupはclustersに含まれないものを含め、環境の全'cluster-N'に作成する
+deploy_environments = [
+    {'config': dev_env_configuration, 'clusters': [1, 2]},
+    {'config': prd_env_configuration, 'clusters': [1]},  # prd-2はBlueGreen切り替え時に追加する
+]
@@ -0,0 +1,287 @@
+"""cdk.out(synth結果)からdeployのcritical pathと各stack/resourceのslackを求める
+
+  stack間: manifest.jsonのstackの依存関係 (app.pyのadd_dependency、stack間の参照)
+  stack内: templateのDependsOn, Ref, Fn::GetAtt, Fn::Sub
+           (EksCluster.deploy_addonsのaddonの直列の依存関係はnode.add_dependencyによりDependsOnとなる)
+  nested stack: nested stackのtemplateのcritical pathをresourceの時間とする
+
+resourceの時間はresource typeの見積もり(DEFAULT_SECONDS)とし、
+過去のCloudFormation eventのJSON(aws cloudformation describe-stack-events の出力)で補正できる。
+stackのresourceは、依存するstackが完了してから作成を開始するものとする。
+
+    cdk synth
+    python -m stacks.cdk_out_analysis cdk.out
+    python -m stacks.cdk_out_analysis cdk.out --events events/*.json --resources
+"""
+import argparse
+import collections
+import datetime
+import glob
+import json
+import os
+import re
+import statistics
+
+# resource typeのdeploy時間の見積もり(秒)。未定義のtypeはCustom Resource(Lambda)とそれ以外で分ける
+DEFAULT_SECONDS = {
+    'Custom::AWSCDK-EKS-Cluster': 720,
+    'Custom::AWSCDK-EKS-FargateProfile': 180,
+    'Custom::AWSCDK-EKS-HelmChart': 120,
+    'Custom::AWSCDK-EKS-KubernetesResource': 30,
+    'Custom::AWSCDK-EKS-KubernetesObjectValue': 30,
+    'Custom::AWSCDKOpenIdConnectProvider': 15,
+    'Custom::AWSCDKCfnJson': 5,
+    'AWS::EKS::Nodegroup': 240,
+    'AWS::EC2::NatGateway': 120,
+    'AWS::EC2::VPCGatewayAttachment': 20,
+    'AWS::ElasticLoadBalancingV2::LoadBalancer': 180,
+    'AWS::Route53::RecordSet': 60,
+    'AWS::KMS::Key': 60,
+    'AWS::IAM::Role': 20,
+    'AWS::IAM::Policy': 20,
+    'AWS::DynamoDB::Table': 20,
+    'AWS::S3::Bucket': 20,
+    'AWS::Lambda::LayerVersion': 15,
+    'AWS::CodePipeline::Pipeline': 15,
+}
+CUSTOM_RESOURCE_SECONDS = 60
+OTHER_SECONDS = 10
+# changesetの作成、stackの完了(cleanup)等、resource以外にstack毎にかかる時間
+STACK_OVERHEAD_SECONDS = 30
+NESTED_STACK_TYPE = 'AWS::CloudFormation::Stack'
+
+# name: stack名(stackの完了)、またはstack名/logical id。seconds: 見積もり(秒)。depends_on: 先に完了するnode名
+Node = collections.namedtuple('Node', ['name', 'stack', 'type', 'seconds', 'depends_on'])
+Timing = collections.namedtuple('Timing', ['start', 'finish', 'slack'])
+
+
+def estimate_seconds(resource_type: str, estimates: dict) -> float:
+    if resource_type in estimates:
+        return estimates[resource_type]
+    return CUSTOM_RESOURCE_SECONDS if resource_type.startswith('Custom::') else OTHER_SECONDS
+
+
+def references(value) -> set:
+    """Ref, Fn::GetAtt, Fn::Sub で参照しているlogical id (Parameter, pseudo parameterを含む)"""
+    found = set()
+    if isinstance(value, list):
+        for item in value:
+            found |= references(item)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            if key == 'Ref' and isinstance(item, str):
+                found.add(item)
+            elif key == 'Fn::GetAtt':
+                found.add(item[0] if isinstance(item, list) else item.split('.', 1)[0])
+            elif key == 'Fn::Sub':
+                template = item[0] if isinstance(item, list) else item
+                found |= {name.split('.', 1)[0] for name in re.findall(r'\$\{([^!}][^}]*)\}', template)}
+                if isinstance(item, list):
+                    found |= references(item[1])
+            else:
+                found |= references(item)
+    return found
+
+
+def resource_dependencies(template: dict) -> dict:
+    """{logical id: [依存するlogical id]} (template内のresourceのみ)"""
+    resources = template.get('Resources', {})
+    dependencies = {}
+    for logical_id, resource in resources.items():
+        depends_on = resource.get('DependsOn', [])
+        depends_on = [depends_on] if isinstance(depends_on, str) else list(depends_on)
+        refs = references({key: value for key, value in resource.items() if key != 'DependsOn'})
+        dependencies[logical_id] = sorted({name for name in depends_on + list(refs)
+                                           if name in resources and name != logical_id})
+    return dependencies
+
+
+def read_json(path: str):
+    with open(path) as f:
+        return json.load(f)
+
+
+def nested_templates(out_dir: str) -> dict:
+    """{assetのobject key: nested stackのtemplate file}。TemplateURLのobject keyからtemplateを探す"""
+    templates = {}
+    for path in glob.glob(os.path.join(out_dir, '*.assets.json')):
+        for asset in read_json(path).get('files', {}).values():
+            if not asset['source']['path'].endswith('.nested.template.json'):
+                continue
+            for destination in asset['destinations'].values():
+                templates[destination['objectKey']] = os.path.join(out_dir, asset['source']['path'])
+    return templates
+
+
+def template_nodes(stack: str, template: dict, estimates: dict, nested: dict, prerequisites: list) -> list:
+    """stackのresourceとstackの完了のnode。resourceはprerequisites(依存するstackの完了)の後に開始する"""
+    nodes = []
+    resources = template.get('Resources', {})
+    for logical_id, depends_on in resource_dependencies(template).items():
+        resource_type = resources[logical_id]['Type']
+        seconds = estimate_seconds(resource_type, estimates)
+        if resource_type == NESTED_STACK_TYPE:
+            url = json.dumps(resources[logical_id].get('Properties', {}).get('TemplateURL'))
+            for object_key, path in nested.items():
+                if object_key in url:
+                    nested_nodes = template_nodes(logical_id, read_json(path), estimates, nested, [])
+                    _, seconds = critical_path(nested_nodes, schedule(nested_nodes))
+                    break
+        nodes.append(Node(f'{stack}/{logical_id}', stack, resource_type, seconds,
+                          [f'{stack}/{name}' for name in depends_on] + prerequisites))
+    nodes.append(Node(stack, stack, NESTED_STACK_TYPE, STACK_OVERHEAD_SECONDS, [node.name for node in nodes]))
+    return nodes
+
+
+def load_cdk_out(out_dir: str, estimates: dict = None) -> list:
+    """cdk.outの全stackのnodeを返す"""
+    estimates = estimates or DEFAULT_SECONDS
+    manifest = read_json(os.path.join(out_dir, 'manifest.json'))
+    stacks = {name: artifact for name, artifact in manifest['artifacts'].items()
+              if artifact['type'] == 'aws:cloudformation:stack'}
+    nested = nested_templates(out_dir)
+    nodes = []
+    for name, artifact in stacks.items():
+        prerequisites = [dependency for dependency in artifact.get('dependencies', []) if dependency in stacks]
+        template = read_json(os.path.join(out_dir, artifact['properties']['templateFile']))
+        nodes += template_nodes(name, template, estimates, nested, prerequisites)
+    return nodes
+
+
+def schedule(nodes: list) -> dict:
+    """{node名: Timing}。依存するnodeが完了した時点で開始する場合の開始/完了時刻と、全体を遅らせずに遅延できる時間"""
+    by_name = {node.name: node for node in nodes}
+    order, remaining = [], {node.name: set(node.depends_on) for node in nodes}
+    ready = [name for name, depends_on in remaining.items() if not depends_on]
+    dependents = collections.defaultdict(list)
+    for node in nodes:
+        for dependency in node.depends_on:
+            dependents[dependency].append(node.name)
+    while ready:
+        name = ready.pop()
+        order.append(name)
+        for dependent in dependents[name]:
+            remaining[dependent].discard(name)
+            if not remaining[dependent]:
+                ready.append(dependent)
+    if len(order) != len(nodes):
+        raise ValueError(f'dependency cycle: {sorted(set(by_name) - set(order))[:5]}')
+
+    start, finish = {}, {}
+    for name in order:
+        start[name] = max([finish[dependency] for dependency in by_name[name].depends_on] + [0])
+        finish[name] = start[name] + by_name[name].seconds
+    total = max(finish.values()) if finish else 0
+    latest_start = {}
+    for name in reversed(order):
+        latest_finish = min([latest_start[dependent] for dependent in dependents[name]] + [total])
+        latest_start[name] = latest_finish - by_name[name].seconds
+    return {name: Timing(start[name], finish[name], latest_start[name] - start[name]) for name in order}
+
+
+def critical_path(nodes: list, timings: dict) -> tuple:
+    """完了が最も遅いnodeまでの依存関係の経路と、その時間(秒)を返す"""
+    if not timings:
+        return [], 0
+    by_name = {node.name: node for node in nodes}
+    name = max(timings, key=lambda key: timings[key].finish)
+    total = timings[name].finish
+    path = [name]
+    while by_name[path[-1]].depends_on:
+        path.append(max(by_name[path[-1]].depends_on, key=lambda key: timings[key].finish))
+    return list(reversed(path)), total
+
+
+def parse_timestamp(value: str) -> datetime.datetime:
+    # 2022-07-20T10:00:00.123000+00:00, 2022-07-20T10:00:00Z
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def measured_seconds(events: list) -> dict:
+    """CloudFormation eventから {resource type: [作成/更新にかかった秒]} を返す"""
+    measured = collections.defaultdict(list)
+    started = {}
+    for event in sorted(events, key=lambda e: parse_timestamp(e['Timestamp'])):
+        resource_type = event.get('ResourceType')
+        # stack自体とnested stackはresourceから求めるため除く
+        if resource_type == NESTED_STACK_TYPE:
+            continue
+        key = (event.get('StackName'), event['LogicalResourceId'])
+        status = event['ResourceStatus']
+        if status in ('CREATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS'):
+            started.setdefault(key, parse_timestamp(event['Timestamp']))
+        elif status in ('CREATE_COMPLETE', 'UPDATE_COMPLETE') and key in started:
+            measured[resource_type].append((parse_timestamp(event['Timestamp']) - started.pop(key)).total_seconds())
+        elif status.endswith('_FAILED'):
+            started.pop(key, None)
+    return measured
+
+
+def calibrate(event_files: list, estimates: dict = None) -> dict:
+    """event(describe-stack-eventsの出力、またはeventのlist)のJSON fileから、typeの見積もりを中央値で置き換える"""
+    measured = collections.defaultdict(list)
+    for path in event_files:
+        events = read_json(path)
+        events = events['StackEvents'] if isinstance(events, dict) else events
+        for resource_type, seconds in measured_seconds(events).items():
+            measured[resource_type] += seconds
+    calibrated = dict(estimates or DEFAULT_SECONDS)
+    calibrated.update({resource_type: statistics.median(seconds) for resource_type, seconds in measured.items()})
+    return calibrated
+
+
+def minutes(seconds: float) -> str:
+    return f'{seconds / 60:.1f}m'
+
+
+def format_report(nodes: list, timings: dict, resources: bool = False) -> str:
+    path, total = critical_path(nodes, timings)
+    by_name = {node.name: node for node in nodes}
+    stacks = [node for node in nodes if node.name == node.stack]
+    serial = sum(node.seconds for node in nodes)
+    lines = [f'critical path (estimated {minutes(total)}, serial {minutes(serial)}):']
+    for name in path:
+        lines.append(f'  {minutes(timings[name].start):>7} +{minutes(by_name[name].seconds):<7} {name} '
+                     f'({by_name[name].type})')
+
+    # stackの開始は最初のresourceの開始、完了/slackはstackの完了のnode
+    started = {}
+    for node in nodes:
+        started[node.stack] = min(started.get(node.stack, timings[node.name].start), timings[node.name].start)
+    lines += ['', f'{"stack":<40}{"start":>8}{"finish":>8}{"slack":>8}']
+    for node in sorted(stacks, key=lambda n: (started[n.name], n.name)):
+        timing = timings[node.name]
+        lines.append(f'{node.name:<40}{minutes(started[node.name]):>8}{minutes(timing.finish):>8}'
+                     f'{minutes(timing.slack):>8}')
+
+    if resources:
+        lines += ['', f'{"resource":<80} {"type":<42}{"start":>8}{"finish":>8}{"slack":>8}']
+        for node in sorted(nodes, key=lambda n: (timings[n.name].slack, timings[n.name].start)):
+            if node in stacks:
+                continue
+            timing = timings[node.name]
+            lines.append(f'{node.name:<80} {node.type:<42}{minutes(timing.start):>8}{minutes(timing.finish):>8}'
+                         f'{minutes(timing.slack):>8}')
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('out_dir', nargs='?', default='cdk.out')
+    parser.add_argument('--events', nargs='*', default=[],
+                        help='見積もりを補正するCloudFormation eventのJSON (describe-stack-eventsの出力)')
+    parser.add_argument('--resources', action='store_true', help='全resourceの開始/完了/slackを出力する')
+    parser.add_argument('--json', action='store_true', help='全nodeの開始/完了/slack(秒)をJSONで出力する')
+    args = parser.parse_args()
+
+    nodes = load_cdk_out(args.out_dir, calibrate(args.events))
+    timings = schedule(nodes)
+    if args.json:
+        print(json.dumps({node.name: dict(timings[node.name]._asdict(), type=node.type, seconds=node.seconds)
+                          for node in nodes}, indent=2))
+        return
+    print(format_report(nodes, timings, args.resources), end='')
+
+
+if __name__ == '__main__':
+    main()
@@ -210,13 +210,11 @@ class FlaskAppStack(Stack):
            see more information:
            https://kubernetes-sigs.github.io/aws-load-balancer-controller/v2.4/guide/targetgroupbinding/targetgroupbinding/
 
-           targetGroupARN: ALBのTargetGroup, 環境毎にBule, Green用に２つ作成
+           targetGroupARN: ALBのTargetGroup, 環境の'cluster-N'毎に作成
             - ALB-TargetGroupArn-dev-1
             - ALB-TargetGroupArn-dev-2
-            - ALB-TargetGroupArn-stg-1
-            - ALB-TargetGroupArn-stg-2
             - ALB-TargetGroupArn-prd-1
-            - ALB-TargetGroupArn-prd-2
+            - ALB-TargetGroupArn-<cluster name> ...
         """
 
         service_name = self.flask_conf['name']
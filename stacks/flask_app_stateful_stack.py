@@ -17,11 +17,13 @@ class FlaskAppStatefulStack(Stack):
             construct_id: str,
             vpc_config: dict,
             flask_stateful_config: dict,
+            cluster_configs: dict,
             **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         self.vpc_conf = vpc_config
         self.flask_stateful_conf = flask_stateful_config
+        self.cluster_confs = cluster_configs  # {N: 'cluster-N'のconfiguration}
 
         self.vpc = self.get_vpc_cross_stack()
 
@@ -104,30 +106,37 @@ class FlaskAppStatefulStack(Stack):
             timeout=aws_cdk.Duration.seconds(5)
         )
 
-        # Cluster BlueGreen用に2つのTargetGroupを作成する
+        # Cluster毎にTargetGroupを作成する(BlueGreen切り替え、複数clusterでのscale out)
         # ALBの場合、Service typeはClusterIP
         # targets: TargetGroupBindingでTargetを登録するため必要なし
-        target_group_1 = aws_elasticloadbalancingv2.ApplicationTargetGroup(
-            self,
-            'BlueGreenTargetGroup-1',
-            target_group_name=f'blue-green-tg-1-{self.flask_stateful_conf["env"]}',
-            target_type=aws_elasticloadbalancingv2.TargetType.IP,  # k8s service type ClusterIP
-            protocol=aws_elasticloadbalancingv2.ApplicationProtocol.HTTP,
-            port=80,
-            vpc=self.vpc,
-            health_check=health_check
-        )
+        target_groups = {}
+        for number, cluster_conf in self.cluster_confs.items():
+            target_groups[number] = aws_elasticloadbalancingv2.ApplicationTargetGroup(
+                self,
+                f'BlueGreenTargetGroup-{number}',
+                target_group_name=f'blue-green-tg-{number}-{self.flask_stateful_conf["env"]}',
+                target_type=aws_elasticloadbalancingv2.TargetType.IP,  # k8s service type ClusterIP
+                protocol=aws_elasticloadbalancingv2.ApplicationProtocol.HTTP,
+                port=80,
+                vpc=self.vpc,
+                health_check=health_check
+            )
 
-        target_group_2 = aws_elasticloadbalancingv2.ApplicationTargetGroup(
-            self,
-            'BlueGreenTargetGroup-2',
-            target_group_name=f'blue-green-tg-2-{self.flask_stateful_conf["env"]}',
-            target_type=aws_elasticloadbalancingv2.TargetType.IP,  # k8s service type ClusterIP
-            protocol=aws_elasticloadbalancingv2.ApplicationProtocol.HTTP,
-            port=80,
-            vpc=self.vpc,
-            health_check=health_check
-        )
+            # Cross Stack Reference for TargetGroupBinding manifest
+            aws_cdk.CfnOutput(
+                self,
+                id=f'CfnOutputTargetGroupArn-{number}',
+                value=target_groups[number].target_group_arn,
+                description="ALB Target Group for cluster blue green",
+                export_name=f'ALB-TargetGroupArn-{cluster_conf["name"]}',
+                # ALB-TargetGroupArn-dev-1, ALB-TargetGroupArn-prd-1, ...
+            )
+
+        # Blue Green Traffic switching: configrationの'cluster-N'の'weight'(合計100)で振り分ける
+        weighted_target_groups = [
+            {'targetGroup': target_groups[number], 'weight': cluster_conf['weight']}
+            for number, cluster_conf in self.cluster_confs.items()
+        ]
 
         # wildcard certification for ALB Listener
         cert = aws_certificatemanager.Certificate.from_certificate_arn(
@@ -142,9 +151,7 @@ class FlaskAppStatefulStack(Stack):
             'Listener443',
             port=443,
             protocol=aws_elasticloadbalancingv2.ApplicationProtocol.HTTPS,
-            default_action=aws_elasticloadbalancingv2.ListenerAction.weighted_forward([
-                {'targetGroup': target_group_1, 'weight': 100},
-            ]),
+            default_action=aws_elasticloadbalancingv2.ListenerAction.weighted_forward(weighted_target_groups),
             certificates=[cert]  # Certification
         )
 
@@ -154,16 +161,7 @@ class FlaskAppStatefulStack(Stack):
             'ApplicationListenerRule',
             listener=https_listener,
             priority=1,  # Priority of the rule.
-            # Todo: --------- ↓ Blue Green Traffic switching ---------
-            action=aws_elasticloadbalancingv2.ListenerAction.weighted_forward([
-                    {'targetGroup': target_group_1, 'weight': 100},  # Blue
-                    {'targetGroup': target_group_2, 'weight': 0},    # Green
-                 ]),
-            # action=aws_elasticloadbalancingv2.ListenerAction.weighted_forward([
-            #         {'targetGroup': target_group_1, 'weight': 0},      # Blue
-            #         {'targetGroup': target_group_2, 'weight': 100},    # Green
-            #      ]),
-            # Todo: --------- ↑ Blue Green Traffic switching ---------
+            action=aws_elasticloadbalancingv2.ListenerAction.weighted_forward(weighted_target_groups),
             conditions=[
                 aws_elasticloadbalancingv2.ListenerCondition.path_patterns(['/*']),
                 aws_elasticloadbalancingv2.ListenerCondition.host_headers([
@@ -173,24 +171,6 @@ class FlaskAppStatefulStack(Stack):
             ]
         )
 
-        # Cross Stack Reference for TargetGroupBinding manifest
-        aws_cdk.CfnOutput(
-            self,
-            id='CfnOutputTargetGroupArn-1',
-            value=target_group_1.target_group_arn,
-            description="ALB Target Group for cluster blue green",
-            export_name=f'ALB-TargetGroupArn-{self.flask_stateful_conf["cluster_list"][0]}',
-            # ALB-TargetGroupArn-dev-1, ALB-TargetGroupArn-prd-1, ...
-        )
-        aws_cdk.CfnOutput(
-            self,
-            id='CfnOutputTargetGroupArn-2',
-            value=target_group_2.target_group_arn,
-            description="ALB Target Group for cluster blue green",
-            export_name=f'ALB-TargetGroupArn-{self.flask_stateful_conf["cluster_list"][1]}',
-            # ALB-TargetGroupArn-dev-2, ALB-TargetGroupArn-prd-2, ...
-        )
-
     def register_subdomain(self, alb: aws_elasticloadbalancingv2.ApplicationLoadBalancer):
         # Route53 Hosted ZoneにApplicationのA Recordを追加する。
         # 既にA Recordが存在する場合はエラーとなるため、手動で削除する必要がある。
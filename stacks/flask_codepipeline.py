@@ -109,6 +109,9 @@ class CodepipelineStack(Stack):
             'github_cd_branch': 'dev',
             'github_cd_manifest': config['github_cd_target_manifest'],
             'github_token_name': config['github_token_name'],
+            'github_clone_mode': config['github_cd_clone_mode'],
+            'github_backend': config['github_cd_backend'],
+            'coalesce_window_seconds': config['github_cd_coalesce_window_seconds'],
         }
         tag_update = TagUpdateAction(
             self,
@@ -149,6 +152,9 @@ class CodepipelineStack(Stack):
             'github_cd_branch': 'prd',
             'github_cd_manifest': config['github_cd_target_manifest'],
             'github_token_name': config['github_token_name'],
+            'github_clone_mode': config['github_cd_clone_mode'],
+            'github_backend': config['github_cd_backend'],
+            'coalesce_window_seconds': config['github_cd_coalesce_window_seconds'],
         }
         tag_update = TagUpdateAction(
             self,
@@ -0,0 +1,219 @@
+"""configrationからstackを作成し、環境/cluster内の依存関係のみを設定する
+
+  VPC -> Stateful -> EKS Cluster -> Flask App  (環境毎、cluster毎)
+  CodePipeline                                  (依存なし)
+
+環境のclusterは'cluster-N'(と'flask-N')のentryで、N個のclusterを1つのALBの後ろで稼働できる。
+cluster毎にALBのtarget groupを作成し、'cluster-N'の'weight'(合計100)でtrafficを振り分ける。
+
+環境間、cluster間には依存関係を設定しないため、`cdk deploy --all --concurrency N` で並列にdeployされる。
+
+CDK contextで作成するstackを選択できる(選択されていないstackは作成しない)。
+stack間の参照はFn.import_valueのexport名のため、選択されていないstackのexportも参照できる。
+    cdk diff -c envs=dev                  # devの全stack
+    cdk diff -c clusters=dev-2            # dev-2のEKS Cluster, Flask Appのみ
+    cdk diff -c envs=dev -c clusters=dev-2  # devのVPC, Stateful + dev-2
+    cdk diff -c envs=pipeline             # CodePipelineのみ
+
+    python -m stacks.stack_graph [--envs dev] [--clusters dev-2]
+        # dry-run: stackを作成せずにdeployの順序とcritical pathを出力する
+"""
+import argparse
+import collections
+from typing import Optional
+from stacks.eks_stack import EksClusterStack
+from stacks.flask_app_stateful_stack import FlaskAppStatefulStack
+from stacks.flask_app_stack import FlaskAppStack
+from stacks.vpc_stack import VpcStack
+from stacks.flask_codepipeline import CodepipelineStack
+
+# name: stack名(construct id), kind: ESTIMATED_MINUTESのkey, depends_on: 依存するstack名
+# environment: 環境名(CodePipelineは'pipeline'), cluster: cluster名(環境で共通のstackはNone)
+StackSpec = collections.namedtuple('StackSpec', ['name', 'kind', 'depends_on', 'stack_class', 'kwargs',
+                                                 'environment', 'cluster'])
+PIPELINE_ENVIRONMENT = 'pipeline'
+
+# dry-runでcritical pathを求める際のdeploy時間の見積もり(分)
+ESTIMATED_MINUTES = {
+    'pipeline': 4,
+    'vpc': 4,
+    'stateful': 6,
+    'cluster': 25,
+    'app': 10,
+}
+
+
+# ALBのweighted forwardに指定できるtarget group数の上限
+MAX_WEIGHTED_TARGET_GROUPS = 5
+
+
+def environment_clusters(config: dict) -> dict:
+    """環境のconfigurationの全cluster {N: 'cluster-N'のconfiguration} (deployしないclusterを含む)"""
+    clusters = {int(key.split('-', 1)[1]): value for key, value in config.items() if key.startswith('cluster-')}
+    return dict(sorted(clusters.items()))
+
+
+def validate_environment(config: dict, deploy_clusters: list):
+    """cluster毎のflask-N, ALBのweight(合計100)、deployするclusterがconfigurationにあることを確認する"""
+    name = config['vpc']['name']
+    clusters = environment_clusters(config)
+    errors = []
+    for number in clusters:
+        if f'flask-{number}' not in config:
+            errors.append(f'flask-{number} is missing for cluster-{number}')
+    for number in deploy_clusters:
+        if number not in clusters:
+            errors.append(f'cluster-{number} is not configured')
+    weights = {number: cluster.get('weight', 0) for number, cluster in clusters.items()}
+    if any(weight < 0 for weight in weights.values()):
+        errors.append(f'weights must not be negative: {weights}')
+    if sum(weights.values()) != 100:
+        errors.append(f'weights must add up to 100: {weights}')
+    if len(clusters) > MAX_WEIGHTED_TARGET_GROUPS:
+        errors.append(f'{len(clusters)} clusters exceed {MAX_WEIGHTED_TARGET_GROUPS} target groups of ALB')
+    if errors:
+        raise ValueError(f'{name}: ' + ', '.join(errors))
+
+
+def plan_stacks(codepipeline_config: dict, deploy_environments: list) -> list:
+    """stackの作成順(依存するstackが先)のStackSpecを返す"""
+    specs = [StackSpec(f'CodepipelineStack-{codepipeline_config["ecr_repository_name"]}', 'pipeline', [],
+                       CodepipelineStack, {'config': codepipeline_config}, PIPELINE_ENVIRONMENT, None)]
+
+    for environment in deploy_environments:
+        config = environment['config']
+        validate_environment(config, environment['clusters'])
+        name = config['vpc']['name']  # dev, prd
+        # subnetのtag, ALBのtarget groupはdeployしないclusterを含む環境の全clusterに作成する(BlueGreen切り替え用)
+        clusters = environment_clusters(config)
+        vpc = StackSpec(f'EksVpcStack-{name}', 'vpc', [], VpcStack,
+                        {'vpc_config': config['vpc'], 'cluster_names': [c['name'] for c in clusters.values()]},
+                        name, None)
+        # 1つのAWS Accountで、環境内の全clusterが共通で利用するStatefulなリソース
+        stateful = StackSpec(f'FlaskAppStatefulStack-{name.capitalize()}', 'stateful', [vpc.name],
+                             FlaskAppStatefulStack,
+                             {'vpc_config': config['vpc'], 'flask_stateful_config': config['flask-stateful'],
+                              'cluster_configs': clusters},
+                             name, None)
+        specs += [vpc, stateful]
+
+        for number in environment['clusters']:
+            cluster_config = config[f'cluster-{number}']
+            cluster = StackSpec(f'EksClusterStack-{cluster_config["name"]}', 'cluster', [stateful.name],
+                                EksClusterStack, {'vpc_config': config['vpc'], 'cluster_config': cluster_config},
+                                name, cluster_config['name'])
+            app = StackSpec(f'FlaskAppStack-{cluster_config["name"]}', 'app', [cluster.name], FlaskAppStack,
+                            {'vpc_config': config['vpc'], 'cluster_config': cluster_config,
+                             'flask_config': config[f'flask-{number}']},
+                            name, cluster_config['name'])
+            specs += [cluster, app]
+    return specs
+
+
+def parse_selector(value: Optional[str]) -> Optional[set]:
+    # CDK context '-c envs=dev,prd' -> {'dev', 'prd'}。未指定はNone(全て)
+    if not value:
+        return None
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+def select_stacks(specs: list, envs: Optional[set] = None, clusters: Optional[set] = None) -> list:
+    """envs, clustersで選択したstackのみを返す(Noneは全て)
+
+    envs: 環境の全stack(VPC, Stateful, cluster)。CodePipelineは'pipeline'
+    clusters: 指定したclusterのEKS Cluster, Flask Appのみ。
+              envsを指定しない場合、環境で共通のstack(VPC, Stateful)とCodePipelineは作成しない
+    """
+    unknown = ((envs or set()) - {spec.environment for spec in specs}) | \
+        ((clusters or set()) - {spec.cluster for spec in specs if spec.cluster})
+    if unknown:
+        raise ValueError(f'unknown envs/clusters: {sorted(unknown)}')
+
+    def selected(spec: StackSpec) -> bool:
+        if envs is not None and spec.environment not in envs:
+            return False
+        if spec.cluster is None:
+            return envs is not None or clusters is None
+        return clusters is None or spec.cluster in clusters
+    return [spec for spec in specs if selected(spec)]
+
+
+def build_stacks(scope, specs: list, env) -> dict:
+    """StackSpecからstackを作成し、依存関係を設定する。{stack名: stack}を返す
+
+    選択されずに作成しないstackへの依存関係は設定しない(deploy済みのstackのexportを参照する)。
+    """
+    stacks = {}
+    for spec in specs:
+        stack = spec.stack_class(scope, spec.name, env=env, **spec.kwargs)
+        for dependency in spec.depends_on:
+            if dependency in stacks:
+                stack.add_dependency(stacks[dependency])
+        stacks[spec.name] = stack
+    return stacks
+
+
+def deploy_waves(specs: list) -> list:
+    """依存関係のみで並列にdeployした場合の順序: [[同時にdeployできるstack名], ...]"""
+    depth = {}
+    for spec in specs:
+        depth[spec.name] = max([depth[dependency] + 1 for dependency in spec.depends_on if dependency in depth] + [0])
+    waves = [[] for _ in range(max(depth.values()) + 1)] if depth else []
+    for spec in specs:
+        waves[depth[spec.name]].append(spec.name)
+    return waves
+
+
+def critical_path(specs: list, minutes: dict = None) -> tuple:
+    """deploy時間の見積もりが最長となる依存関係の経路と、その時間(分)を返す"""
+    minutes = minutes or ESTIMATED_MINUTES
+    finish, previous = {}, {}
+    for spec in specs:
+        start = 0
+        for dependency in spec.depends_on:
+            if finish.get(dependency, 0) > start:
+                start, previous[spec.name] = finish[dependency], dependency
+        finish[spec.name] = start + minutes[spec.kind]
+
+    name = max(finish, key=finish.get)
+    total = finish[name]
+    path = [name]
+    while path[-1] in previous:
+        path.append(previous[path[-1]])
+    return list(reversed(path)), total
+
+
+def format_plan(specs: list, minutes: dict = None) -> str:
+    minutes = minutes or ESTIMATED_MINUTES
+    if not specs:
+        return 'no stacks selected\n'
+    lines = ['deploy waves (stacks in a wave deploy in parallel):']
+    for i, wave in enumerate(deploy_waves(specs)):
+        lines.append(f'  {i + 1}: {", ".join(wave)}')
+
+    lines += ['', 'dependencies:']
+    for spec in specs:
+        lines.append(f'  {spec.name} <- {", ".join(spec.depends_on) or "-"}')
+
+    kinds = {spec.name: spec.kind for spec in specs}
+    path, total = critical_path(specs, minutes)
+    serial = sum(minutes[spec.kind] for spec in specs)
+    lines += ['', f'critical path (estimated {total} min, serial {serial} min):',
+              '  ' + ' -> '.join(f'{name} ({minutes[kinds[name]]}m)' for name in path)]
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    from configration import codepipeline_stack_configuration
+    from configration import deploy_environments
+    parser = argparse.ArgumentParser(description='stackのdeploy順序とcritical pathを出力する(dry-run)')
+    parser.add_argument('--envs', help='cdk -c envs=... と同じ')
+    parser.add_argument('--clusters', help='cdk -c clusters=... と同じ')
+    args = parser.parse_args()
+    specs = select_stacks(plan_stacks(codepipeline_stack_configuration, deploy_environments),
+                          parse_selector(args.envs), parse_selector(args.clusters))
+    print(format_plan(specs), end='')
+
+
+if __name__ == '__main__':
+    main()
@@ -12,11 +12,13 @@ class VpcStack(Stack):
             scope: Construct,
             construct_id: str,
             vpc_config: dict,
+            cluster_names: list,
             **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         self.aws_env = {'account': self.account, 'region': self.region}
         self.vpc_conf = vpc_config
+        self.cluster_names = cluster_names  # 環境の全EKS Cluster名 (SubnetにEKS用Tag付加)
 
         self.vpc = aws_ec2.Vpc(
             self,
@@ -54,7 +56,7 @@ class VpcStack(Stack):
         self.tag_all_subnets(self.vpc.public_subnets, 'kubernetes.io/role/elb', '1')
         self.tag_all_subnets(self.vpc.private_subnets, 'kubernetes.io/role/internal-elb', '1')
 
-        for cluster_name in self.vpc_conf['cluster_name_list']:
+        for cluster_name in self.cluster_names:
             self.tag_all_subnets(self.vpc.public_subnets,
                                  f'kubernetes.io/cluster/{cluster_name}', 'shared')
             self.tag_all_subnets(self.vpc.private_subnets,
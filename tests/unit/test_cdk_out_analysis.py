@@ -0,0 +1,63 @@
+import json
+from stacks import cdk_out_analysis
+
+
+def write_cdk_out(out_dir, stacks: dict):
+    # stacks: {stack名: (依存するstack, template)}
+    artifacts = {}
+    for name, (dependencies, template) in stacks.items():
+        (out_dir / f'{name}.template.json').write_text(json.dumps(template))
+        artifacts[f'{name}.assets'] = {'type': 'cdk:asset-manifest'}
+        artifacts[name] = {'type': 'aws:cloudformation:stack', 'dependencies': dependencies + [f'{name}.assets'],
+                           'properties': {'templateFile': f'{name}.template.json'}}
+    (out_dir / 'manifest.json').write_text(json.dumps({'artifacts': artifacts}))
+
+
+CLUSTER_TEMPLATE = {'Resources': {
+    'Role': {'Type': 'AWS::IAM::Role'},
+    'Cluster': {'Type': 'Custom::AWSCDK-EKS-Cluster', 'Properties': {'RoleArn': {'Fn::GetAtt': ['Role', 'Arn']}}},
+    # deploy_addonsの直列の依存関係(DependsOn)
+    'ChartA': {'Type': 'Custom::AWSCDK-EKS-HelmChart', 'Properties': {'ClusterName': {'Ref': 'Cluster'}}},
+    'ChartB': {'Type': 'Custom::AWSCDK-EKS-HelmChart', 'DependsOn': 'ChartA',
+               'Properties': {'ClusterName': {'Ref': 'Cluster'}}},
+    'Parameter': {'Type': 'AWS::SSM::Parameter', 'Properties': {'Value': {'Fn::Sub': '${Cluster.Endpoint}'}}},
+}}
+
+
+def test_critical_path_follows_stack_and_addon_dependencies(tmp_path):
+    write_cdk_out(tmp_path, {
+        'Vpc': ([], {'Resources': {'Vpc': {'Type': 'AWS::EC2::VPC'}}}),
+        'Cluster': (['Vpc'], CLUSTER_TEMPLATE),
+        'Pipeline': ([], {'Resources': {'Pipeline': {'Type': 'AWS::CodePipeline::Pipeline'}}}),
+    })
+    nodes = cdk_out_analysis.load_cdk_out(str(tmp_path))
+    timings = cdk_out_analysis.schedule(nodes)
+    path, total = cdk_out_analysis.critical_path(nodes, timings)
+
+    assert path == ['Vpc/Vpc', 'Vpc', 'Cluster/Role', 'Cluster/Cluster', 'Cluster/ChartA', 'Cluster/ChartB', 'Cluster']
+    seconds = cdk_out_analysis.DEFAULT_SECONDS
+    assert total == (cdk_out_analysis.OTHER_SECONDS + seconds['AWS::IAM::Role'] + seconds['Custom::AWSCDK-EKS-Cluster']
+                     + 2 * seconds['Custom::AWSCDK-EKS-HelmChart'] + 2 * cdk_out_analysis.STACK_OVERHEAD_SECONDS)
+    # ChartA, ChartBと並列のParameterは、ChartA+ChartBの時間だけ遅延できる
+    assert timings['Cluster/Parameter'].slack == 2 * seconds['Custom::AWSCDK-EKS-HelmChart'] - \
+        cdk_out_analysis.OTHER_SECONDS
+    assert timings['Pipeline'].slack == total - timings['Pipeline'].finish
+
+
+def test_calibrate_uses_median_of_cloudformation_events(tmp_path):
+    def event(logical_id, status, timestamp):
+        return {'StackName': 'Cluster', 'LogicalResourceId': logical_id, 'ResourceType': 'AWS::IAM::Role',
+                'ResourceStatus': status, 'Timestamp': timestamp}
+    events = [event('A', 'CREATE_COMPLETE', '2022-07-20T10:01:00.000000+00:00'),
+              event('A', 'CREATE_IN_PROGRESS', '2022-07-20T10:00:00.000000+00:00'),
+              event('A', 'CREATE_IN_PROGRESS', '2022-07-20T10:00:01.000000+00:00'),
+              event('B', 'UPDATE_IN_PROGRESS', '2022-07-20T10:00:00Z'),
+              event('B', 'UPDATE_COMPLETE', '2022-07-20T10:00:10Z'),
+              event('C', 'CREATE_IN_PROGRESS', '2022-07-20T10:00:00Z'),
+              event('C', 'CREATE_FAILED', '2022-07-20T10:05:00Z')]
+    path = tmp_path / 'events.json'
+    path.write_text(json.dumps({'StackEvents': events}))
+
+    estimates = cdk_out_analysis.calibrate([str(path)])
+    assert estimates['AWS::IAM::Role'] == 35
+    assert estimates['Custom::AWSCDK-EKS-Cluster'] == cdk_out_analysis.DEFAULT_SECONDS['Custom::AWSCDK-EKS-Cluster']
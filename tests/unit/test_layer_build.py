@@ -0,0 +1,88 @@
+import os
+import pytest
+from _constructs.codepipeline import layer_build
+
+FUNCTION_DIR = os.path.join(os.path.dirname(__file__), '..', '..',
+                            '_constructs', 'codepipeline', 'functions', 'manifest_update')
+
+
+def test_trim_layer_removes_tests_and_unused_packages(tmp_path):
+    for path in ['dulwich/__init__.py', 'dulwich/tests/test_repo.py', 'dulwich/contrib/swift.py',
+                 'dulwich/_objects.c', 'yaml/__init__.py', 'yaml/__pycache__/x.pyc', 'bin/dulwich']:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_bytes(b'x' * 10)
+
+    assert layer_build.trim_layer(str(tmp_path)) == 50
+    remaining = sorted(os.path.relpath(os.path.join(root, name), str(tmp_path))
+                       for root, _, files in os.walk(str(tmp_path)) for name in files)
+    assert remaining == ['dulwich/__init__.py', 'yaml/__init__.py']
+
+
+def test_build_layer_reuses_output_until_requirements_change(tmp_path, monkeypatch):
+    installs = []
+
+    def install_requirements(requirements_file, python_dir):
+        installs.append(python_dir)
+        os.makedirs(os.path.join(python_dir, 'dulwich', 'tests'))
+        with open(os.path.join(python_dir, 'dulwich', '__init__.py'), 'w') as f:
+            f.write(open(requirements_file).read())
+
+    monkeypatch.setattr(layer_build, 'install_requirements', install_requirements)
+    monkeypatch.setattr(layer_build, 'compile_layer', lambda python_dir, runtime_version: False)
+    requirements = tmp_path / 'requirements.txt'
+    requirements.write_text('dulwich==0.21.7\n')
+    output_dir = str(tmp_path / 'layer_pip')
+
+    first = layer_build.build_layer(str(requirements), output_dir)
+    second = layer_build.build_layer(str(requirements), output_dir)
+    assert first['rebuilt'] and not second['rebuilt'] and first['hash'] == second['hash']
+    assert len(installs) == 1 and layer_build.read_layer_hash(output_dir) == first['hash']
+
+    requirements.write_text('dulwich==0.21.0\n')
+    third = layer_build.build_layer(str(requirements), output_dir)
+    assert third['rebuilt'] and third['hash'] != first['hash']
+    assert (tmp_path / 'layer_pip' / 'python' / 'dulwich' / '__init__.py').read_text() == 'dulwich==0.21.0\n'
+    assert not (tmp_path / 'layer_pip' / 'python' / 'dulwich' / 'tests').exists()
+    # build用のdirectoryは残さない
+    assert sorted(os.listdir(str(tmp_path))) == ['layer_pip', 'requirements.txt']
+
+
+def test_build_layer_rejects_unpinned_requirements(tmp_path, monkeypatch):
+    monkeypatch.setattr(layer_build, 'install_requirements', lambda requirements_file, python_dir: pytest.fail())
+    requirements = tmp_path / 'requirements.txt'
+    requirements.write_text('# comment\nPyYAML==6.0\ndulwich>=0.21  # latest\n')
+    with pytest.raises(ValueError, match='dulwich>=0.21'):
+        layer_build.build_layer(str(requirements), str(tmp_path / 'layer_pip'))
+    assert not (tmp_path / 'layer_pip').exists()
+
+
+def test_failed_build_keeps_previous_layer(tmp_path, monkeypatch):
+    requirements = tmp_path / 'requirements.txt'
+    requirements.write_text('dulwich==0.21.7\n')
+    output_dir = str(tmp_path / 'layer_pip')
+    monkeypatch.setattr(layer_build, 'install_requirements',
+                        lambda requirements_file, python_dir: os.makedirs(python_dir))
+    monkeypatch.setattr(layer_build, 'compile_layer', lambda python_dir, runtime_version: False)
+    previous = layer_build.build_layer(str(requirements), output_dir)['hash']
+
+    def fail(requirements_file, python_dir):
+        raise RuntimeError('network unavailable')
+
+    monkeypatch.setattr(layer_build, 'install_requirements', fail)
+    requirements.write_text('dulwich==0.21.0\n')
+    with pytest.raises(RuntimeError):
+        layer_build.build_layer(str(requirements), output_dir)
+    assert layer_build.read_layer_hash(output_dir) == previous
+    assert sorted(os.listdir(str(tmp_path))) == ['layer_pip', 'requirements.txt']
+
+
+def test_import_profile_reports_direct_imports():
+    entries = layer_build.profile_imports('function', [FUNCTION_DIR])
+    report = layer_build.format_import_profile('function', entries, budget_ms=300)
+
+    direct = report.split('direct imports (cumulative ms):\n')[1].split('\n\n')[0]
+    names = [line.split()[1] for line in direct.splitlines()]
+    # boto3とdulwich.porcelainは初回利用時にimportする
+    assert 'image_updater' in names and 'github_api' in names
+    imported = [name for name, _, _, _ in entries]
+    assert 'boto3' not in imported and 'dulwich.porcelain' not in imported
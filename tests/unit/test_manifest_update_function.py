@@ -0,0 +1,631 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import pytest
+from dulwich.object_store import tree_lookup_path
+from dulwich.repo import Repo
+from benchmarks.manifest_update.fixtures import build_cd_repository
+from benchmarks.manifest_update.fixtures import import_function
+from benchmarks.manifest_update.fixtures import GitHttpServer
+from benchmarks.manifest_update.github_api_server import GithubApiServer
+from benchmarks.manifest_update.aws_stubs import codepipeline_event
+from benchmarks.manifest_update.aws_stubs import MemoryStateStore
+from benchmarks.manifest_update.aws_stubs import StubCodePipeline
+from benchmarks.manifest_update.aws_stubs import StubContext
+from benchmarks.manifest_update.aws_stubs import StubSecretsManager
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+function = import_function()
+
+
+@pytest.fixture
+def remote(tmp_path):
+    remote_path = str(tmp_path / 'remote.git')
+    build_cd_repository(remote_path, services=3, history=10)
+    with GitHttpServer(remote_path) as server:
+        yield remote_path, server.url
+
+
+def read_manifest(repo_path: str, branch: str, manifest: str = 'deployment.yaml') -> str:
+    repo = Repo(repo_path)
+    tree_id = repo[b'refs/heads/' + branch.encode()].tree
+    _, blob_id = tree_lookup_path(repo.__getitem__, tree_id, manifest.encode())
+    return repo[blob_id].data.decode('utf-8')
+
+
+def test_sparse_clone_checks_out_only_target_manifest(remote, tmp_path):
+    remote_path, url = remote
+    local_repo_path = str(tmp_path / 'repo') + '/'
+    git = function.Git(url, [{'branch': 'dev', 'manifests': ['deployment.yaml']}], local_repo_path, 'token',
+                       clone_mode=function.CLONE_MODE_SPARSE)
+    git.clone()
+    assert sorted(os.listdir(local_repo_path)) == ['.git', 'deployment.yaml']
+
+    manifest = function.ManifestUpdated('deployment.yaml', 'new-tag')
+    git.write_manifest('dev', 'deployment.yaml',
+                       manifest.update_image_tag_content(git.read_manifest('dev', 'deployment.yaml')))
+    git.add()
+    git.commit()
+    git.push()
+
+    assert 'flask:new-tag' in read_manifest(remote_path, 'dev')
+    remote_repo = Repo(remote_path)
+    head = remote_repo[b'refs/heads/dev']
+    assert head.parents == [remote_repo.refs[b'refs/heads/prd']]
+    # target manifest以外のtreeは変更されない
+    assert remote_repo[head.tree][b'services'] == remote_repo[remote_repo[head.parents[0]].tree][b'services']
+
+
+@pytest.fixture
+def handler_env(monkeypatch, tmp_path):
+    codepipeline = StubCodePipeline()
+    monkeypatch.setattr(function, 'get_code_pipeline_client', lambda: codepipeline)
+    monkeypatch.setattr(function, 'get_secret', lambda secret_id, force_refresh=False: 'token')
+    monkeypatch.setattr(function, 'REPO_CACHE_DIR', str(tmp_path / 'repo-cache'))
+    return codepipeline
+
+
+@pytest.mark.parametrize('clone_mode', ['full', 'sparse'])
+def test_warm_invocation_fetches_cached_repository(remote, handler_env, monkeypatch, clone_mode):
+    remote_path, url = remote
+    clone_calls = []
+    original_clone = function.Git.clone
+    monkeypatch.setattr(function.Git, 'clone', lambda self: clone_calls.append(1) or original_clone(self))
+
+    function.lambda_handler(codepipeline_event(url, 'dev', 'tag-1', github_clone_mode=clone_mode), None)
+    function.lambda_handler(codepipeline_event(url, 'dev', 'tag-2', github_clone_mode=clone_mode), None)
+
+    assert [result for result, _ in handler_env.results] == ['success', 'success']
+    assert len(clone_calls) == 1
+    assert 'flask:tag-2' in read_manifest(remote_path, 'dev')
+
+
+def test_warm_fetch_skips_heads_already_in_cache(remote, handler_env, capsys):
+    remote_path, url = remote
+    for tag in ['tag-1', 'tag-2']:
+        function.lambda_handler(codepipeline_event(url, 'dev', tag, github_clone_mode='sparse'), None)
+    # remoteのheadは前回pushしたcommitのため、packを受信しない
+    assert [sum(emf['BytesReceived']) for emf in emitted_metrics(capsys.readouterr().out)][1] == 0
+
+    # 他のcommitでheadが進んだ場合はfetchし、その上に積む
+    concurrent = push_concurrent_commit(remote_path, 'dev', 'services/service-001/deployment.yaml')
+    function.lambda_handler(codepipeline_event(url, 'dev', 'tag-3', github_clone_mode='sparse'), None)
+
+    [emf] = emitted_metrics(capsys.readouterr().out)
+    assert sum(emf['BytesReceived']) > 0
+    assert Repo(remote_path)[b'refs/heads/dev'].parents == [concurrent]
+    assert 'flask:tag-3' in read_manifest(remote_path, 'dev')
+
+
+def test_cache_evicts_least_recently_used_entry_over_total_limit(remote, handler_env, monkeypatch):
+    remote_path, url = remote
+    cache = function.RepositoryCache(function.REPO_CACHE_DIR, 1)
+    function.lambda_handler(codepipeline_event(url, 'dev', 'tag-1', github_clone_mode='sparse'), None)
+    dev_path = cache.path_for(url, ['dev'], 'sparse')
+    # cloneした時点のsizeを保存し、以降は走査しない
+    assert cache.stored_size(dev_path) > 0
+
+    # 2つ目のentryを追加するとcache全体の上限を超える
+    monkeypatch.setattr(function, 'REPO_CACHE_TOTAL_MAX_BYTES', cache.stored_size(dev_path) + 1)
+    function.lambda_handler(codepipeline_event(url, 'prd', 'tag-1', github_clone_mode='sparse'), None)
+
+    assert [result for result, _ in handler_env.results] == ['success', 'success']
+    assert not os.path.exists(dev_path) and cache.stored_size(dev_path) is None
+    assert os.path.isdir(os.path.join(cache.path_for(url, ['prd'], 'sparse'), '.git'))
+
+
+def test_corrupted_cache_falls_back_to_clone(remote, handler_env):
+    remote_path, url = remote
+    event = codepipeline_event(url, 'dev', 'tag-1', github_clone_mode='sparse')
+    function.lambda_handler(event, None)
+
+    local_repo_path = function.RepositoryCache(function.REPO_CACHE_DIR, 1).path_for(url, ['dev'], 'sparse')
+    os.remove(os.path.join(local_repo_path, '.git', 'refs', 'heads', 'dev'))
+
+    function.lambda_handler(codepipeline_event(url, 'dev', 'tag-2', github_clone_mode='sparse'), None)
+    assert [result for result, _ in handler_env.results] == ['success', 'success']
+    assert 'flask:tag-2' in read_manifest(remote_path, 'dev')
+
+
+def test_api_backend_updates_manifest_without_clone(remote, handler_env, tmp_path):
+    remote_path, _ = remote
+    with GithubApiServer(remote_path, token='token') as api:
+        event = codepipeline_event('https://github.com/rafty/handson-flask_cd.git', 'dev', 'tag-api',
+                                   github_backend='api', github_api_url=api.url)
+        function.lambda_handler(event, None)
+
+    assert [result for result, _ in handler_env.results] == ['success']
+    assert 'flask:tag-api' in read_manifest(remote_path, 'dev')
+    assert not os.path.exists(function.REPO_CACHE_DIR)
+    remote_repo = Repo(remote_path)
+    assert remote_repo[b'refs/heads/dev'].parents == [remote_repo.refs[b'refs/heads/prd']]
+
+
+def test_api_backend_push_is_fast_forward_only(remote):
+    remote_path, _ = remote
+    with GithubApiServer(remote_path, token='token') as api:
+        pushes = []
+        for tag in ['tag-1', 'tag-2']:
+            git = function.GithubApi('https://github.com/rafty/handson-flask_cd.git',
+                                     [{'branch': 'dev', 'manifests': ['deployment.yaml']}],
+                                     'token', api_url=api.url)
+            git.clone()
+            git.write_manifest('dev', 'deployment.yaml',
+                               git.read_manifest('dev', 'deployment.yaml').replace('initial', tag))
+            git.add()
+            git.commit()
+            pushes.append(git)
+        pushes[0].push()
+        with pytest.raises(function.GithubApiError) as e:
+            pushes[1].push()
+    assert e.value.status == 422
+
+
+@pytest.mark.parametrize('backend', ['git', 'api'])
+def test_batch_targets_commit_once_per_branch(remote, handler_env, backend):
+    remote_path, url = remote
+    before = {branch: Repo(remote_path).refs[b'refs/heads/' + branch.encode()] for branch in ['dev', 'prd']}
+    targets = [
+        {'branch': 'dev', 'manifests': ['deployment.yaml', 'services/service-000/deployment.yaml']},
+        {'branch': 'prd', 'manifests': ['deployment.yaml']},
+    ]
+    if backend == 'api':
+        url = 'https://github.com/rafty/handson-flask_cd.git'
+    with GithubApiServer(remote_path, token='token') as api:
+        event = codepipeline_event(url, 'dev', 'tag-batch', github_targets=targets,
+                                   github_clone_mode='sparse', github_backend=backend, github_api_url=api.url)
+        function.lambda_handler(event, None)
+
+    assert [result for result, _ in handler_env.results] == ['success']
+    remote_repo = Repo(remote_path)
+    for branch in ['dev', 'prd']:
+        assert remote_repo[b'refs/heads/' + branch.encode()].parents == [before[branch]]
+        assert 'flask:tag-batch' in read_manifest(remote_path, branch)
+    assert 'flask:tag-batch' in read_manifest(remote_path, 'dev', 'services/service-000/deployment.yaml')
+    assert 'flask:tag-batch' not in read_manifest(remote_path, 'prd', 'services/service-000/deployment.yaml')
+
+
+@pytest.mark.parametrize('backend', ['git', 'api'])
+def test_unchanged_manifest_skips_commit_and_push(remote, handler_env, backend):
+    remote_path, url = remote
+    if backend == 'api':
+        url = 'https://github.com/rafty/handson-flask_cd.git'
+    with GithubApiServer(remote_path, token='token') as api:
+        for job_id in ['job-1', 'job-2']:
+            event = codepipeline_event(url, 'dev', 'tag-same', job_id=job_id,
+                                       github_backend=backend, github_api_url=api.url)
+            function.lambda_handler(event, None)
+            if job_id == 'job-1':
+                head = Repo(remote_path).refs[b'refs/heads/dev']
+
+    assert [(result, kwargs['jobId']) for result, kwargs in handler_env.results] == [
+        ('success', 'job-1'), ('success', 'job-2')]
+    # 2回目はmanifestが変わらないためcommitされない
+    assert Repo(remote_path).refs[b'refs/heads/dev'] == head
+
+
+def test_secret_is_cached_and_refreshed_on_authentication_failure(remote, monkeypatch, tmp_path):
+    remote_path, _ = remote
+    codepipeline = StubCodePipeline()
+    secrets_manager = StubSecretsManager('rotated-out', 'token')
+    monkeypatch.setattr(function, 'get_code_pipeline_client', lambda: codepipeline)
+    monkeypatch.setattr(function, 'get_secrets_manager_client', lambda: secrets_manager)
+    monkeypatch.setattr(function, '_secret_cache', {})
+    with GithubApiServer(remote_path, token='token') as api:
+        for tag in ['tag-1', 'tag-2']:
+            event = codepipeline_event('https://github.com/rafty/handson-flask_cd.git', 'dev', tag,
+                                       github_backend='api', github_api_url=api.url)
+            function.lambda_handler(event, None)
+
+    assert [result for result, _ in codepipeline.results] == ['success', 'success']
+    # 1回目は401でforce refresh、2回目はcacheしたtokenを使う
+    assert secrets_manager.calls == 2
+    assert 'flask:tag-2' in read_manifest(remote_path, 'dev')
+
+
+def push_concurrent_commit(repo_path: str, branch: str, manifest: str):
+    # 別のpipeline実行が先にpushしたcommitを再現する
+    repo = Repo(repo_path)
+    ref = b'refs/heads/' + branch.encode()
+    parent = repo[repo.refs[ref]]
+    _, blob_id = tree_lookup_path(repo.__getitem__, parent.tree, manifest.encode())
+    blob = function.Blob.from_string(repo[blob_id].data.replace(b'replicas: 1', b'replicas: 2'))
+    repo.object_store.add_object(blob)
+    commit = function.Commit()
+    commit.tree = function.replace_tree_entry(repo.object_store, parent.tree, manifest.encode(), blob.id)
+    commit.parents = [parent.id]
+    commit.author = commit.committer = b'other <other@example.com>'
+    commit.author_time = commit.commit_time = 0
+    commit.author_timezone = commit.commit_timezone = 0
+    commit.message = b'concurrent'
+    repo.object_store.add_object(commit)
+    repo.refs[ref] = commit.id
+    return commit.id
+
+
+@pytest.mark.parametrize('backend', ['git', 'api'])
+def test_rejected_push_is_rebased_and_retried(remote, handler_env, monkeypatch, backend):
+    remote_path, url = remote
+    if backend == 'api':
+        url = 'https://github.com/rafty/handson-flask_cd.git'
+    monkeypatch.setattr(function, 'PUSH_BACKOFF_SECONDS', 0)
+    backend_class = function.GithubApi if backend == 'api' else function.Git
+    original_commit = backend_class.commit
+    concurrent = []
+
+    def commit_racing_with_other_pipeline(self):
+        if not concurrent:
+            concurrent.append(push_concurrent_commit(remote_path, 'dev', 'services/service-001/deployment.yaml'))
+        original_commit(self)
+
+    monkeypatch.setattr(backend_class, 'commit', commit_racing_with_other_pipeline)
+    with GithubApiServer(remote_path, token='token') as api:
+        event = codepipeline_event(url, 'dev', 'tag-retry', github_clone_mode='sparse',
+                                   github_backend=backend, github_api_url=api.url)
+        function.lambda_handler(event, None)
+
+    assert [result for result, _ in handler_env.results] == ['success']
+    remote_repo = Repo(remote_path)
+    # 先にpushされたcommitを上書きせず、その上にtagの更新を積む
+    assert remote_repo[b'refs/heads/dev'].parents == concurrent
+    assert 'flask:tag-retry' in read_manifest(remote_path, 'dev')
+    assert 'replicas: 2' in read_manifest(remote_path, 'dev', 'services/service-001/deployment.yaml')
+
+
+def run_with_continuation(url: str, handler_env, remove_cache_before_push: bool = False, **user_parameters) -> list:
+    # 残り時間がない状態でinvokeし、CodePipelineと同様にcontinuation tokenを付けて再invokeする
+    token, phases = None, []
+    while True:
+        event = codepipeline_event(url, 'dev', 'tag-phase', continuation_token=token, **user_parameters)
+        function.lambda_handler(event, StubContext(remaining_ms=0))
+        result, kwargs = handler_env.results[-1]
+        token = kwargs.get('continuationToken')
+        if result != 'success' or token is None:
+            return phases
+        phases.append(function.json.loads(token)['phase'])
+        if remove_cache_before_push and phases == ['edit', 'push']:
+            function.RepositoryCache.invalidate(function.REPO_CACHE_DIR)
+
+
+@pytest.mark.parametrize('backend', ['git', 'api'])
+def test_continuation_token_splits_update_into_phases(remote, handler_env, backend):
+    remote_path, url = remote
+    if backend == 'api':
+        url = 'https://github.com/rafty/handson-flask_cd.git'
+    before = Repo(remote_path).refs[b'refs/heads/dev']
+    with GithubApiServer(remote_path, token='token') as api:
+        phases = run_with_continuation(url, handler_env, github_clone_mode='sparse',
+                                       github_backend=backend, github_api_url=api.url)
+
+    assert phases == ['edit', 'push']
+    assert [result for result, _ in handler_env.results] == ['success'] * 3
+    assert Repo(remote_path)[b'refs/heads/dev'].parents == [before]
+    assert 'flask:tag-phase' in read_manifest(remote_path, 'dev')
+
+
+def test_continuation_without_cached_commit_restarts_from_edit(remote, handler_env):
+    remote_path, url = remote
+    phases = run_with_continuation(url, handler_env, remove_cache_before_push=True, github_clone_mode='sparse')
+
+    # 別のcontainerでinvokeされた場合と同様に、editからやり直してpushする
+    assert phases == ['edit', 'push', 'push']
+    assert 'flask:tag-phase' in read_manifest(remote_path, 'dev')
+
+
+def emitted_metrics(output: str) -> list:
+    # Powertools MetricsはCloudWatch EMFのJSONをstdoutに出力する
+    return [function.json.loads(line) for line in output.splitlines() if line.startswith('{"_aws"')]
+
+
+def test_phase_latency_metrics_are_emitted(remote, handler_env, capsys):
+    _, url = remote
+    function.lambda_handler(codepipeline_event(url, 'dev', 'tag-metrics', github_clone_mode='sparse'), None)
+
+    [emf] = emitted_metrics(capsys.readouterr().out)
+    names = {metric['Name'] for metric in emf['_aws']['CloudWatchMetrics'][0]['Metrics']}
+    assert {'SecretFetchTime', 'CloneTime', 'ManifestEditTime', 'CommitTime', 'PushTime',
+            'ManifestSize', 'BytesReceived', 'BytesSent'} <= names
+    assert {'repository', 'branch'} <= set(emf['_aws']['CloudWatchMetrics'][0]['Dimensions'][0])
+    assert emf['branch'] == 'dev'
+    assert sum(emf['BytesReceived']) > 0 and sum(emf['BytesSent']) > 0
+
+
+def test_import_loads_tracer_and_yaml_in_init_phase():
+    # X-Ray SDK(Tracer), PyYAMLはinvoke毎に使用するため、init phaseでimportする(初回invokeのlatencyに含めない)
+    from benchmarks.manifest_update.fixtures import FUNCTION_DIR
+    code = 'import sys, function; print(sorted({"aws_xray_sdk.core", "yaml"} & set(sys.modules)))'
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=FUNCTION_DIR,
+                                     env=dict(os.environ, PYTHONPATH=FUNCTION_DIR))
+    assert output.decode('utf-8').strip() == "['aws_xray_sdk.core', 'yaml']"
+
+
+def test_memory_mode_does_not_write_to_tmp(remote, handler_env):
+    remote_path, url = remote
+    before = Repo(remote_path).refs[b'refs/heads/dev']
+    function.lambda_handler(codepipeline_event(url, 'dev', 'tag-memory', github_clone_mode='memory'), None)
+
+    assert [result for result, _ in handler_env.results] == ['success']
+    assert Repo(remote_path)[b'refs/heads/dev'].parents == [before]
+    assert 'flask:tag-memory' in read_manifest(remote_path, 'dev')
+    assert not os.path.exists(function.REPO_CACHE_DIR)
+
+
+def test_memory_mode_falls_back_to_disk_over_limit(remote, handler_env, monkeypatch):
+    remote_path, url = remote
+    monkeypatch.setattr(function, 'MEMORY_REPO_MAX_BYTES', 1024)
+    function.lambda_handler(codepipeline_event(url, 'dev', 'tag-fallback', github_clone_mode='memory'), None)
+
+    assert [result for result, _ in handler_env.results] == ['success']
+    assert 'flask:tag-fallback' in read_manifest(remote_path, 'dev')
+    # sparse modeのcacheとしてdiskにcloneされる
+    sparse_path = function.RepositoryCache(function.REPO_CACHE_DIR, 1).path_for(url, ['dev'], 'sparse')
+    assert os.path.isdir(os.path.join(sparse_path, '.git'))
+
+
+def test_memory_mode_does_not_spool_pack_to_tmp(remote, handler_env, monkeypatch):
+    remote_path, url = remote
+    # packがspoolのsizeを超えると、SpooledTemporaryFileは/tmpの一時fileに書き出す
+    monkeypatch.setattr('dulwich.object_store.PACK_SPOOL_FILE_MAX_SIZE', 1024)
+    temporary_files = []
+    original_temporary_file = tempfile.TemporaryFile
+    monkeypatch.setattr(tempfile, 'TemporaryFile',
+                        lambda *args, **kwargs: temporary_files.append(1) or original_temporary_file(*args, **kwargs))
+    function.lambda_handler(codepipeline_event(url, 'dev', 'tag-spool', github_clone_mode='memory'), None)
+
+    assert [result for result, _ in handler_env.results] == ['success']
+    assert 'flask:tag-spool' in read_manifest(remote_path, 'dev')
+    # spoolのsizeを超えるpackは受信を中断し、sparse(disk)にfallbackする
+    assert temporary_files == []
+
+
+@pytest.fixture
+def state_store(monkeypatch):
+    store = MemoryStateStore()
+    monkeypatch.setattr(function, 'get_state_store', lambda: store)
+    return store
+
+
+def test_burst_of_builds_is_coalesced_to_newest_tag(remote, handler_env, state_store, monkeypatch):
+    remote_path, url = remote
+    clock = [1000000]
+    monkeypatch.setattr(function.coalescing, 'now_ms', lambda: clock[0])
+    before = Repo(remote_path).refs[b'refs/heads/dev']
+
+    tokens = {}
+    for job_id, tag in [('job-1', 'tag-old'), ('job-2', 'tag-new')]:
+        function.lambda_handler(codepipeline_event(url, 'dev', tag, job_id=job_id, coalesce_window_seconds=30),
+                                StubContext())
+        tokens[job_id] = handler_env.results[-1][1]['continuationToken']
+        clock[0] += 1000
+    # window内はpushしない
+    assert Repo(remote_path).refs[b'refs/heads/dev'] == before
+
+    clock[0] += 30000
+    for job_id, tag in [('job-1', 'tag-old'), ('job-2', 'tag-new')]:
+        # CodePipelineはcontinuationを新しいjob idで実行する
+        function.lambda_handler(codepipeline_event(url, 'dev', tag, job_id=f'{job_id}-cont',
+                                                   coalesce_window_seconds=30, continuation_token=tokens[job_id]),
+                                StubContext())
+        result, kwargs = handler_env.results[-1]
+        assert result == 'success' and 'continuationToken' not in kwargs
+
+    # supersededのjobも成功とし、最新のtagのみ1 commitでpushする
+    head = Repo(remote_path)[b'refs/heads/dev']
+    assert head.parents == [before]
+    assert 'flask:tag-new' in read_manifest(remote_path, 'dev')
+
+
+@pytest.mark.parametrize('backend', ['git', 'api'])
+def test_promotion_applies_change_record_from_dev(remote, handler_env, state_store, monkeypatch, backend):
+    remote_path, url = remote
+    if backend == 'api':
+        url = 'https://github.com/rafty/handson-flask_cd.git'
+    requests = []
+    original_request = function.GithubApi._request
+    monkeypatch.setattr(function.GithubApi, '_request',
+                        lambda self, method, path, body=None:
+                        requests.append((method, path.split('/')[1])) or original_request(self, method, path, body))
+
+    with GithubApiServer(remote_path, token='token') as api:
+        user_parameters = dict(github_clone_mode='sparse', github_backend=backend, github_api_url=api.url)
+        function.lambda_handler(codepipeline_event(url, 'dev', 'tag-promo', **user_parameters), None)
+        # prdではmanifestをparse/editせずにdevで保存したchange recordを適用する
+        monkeypatch.setattr(function.ManifestUpdated, 'update_image_tag_content', None)
+        requests.clear()
+        function.lambda_handler(codepipeline_event(url, 'prd', 'tag-promo', **user_parameters), None)
+
+    assert [result for result, _ in handler_env.results] == ['success', 'success']
+    assert read_manifest(remote_path, 'prd') == read_manifest(remote_path, 'dev')
+    assert 'flask:tag-promo' in read_manifest(remote_path, 'prd')
+    if backend == 'api':
+        # devでpush済みのblobを再利用する(取得、uploadしない)
+        assert ('GET', 'blobs') not in requests and ('POST', 'blobs') not in requests
+    # change recordにはmanifestのcontentを保存しない
+    [change] = [item for pk, item in state_store.items.items() if pk.startswith('change#')]
+    assert set(change) == {'pk', 'old_blob', 'new_blob', 'images', 'expires_at'}
+
+
+def test_change_record_is_saved_only_after_push(remote, handler_env, state_store, monkeypatch):
+    remote_path, url = remote
+    url = 'https://github.com/rafty/handson-flask_cd.git'
+
+    def fail(self):
+        raise function.GithubApiError(500, 'Server Error')
+
+    with GithubApiServer(remote_path, token='token') as api:
+        user_parameters = dict(github_backend='api', github_api_url=api.url)
+        with monkeypatch.context() as m:
+            # devは変更後のblobをuploadする前に失敗する
+            m.setattr(function.GithubApi, 'add', fail)
+            function.lambda_handler(codepipeline_event(url, 'dev', 'tag-unpushed', **user_parameters), None)
+        assert not [pk for pk in state_store.items if pk.startswith('change#')]
+
+        # prdはGitHub上に存在しないblobを使用せずにmanifestをeditする
+        function.lambda_handler(codepipeline_event(url, 'prd', 'tag-unpushed', **user_parameters), None)
+
+    assert [result for result, _ in handler_env.results] == ['failure', 'success']
+    assert 'flask:tag-unpushed' in read_manifest(remote_path, 'prd')
+    assert [pk for pk in state_store.items if pk.startswith('change#')]
+
+
+def test_promotion_edits_manifest_when_change_record_does_not_match(remote, handler_env, state_store):
+    remote_path, url = remote
+    function.lambda_handler(codepipeline_event(url, 'dev', 'tag-stale', github_clone_mode='sparse'), None)
+    # devとprdのmanifestが異なる等で、置換した結果が変更後のblobと一致しない場合はparse/editする
+    [key] = [pk for pk in state_store.items if pk.startswith('change#')]
+    state_store.put(key, dict(state_store.get(key), new_blob='0' * 40))
+    function.lambda_handler(codepipeline_event(url, 'prd', 'tag-stale', github_clone_mode='sparse'), None)
+
+    assert [result for result, _ in handler_env.results] == ['success', 'success']
+    assert read_manifest(remote_path, 'prd') == read_manifest(remote_path, 'dev')
+
+
+def test_redelivered_job_is_not_committed_twice(remote, handler_env, state_store, monkeypatch):
+    remote_path, url = remote
+    event = codepipeline_event(url, 'dev', 'tag-once', job_id='job-redelivered', github_clone_mode='sparse')
+    function.lambda_handler(event, None)
+    head = Repo(remote_path).refs[b'refs/heads/dev']
+    assert state_store.get(f'job#job-redelivered#{url}#dev')['commit'] == head.decode('ascii')
+
+    # 同じjobの再配信は、clone/pushせずに成功とする
+    monkeypatch.setattr(function, 'update_manifests', None)
+    function.lambda_handler(event, None)
+
+    assert [result for result, _ in handler_env.results] == ['success', 'success']
+    assert Repo(remote_path).refs[b'refs/heads/dev'] == head
+
+
+def test_redelivered_job_after_continuation_is_not_committed_twice(remote, handler_env, state_store, monkeypatch):
+    remote_path, url = remote
+    event = codepipeline_event(url, 'dev', 'tag-once', job_id='job-origin', github_clone_mode='sparse')
+    function.lambda_handler(event, StubContext(remaining_ms=0))
+    # CodePipelineはcontinuationを新しいjob idで実行する
+    for i in range(1, 3):
+        token = handler_env.results[-1][1]['continuationToken']
+        function.lambda_handler(codepipeline_event(url, 'dev', 'tag-once', job_id=f'job-cont-{i}',
+                                                   continuation_token=token, github_clone_mode='sparse'),
+                                StubContext(remaining_ms=0))
+    head = Repo(remote_path).refs[b'refs/heads/dev']
+    assert 'continuationToken' not in handler_env.results[-1][1]
+    assert state_store.get(f'job#job-origin#{url}#dev')['commit'] == head.decode('ascii')
+
+    # 最初のjobの再配信は、clone/pushせずに成功とする
+    monkeypatch.setattr(function, 'update_manifests', None)
+    function.lambda_handler(event, None)
+
+    assert [result for result, _ in handler_env.results] == ['success'] * 4
+    assert Repo(remote_path).refs[b'refs/heads/dev'] == head
+
+
+def test_partially_completed_job_updates_remaining_branches(remote, handler_env, state_store):
+    remote_path, url = remote
+    prd_before = Repo(remote_path).refs[b'refs/heads/prd']
+    state_store.put(f'job#job-partial#{url}#prd', {'commit': prd_before.decode('ascii'), 'manifests': ['deployment.yaml']})
+    targets = [{'branch': 'dev', 'manifests': ['deployment.yaml']}, {'branch': 'prd', 'manifests': ['deployment.yaml']}]
+    function.lambda_handler(codepipeline_event(url, 'dev', 'tag-partial', job_id='job-partial',
+                                               github_clone_mode='sparse', github_targets=targets), None)
+
+    assert [result for result, _ in handler_env.results] == ['success']
+    assert 'flask:tag-partial' in read_manifest(remote_path, 'dev')
+    assert Repo(remote_path).refs[b'refs/heads/prd'] == prd_before
+
+
+def test_rollback_re_pins_previous_known_good_tag(remote, handler_env, state_store):
+    remote_path, url = remote
+    for i, tag in enumerate(['tag-good', 'tag-bad']):
+        function.lambda_handler(codepipeline_event(url, 'dev', tag, job_id=f'job-{i}', github_clone_mode='sparse',
+                                                   container_image_name={'value': 'flask'}), None)
+    before = Repo(remote_path).refs[b'refs/heads/dev']
+
+    rollback_event = {'github_cd_repository': url, 'github_token_name': 'GithubPersonalAccessToken',
+                      'github_branch': 'dev', 'github_cd_manifest': 'deployment.yaml', 'container_image_name': 'flask'}
+    result = function.rollback_handler(rollback_event, None)
+
+    head = Repo(remote_path)[b'refs/heads/dev']
+    assert result['tag'] == 'tag-good' and result['rolled_back_from'] == ['tag-bad']
+    assert head.parents == [before] and result['commits'] == {'dev': head.id.decode('ascii')}
+    assert 'flask:tag-good' in read_manifest(remote_path, 'dev')
+    # rollback元のtagはknown-goodとしないため、tag-goodより前がないとrollbackできない
+    with pytest.raises(ValueError):
+        function.rollback_handler(rollback_event, None)
+
+
+def test_rollback_without_image_name_uses_ledger_image(remote, handler_env, state_store):
+    remote_path, url = remote
+    for i, tag in enumerate(['tag-good', 'tag-bad']):
+        function.lambda_handler(codepipeline_event(url, 'dev', tag, job_id=f'job-{i}', github_clone_mode='sparse',
+                                                   container_image_name={'value': 'flask'}), None)
+
+    # pipelineと同じUserParametersを持たない直接invokeでは、image名を省略できる
+    result = function.rollback_handler({'github_cd_repository': url, 'github_token_name': 'GithubPersonalAccessToken',
+                                        'github_branch': 'dev', 'github_cd_manifest': 'deployment.yaml'}, None)
+
+    assert result['tag'] == 'tag-good' and result['rolled_back_from'] == ['tag-bad']
+    assert 'flask:tag-good' in read_manifest(remote_path, 'dev')
+    [deployments] = [item for pk, item in state_store.items.items() if pk.startswith('ledger#')]
+    assert [entry['image'] for entry in deployments['entries']] == ['flask'] * 3
+
+
+def test_fan_out_updates_repositories_in_parallel(remote, handler_env, tmp_path, capsys):
+    remote_path, url = remote
+    other_path = str(tmp_path / 'other.git')
+    build_cd_repository(other_path, services=1, history=3)
+    with GitHttpServer(other_path) as other:
+        repositories = [{'github_cd_repository': url},
+                        {'github_cd_repository': other.url, 'github_branch': 'prd'}]
+        function.lambda_handler(codepipeline_event(url, 'dev', 'tag-fanout', github_clone_mode='sparse',
+                                                   github_repositories=repositories), None)
+
+    assert [result for result, _ in handler_env.results] == ['success']
+    assert 'flask:tag-fanout' in read_manifest(remote_path, 'dev')
+    assert 'flask:tag-fanout' in read_manifest(other_path, 'prd')
+    # repository毎に、そのrepositoryとbranchのみをdimensionとしてmetricを出力する
+    emfs = {emf['repository']: emf for emf in emitted_metrics(capsys.readouterr().out) if 'repository' in emf}
+    assert set(emfs) == {function.repository_name(url), function.repository_name(other.url)}
+    assert emfs[function.repository_name(url)]['branch'] == 'dev'
+    assert emfs[function.repository_name(other.url)]['branch'] == 'prd'
+    assert all('CloneTime' in emf and 'PushTime' in emf for emf in emfs.values())
+
+
+def test_fan_out_reports_one_failure_after_all_repositories(remote, handler_env):
+    remote_path, url = remote
+    repositories = [{'github_cd_repository': url},
+                    {'github_cd_repository': 'http://127.0.0.1:1/missing.git'}]
+    function.lambda_handler(codepipeline_event(url, 'dev', 'tag-partial-fanout', github_clone_mode='sparse',
+                                               github_repositories=repositories), None)
+
+    [(result, kwargs)] = handler_env.results
+    assert result == 'failure' and 'missing' in kwargs['failureDetails']['message']
+    # 失敗していないrepositoryは更新する
+    assert 'flask:tag-partial-fanout' in read_manifest(remote_path, 'dev')
+
+
+def test_fan_out_eviction_keeps_entries_in_use(remote, handler_env, tmp_path, monkeypatch):
+    remote_path, url = remote
+    other_path = str(tmp_path / 'other.git')
+    build_cd_repository(other_path, services=1, history=3)
+    # 1 entryでcache全体の上限を超え、recordしたrepository以外は全てevictの対象となる
+    monkeypatch.setattr(function, 'REPO_CACHE_TOTAL_MAX_BYTES', 1)
+    recorded = threading.Event()
+    original_record = function.RepositoryCache.record
+    monkeypatch.setattr(function.RepositoryCache, 'record',
+                        lambda self, path, added: (original_record(self, path, added), recorded.set()))
+    original_clone = function.Git.clone
+
+    def clone(self):
+        original_clone(self)
+        if self._cd_repository != url:
+            # clone後、commit前に他のrepositoryがrecord(evict)する
+            assert recorded.wait(timeout=30)
+    monkeypatch.setattr(function.Git, 'clone', clone)
+
+    with GitHttpServer(other_path) as other:
+        repositories = [{'github_cd_repository': url}, {'github_cd_repository': other.url}]
+        function.lambda_handler(codepipeline_event(url, 'dev', 'tag-evict', github_clone_mode='full',
+                                                   github_repositories=repositories), None)
+
+    assert [result for result, _ in handler_env.results] == ['success']
+    assert 'flask:tag-evict' in read_manifest(remote_path, 'dev')
+    assert 'flask:tag-evict' in read_manifest(other_path, 'dev')
@@ -0,0 +1,86 @@
+import pytest
+from benchmarks.manifest_update.fixtures import add_function_path
+
+add_function_path()
+import image_updater  # noqa: E402
+
+ECR = '338456725408.dkr.ecr.ap-northeast-1.amazonaws.com'
+
+MANIFEST = f"""apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: flask
+spec:
+  template:
+    spec:
+      initContainers:
+      - name: migrate
+        image: {ECR}/flask:old
+      containers:
+      - name: proxy
+        image: envoyproxy/envoy:v1.22.0
+      - name: flask
+        image: {ECR}/flask:old
+---
+apiVersion: batch/v1
+kind: CronJob
+metadata:
+  name: batch
+spec:
+  jobTemplate:
+    spec:
+      template:
+        spec:
+          containers:
+          - name: batch
+            image: registry.local:5000/flask:old
+"""
+
+
+@pytest.mark.parametrize('image, registry, repository, tag', [
+    ('flask', '', 'flask', ''),
+    (f'{ECR}/flask:v1', ECR, 'flask', 'v1'),
+    ('registry.local:5000/team/flask:v1', 'registry.local:5000', 'team/flask', 'v1'),
+    ('localhost:5000/flask@sha256:abcd', 'localhost:5000', 'flask', ''),
+])
+def test_image_reference(image, registry, repository, tag):
+    reference = image_updater.ImageReference(image)
+    assert (reference.registry, reference.repository, reference.tag) == (registry, repository, tag)
+    assert reference.with_tag('new') == (f'{registry}/{repository}:new' if registry else f'{repository}:new')
+
+
+def test_update_images_rewrites_only_matching_workload_images():
+    index = image_updater.ImageIndex(MANIFEST)
+    assert index.documents == 2
+    assert len(index.containers) == 4
+
+    updated = image_updater.update_images(MANIFEST, {'flask': 'new'}, index=index)
+    assert updated.count('flask:new') == 3
+    assert 'envoyproxy/envoy:v1.22.0' in updated
+    assert 'registry.local:5000/flask:new' in updated
+
+
+def test_update_images_kustomization():
+    kustomization = 'resources:\n- deployment.yaml\nimages:\n- name: flask\n  newTag: old\n- name: nginx\n  newTag: "1.21"\n'
+    updated = image_updater.update_images(kustomization, {'flask': 'new'}, filename='overlays/dev/kustomization.yaml')
+    assert 'newTag: new' in updated
+    assert "newTag: '1.21'" in updated or 'newTag: "1.21"' in updated
+
+
+def test_surgical_edit_keeps_everything_else_byte_identical():
+    content = '# managed by argocd\n' + MANIFEST.replace(
+        'image: envoyproxy/envoy:v1.22.0', 'image: "envoyproxy/envoy:v1.22.0"  # sidecar').replace('\n', '\r\n')
+    updated = image_updater.update_images(content, {'flask': 'new'})
+
+    before, after = content.split('\r\n'), updated.split('\r\n')
+    assert len(before) == len(after)
+    changed = [(a, b) for a, b in zip(before, after) if a != b]
+    assert len(changed) == 3
+    assert all(a.replace(':old', ':new') == b for a, b in changed)
+
+
+def test_surgical_edit_adds_missing_kustomization_new_tag():
+    kustomization = 'images:\n- name: flask  # app\n  newName: registry.local:5000/flask\n- name: nginx\n'
+    updated = image_updater.update_images(kustomization, {'flask': '1.10'}, filename='kustomization.yaml')
+    assert updated == ('images:\n- name: flask  # app\n  newName: registry.local:5000/flask\n'
+                       '  newTag: "1.10"\n- name: nginx\n')
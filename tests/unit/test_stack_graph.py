@@ -0,0 +1,92 @@
+import copy
+import aws_cdk
+import pytest
+from aws_cdk import assertions
+from benchmarks.synth import fixtures
+from stacks import stack_graph
+from configration import apex_domain
+from configration import codepipeline_stack_configuration
+from configration import deploy_environments
+from configration import dev_env_configuration
+
+
+def test_dependencies_stay_within_environment_and_cluster():
+    specs = {spec.name: spec for spec in stack_graph.plan_stacks(codepipeline_stack_configuration,
+                                                                 deploy_environments)}
+
+    assert specs['CodepipelineStack-flask'].depends_on == []
+    assert specs['EksVpcStack-prd'].depends_on == []
+    assert specs['FlaskAppStatefulStack-Dev'].depends_on == ['EksVpcStack-dev']
+    # 同じ環境のclusterは互いに依存しない
+    assert specs['EksClusterStack-dev-2'].depends_on == ['FlaskAppStatefulStack-Dev']
+    assert specs['FlaskAppStack-dev-2'].depends_on == ['EksClusterStack-dev-2']
+    assert 'EksClusterStack-prd-2' not in specs
+
+
+def test_critical_path_is_longest_single_chain():
+    specs = stack_graph.plan_stacks(codepipeline_stack_configuration, deploy_environments)
+    path, total = stack_graph.critical_path(specs)
+
+    assert path == ['EksVpcStack-dev', 'FlaskAppStatefulStack-Dev', 'EksClusterStack-dev-1', 'FlaskAppStack-dev-1']
+    assert total == sum(stack_graph.ESTIMATED_MINUTES[kind] for kind in ['vpc', 'stateful', 'cluster', 'app'])
+    assert stack_graph.deploy_waves(specs)[0] == ['CodepipelineStack-flask', 'EksVpcStack-dev', 'EksVpcStack-prd']
+
+
+def selected_names(envs: str = None, clusters: str = None) -> list:
+    specs = stack_graph.plan_stacks(codepipeline_stack_configuration, deploy_environments)
+    return [spec.name for spec in stack_graph.select_stacks(specs, stack_graph.parse_selector(envs),
+                                                            stack_graph.parse_selector(clusters))]
+
+
+def test_context_selectors_choose_stacks():
+    assert len(selected_names()) == 11
+    assert selected_names(envs='pipeline') == ['CodepipelineStack-flask']
+    assert selected_names(clusters='dev-2') == ['EksClusterStack-dev-2', 'FlaskAppStack-dev-2']
+    assert selected_names(envs='dev', clusters='dev-2') == [
+        'EksVpcStack-dev', 'FlaskAppStatefulStack-Dev', 'EksClusterStack-dev-2', 'FlaskAppStack-dev-2']
+    assert selected_names(envs='prd') == [
+        'EksVpcStack-prd', 'FlaskAppStatefulStack-Prd', 'EksClusterStack-prd-1', 'FlaskAppStack-prd-1']
+    with pytest.raises(ValueError):
+        selected_names(clusters='dev2')
+
+
+def three_cluster_environment(weights: list) -> dict:
+    config = copy.deepcopy(dev_env_configuration)
+    config['cluster-3'] = dict(config['cluster-2'], name='dev-3')
+    config['flask-3'] = dict(config['flask-2'], eks_cluster='dev-3')
+    for number, weight in enumerate(weights, start=1):
+        config[f'cluster-{number}']['weight'] = weight
+    return config
+
+
+def test_validate_environment_checks_weights_and_entries():
+    stack_graph.validate_environment(three_cluster_environment([50, 30, 20]), [1, 2, 3])
+    with pytest.raises(ValueError, match='add up to 100'):
+        stack_graph.validate_environment(three_cluster_environment([50, 30, 30]), [1, 2, 3])
+    with pytest.raises(ValueError, match='cluster-4 is not configured'):
+        stack_graph.validate_environment(three_cluster_environment([50, 30, 20]), [4])
+    config = three_cluster_environment([50, 30, 20])
+    del config['flask-3']
+    with pytest.raises(ValueError, match='flask-3 is missing'):
+        stack_graph.validate_environment(config, [1])
+
+
+def test_each_cluster_gets_target_group_and_weighted_forward():
+    config = three_cluster_environment([50, 30, 20])
+    specs = {spec.kind: spec for spec in stack_graph.plan_stacks(
+        codepipeline_stack_configuration, [{'config': config, 'clusters': [1, 2, 3]}])}
+    assert specs['vpc'].kwargs['cluster_names'] == ['dev-1', 'dev-2', 'dev-3']
+
+    app = aws_cdk.App(context=fixtures.synth_context(apex_domain))
+    spec = specs['stateful']
+    stack = spec.stack_class(app, spec.name, env=aws_cdk.Environment(account=fixtures.ACCOUNT,
+                                                                       region=fixtures.REGION), **spec.kwargs)
+    template = assertions.Template.from_stack(stack)
+
+    template.resource_count_is('AWS::ElasticLoadBalancingV2::TargetGroup', 3)
+    outputs = template.to_json()['Outputs']
+    assert sorted(output['Export']['Name'] for name, output in outputs.items() if 'TargetGroupArn' in name) == [
+        'ALB-TargetGroupArn-dev-1', 'ALB-TargetGroupArn-dev-2', 'ALB-TargetGroupArn-dev-3']
+    rule = next(iter(template.find_resources('AWS::ElasticLoadBalancingV2::ListenerRule').values()))
+    target_groups = rule['Properties']['Actions'][0]['ForwardConfig']['TargetGroups']
+    assert [target_group['Weight'] for target_group in target_groups] == [50, 30, 20]
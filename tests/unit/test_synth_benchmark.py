@@ -0,0 +1,29 @@
+from benchmarks import baseline as benchmark_baseline
+from benchmarks.synth import bench_synth
+from benchmarks.synth import fixtures
+
+
+def test_stacks_synthesize_offline_with_fixtures(tmp_path, monkeypatch):
+    # HostedZoneのlookup, ArgoCdのSecrets Managerを含むstackがAWSへのアクセスなしでsynthできる
+    fixtures.prepare_work_dir(str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('SKIP_PIP', '1')
+
+    result = bench_synth.worker('stateful')
+    assert result['resources'] > 0
+
+    minimal = fixtures.scenario_spec('eks-minimal')
+    assert not any(minimal.kwargs['cluster_config'][flag] for flag in fixtures.ADDON_FLAGS)
+    assert fixtures.scenario_spec('eks-all-addons').kwargs['cluster_config']['addon_argocd_enable']
+
+
+def test_find_regressions_uses_tolerance_and_slack():
+    baseline = {'vpc': {'construct_ms': 100, 'synth_ms': 100, 'total_ms': 2000, 'peak_rss_mb': 200,
+                        'template_kb': 10, 'resources': 40}}
+    tolerances = {'tolerance': 0.5, 'slack_ms': 500, 'size_tolerance': 0.2}
+
+    assert benchmark_baseline.find_regressions({'vpc': dict(baseline['vpc'], synth_ms=640)}, baseline, tolerances,
+                                               bench_synth.CHECKED_METRICS) == []
+    regressions = benchmark_baseline.find_regressions({'vpc': dict(baseline['vpc'], resources=49)}, baseline,
+                                                      tolerances, bench_synth.CHECKED_METRICS)
+    assert regressions == ['vpc: resources 49 > 48.0 (baseline 40)']